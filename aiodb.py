@@ -0,0 +1,57 @@
+# aiodb.py - non-blocking DB access for the dashboard's event loop
+#
+# db.py is synchronous, and a query can wait up to BUSY_TIMEOUT_MS for a busy
+# database; run on the event loop, that would freeze every WebSocket client.
+# Reads go to a small pool of threads instead, each with its own query-only
+# connection (WAL readers never wait for the workers' writes), and writes go
+# to a single thread. Identical reads already in flight are coalesced:
+# callers asking for the same function and arguments while it runs await
+# the same result, so N dashboards polling at once cost one query.
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+import db
+
+READ_THREADS = 4
+
+
+def _query_only():
+    # this thread's cached connection refuses writes from now on
+    db.get_conn().execute("PRAGMA query_only=ON")
+
+
+class AsyncDB:
+    def __init__(self, read_threads: int = READ_THREADS):
+        self._reads = ThreadPoolExecutor(max_workers=read_threads, thread_name_prefix="queuectl-read",
+                                         initializer=_query_only)
+        self._writes = ThreadPoolExecutor(max_workers=1, thread_name_prefix="queuectl-write")
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def read(self, fn: Callable, *args, **kwargs):
+        """Run a read-only fn(*args, **kwargs) on the read pool, sharing identical in-flight calls."""
+        key = (fn, args, tuple(sorted(kwargs.items())))
+        try:
+            fut = self._inflight.get(key)
+        except TypeError:
+            # unhashable arguments: just don't coalesce
+            key, fut = None, None
+        if fut is None:
+            fut = asyncio.get_running_loop().run_in_executor(self._reads, functools.partial(fn, *args, **kwargs))
+            if key is not None:
+                self._inflight[key] = fut
+                fut.add_done_callback(lambda _f: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # one waiter giving up (client gone) must not cancel the others
+        return await asyncio.shield(fut)
+
+    async def write(self, fn: Callable, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the single write thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._writes, functools.partial(fn, *args, **kwargs))
+
+    def close(self):
+        self._reads.shutdown(wait=False)
+        self._writes.shutdown(wait=True)
@@ -0,0 +1,211 @@
+# async_worker.py - asyncio worker engine: many concurrent subprocess jobs per process
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from db import (
+    DEFAULT_LEASE_SECONDS,
+    complete_job,
+    extend_leases,
+    fail_job,
+    get_config,
+    get_job,
+    reap_expired_leases,
+)
+from capture import DEFAULT_OUTPUT_CAP, output_settings, run_captured_async
+from fairshare import FairShare
+from metrics import METRICS, observe_wait
+from notify import Waker, poke
+from pyjobs import PythonPool, start_pool
+from retention import BackgroundRetention
+from worker import MAX_IDLE_SECONDS, REAP_INTERVAL, idle_timeout, shutdown_flag, worker_id
+
+# upper bound on jobs claimed per transaction, however many slots are free
+MAX_CLAIM_CHUNK = 100
+
+
+class AsyncWorker:
+    """
+    One claim loop feeding up to `concurrency` jobs that run side by side as
+    asyncio subprocesses. Per-job timeouts are event-loop timers, not threads.
+    All DB access goes through a single executor thread, i.e. one SQLite
+    connection, so the event loop never blocks on a busy database.
+    """
+
+    def __init__(self, concurrency: int, poll_interval: float = MAX_IDLE_SECONDS,
+                 pool: Optional[PythonPool] = None, max_jobs: Optional[int] = None, stop=None,
+                 queues: Optional[List[str]] = None):
+        self.concurrency = concurrency
+        self.queues = queues
+        # only ever used on self._db_thread
+        self.fair = FairShare(queues)
+        self.max_jobs = max_jobs
+        self.started = 0
+        self.stop = stop
+        self.poll_interval = poll_interval
+        self.owner = worker_id()
+        self.lease_seconds = DEFAULT_LEASE_SECONDS
+        self.output = (DEFAULT_OUTPUT_CAP, "logs")
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.retention = BackgroundRetention(self.owner)
+        self._retention_run: Optional[asyncio.Future] = None
+        self._db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="queuectl-db")
+        # python jobs block a thread each while their pool child runs them
+        self.pool = pool
+        self._py_threads = ThreadPoolExecutor(max_workers=pool.size if pool else 1,
+                                              thread_name_prefix="queuectl-py")
+
+    def _stopping(self) -> bool:
+        return shutdown_flag.is_set() or (self.stop is not None and self.stop.is_set())
+
+    async def _db(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_thread, functools.partial(fn, *args, **kwargs))
+
+    async def run(self):
+        self.lease_seconds = int(await self._db(get_config, "lease_seconds") or DEFAULT_LEASE_SECONDS)
+        self.output = await self._db(output_settings)
+        print(f"Async worker {self.owner} started (concurrency {self.concurrency}, "
+              f"lease {self.lease_seconds}s, queues {','.join(self.queues) if self.queues else 'all'}). "
+              f"Press Ctrl+C to stop.")
+        heartbeat = asyncio.create_task(self._heartbeat())
+        self.waker = Waker()
+        try:
+            await self._claim_loop()
+            if self.inflight:
+                print(f"Waiting for {len(self.inflight)} running job(s) to finish...")
+                await asyncio.gather(*self.inflight.values(), return_exceptions=True)
+        finally:
+            heartbeat.cancel()
+            self.waker.close()
+            await self._db(METRICS.flush, self.owner, True)
+            self._db_thread.shutdown(wait=True)
+            self._py_threads.shutdown(wait=True)
+
+    async def _claim_loop(self):
+        last_reap = 0.0
+        while not self._stopping():
+            if self.max_jobs and self.started >= self.max_jobs:
+                print(f"Async worker {self.owner} started {self.started} job(s); exiting to be replaced.")
+                return
+            if time.time() - last_reap >= REAP_INTERVAL:
+                last_reap = time.time()
+                reaped = await self._db(reap_expired_leases, int(last_reap))
+                if reaped:
+                    print(f"[REAP] {len(reaped)} expired lease(s) returned: {', '.join(reaped)}")
+                    poke()
+
+            if METRICS.flush_due():
+                await self._db(METRICS.flush, self.owner, True)
+            if self.retention.due() and (self._retention_run is None or self._retention_run.done()):
+                # its own thread (and connection): a pass takes seconds and must
+                # not hold up claims and results queued on self._db_thread
+                self._retention_run = asyncio.get_running_loop().run_in_executor(None, self.retention.run)
+
+            free = self.concurrency - len(self.inflight)
+            if self.max_jobs:
+                free = min(free, self.max_jobs - self.started)
+            if free <= 0:
+                # all slots busy: wake as soon as any job finishes
+                await asyncio.wait(list(self.inflight.values()), timeout=self.poll_interval,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            t0 = time.perf_counter()
+            job_ids = await self._db(self.fair.claim, int(time.time()), min(free, MAX_CLAIM_CHUNK),
+                                     owner=self.owner, lease_seconds=self.lease_seconds)
+            if job_ids:
+                METRICS.observe("claim", time.perf_counter() - t0)
+            claimed_at = time.time()
+            self.started += len(job_ids)
+            for job_id in job_ids:
+                task = asyncio.create_task(self._run_job(job_id, claimed_at))
+                self.inflight[job_id] = task
+                task.add_done_callback(lambda _t, j=job_id: self.inflight.pop(j, None))
+            if not job_ids:
+                # retries scheduled by our own jobs poke this waker too
+                await self.waker.wait_async(await self._db(idle_timeout, self.poll_interval))
+
+    async def _heartbeat(self):
+        interval = max(1.0, self.lease_seconds / 3.0)
+        while True:
+            await asyncio.sleep(interval)
+            ids = list(self.inflight)
+            if not ids:
+                continue
+            still = set(await self._db(extend_leases, ids, self.owner, int(time.time()) + self.lease_seconds))
+            for job_id in ids:
+                if job_id not in still:
+                    # complete/fail are owner-guarded, so the result will be dropped
+                    print(f"[LOST] {job_id} lease expired while running")
+
+    async def _run_job(self, job_id: str, claimed_at: float):
+        job = await self._db(get_job, job_id)
+        if not job:
+            return
+        observe_wait(job, claimed_at)
+        cmd = job["command"]
+        job_timeout = job["timeout"] if job["timeout"] is not None else None
+        print(f"> Processing {job['id']} (priority={job['priority']} timeout={job_timeout}) {job['kind']}: {cmd}")
+        try:
+            t0 = time.perf_counter()
+            if job["kind"] == "python":
+                if self.pool is None:
+                    raise RuntimeError("python job but this worker has no python pool")
+                returncode, out, err = await asyncio.get_running_loop().run_in_executor(
+                    self._py_threads,
+                    functools.partial(self.pool.run, cmd, job["args"], job_timeout, job["id"], *self.output))
+            else:
+                returncode, out, err = await run_captured_async(cmd, job_timeout, job["id"], *self.output)
+            METRICS.observe("run", time.perf_counter() - t0)
+            if returncode is None:
+                err_msg = f"timeout after {job_timeout}s"
+                print(f"[TIMEOUT] {job['id']} -> {err_msg}")
+                await self._fail(job, err_msg, stdout=out or None, stderr=err or None)
+            elif returncode == 0:
+                print(f"[OK] {job['id']}")
+                t0 = time.perf_counter()
+                released = await self._db(complete_job, job["id"], owner=self.owner, stdout=out, stderr=err)
+                METRICS.observe("commit", time.perf_counter() - t0)
+                if released is None:
+                    print(f"[LOST] {job['id']} lease expired before completion; result discarded")
+                elif released:
+                    print(f"[DEPS] {job['id']} released {len(released)} dependent job(s)")
+                    poke()
+            else:
+                print(f"[FAIL] {job['id']} (exit={returncode})")
+                await self._fail(job, err or out, stdout=out, stderr=err)
+        except Exception as e:
+            print(f"[EXC] {job['id']} -> {e}")
+            await self._fail(job, str(e))
+        if job["concurrency_key"]:
+            # a slot on this key is free again; workers idling on it can claim
+            poke()
+
+    async def _fail(self, job, err_msg: str, stdout: Optional[str] = None, stderr: Optional[str] = None):
+        t0 = time.perf_counter()
+        outcome = await self._db(fail_job, job["id"], err_msg, owner=self.owner, stdout=stdout, stderr=stderr)
+        METRICS.observe("commit", time.perf_counter() - t0)
+        if outcome is None:
+            print(f"[LOST] {job['id']} lease expired before failure was recorded")
+            return
+        state, attempts, delay = outcome
+        if state == "dead":
+            print(f"[DLQ] Job {job['id']} moved to DLQ after {attempts-1} retries.")
+        else:
+            print(f"[RETRY] {job['id']} in {delay}s (attempt {attempts}/{job['max_retries']})")
+            METRICS.observe("retry_delay", delay)
+            poke()
+
+
+def async_worker_loop(concurrency: int, poll_interval: float = 1.0, max_jobs: Optional[int] = None, stop=None,
+                      queues: Optional[List[str]] = None):
+    # python jobs are CPU-bound: no point in more children than cores
+    pool = start_pool(min(concurrency, os.cpu_count() or 1))
+    try:
+        asyncio.run(AsyncWorker(concurrency, poll_interval, pool, max_jobs, stop, queues).run())
+    finally:
+        pool.close()
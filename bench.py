@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# bench.py - micro/macro benchmarks for QueueCTL (run against a scratch DB)
+#
+#   python bench.py claim --sizes 10000,100000,1000000
+#   python bench.py conn --jobs 2000
+#   python bench.py enqueue --jobs 200000
+#   python bench.py workload mixed --jobs 5000 --workers 4 --json results.json
+#
+# Every benchmark works on its own temporary SQLite file, never on queue.db.
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import db
+
+
+def _fresh_db(tmpdir: str, name: str) -> str:
+    path = os.path.join(tmpdir, name)
+    db.close_conn()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db.DB_PATH = path
+    db.init_db()
+    return path
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    k = min(len(s) - 1, max(0, int(round(pct / 100.0 * (len(s) - 1)))))
+    return s[k]
+
+
+def _fmt_ms(seconds: float) -> str:
+    return f"{seconds * 1000:8.3f}ms"
+
+
+def _seed_jobs(count: int, state: str, prefix: str, chunk: int = 50000, future: bool = False):
+    """
+    Bulk-insert `count` synthetic jobs directly (bypasses save_job for speed),
+    then recount the trigger-maintained counters. future=True schedules them a
+    year out at priorities 5-9, above the 0-4 of due jobs, so a claim has to
+    get past them.
+    """
+    conn = db.get_conn()
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    run_at, base = (int(time.time()) + 365 * 86400, 5) if future else (0, 0)
+    done = 0
+    while done < count:
+        n = min(chunk, count - done)
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO jobs(id, command, state, attempts, max_retries, priority, created_at, updated_at, next_run_at) "
+            "VALUES (?, 'true', ?, 0, 3, ?, ?, ?, ?)",
+            ((f"{prefix}-{done + i}", state, base + (done + i) % 5, now, now, run_at) for i in range(n)),
+        )
+        conn.execute("COMMIT")
+        done += n
+    db.rebuild_queue_stats()
+
+
+def bench_claim(args):
+    """Claim latency as the number of completed jobs grows."""
+    sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+    tmpdir = args.dir or tempfile.mkdtemp(prefix="queuectl-bench-")
+    print(f"claim latency: {args.claims} claims per size, {args.pending} due + {args.future} future "
+          f"pending jobs, db in {tmpdir}")
+    print(f"{'completed':>10} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10}")
+    _fresh_db(tmpdir, "bench_claim.db")
+    seeded = 0
+    for size in sizes:
+        if size > seeded:
+            _seed_jobs(size - seeded, "completed", f"done{seeded}")
+            seeded = size
+        db.get_conn().execute("DELETE FROM jobs WHERE state!='completed'")
+        _seed_jobs(args.pending, "pending", f"pend{size}")
+        _seed_jobs(args.future, "pending", f"later{size}", future=True)
+
+        samples = []
+        for _ in range(args.claims):
+            t0 = time.perf_counter()
+            job_id = db.claim_one_pending(int(time.time()))
+            samples.append(time.perf_counter() - t0)
+            if job_id is None:
+                break
+        print(f"{size:>10} {_fmt_ms(statistics.mean(samples))} {_fmt_ms(_percentile(samples, 50))} "
+              f"{_fmt_ms(_percentile(samples, 99))} {_fmt_ms(max(samples))}")
+
+
+def _legacy_get_conn():
+    # what db.get_conn() did before connections were cached: a new handle
+    # (and a journal_mode round trip) for every call
+    conn = sqlite3.connect(db.DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _job_lifecycle(i: int, prefix: str):
+    """The DB calls one successful job makes: enqueue, claim, run, complete."""
+    job_id = f"{prefix}-{i}"
+    db.get_config("default_max_retries")
+    db.save_job({"id": job_id, "command": "true"})
+    claimed = db.claim_one_pending(int(time.time()), owner="bench")
+    job = db.get_job(claimed)
+    db.complete_job(job["id"], owner="bench", stdout="", stderr="")
+
+
+def bench_conn(args):
+    """Per-job DB overhead with a fresh connection per call vs. cached connections."""
+    tmpdir = args.dir or tempfile.mkdtemp(prefix="queuectl-bench-")
+    print(f"per-job DB overhead: {args.jobs} job lifecycles per mode, db in {tmpdir}")
+    results = {}
+    for mode in ("per-call connect", "cached connection"):
+        _fresh_db(tmpdir, "bench_conn.db")
+        real_get_conn = db.get_conn
+        if mode == "per-call connect":
+            db.get_conn = _legacy_get_conn
+        try:
+            samples = []
+            for i in range(args.jobs):
+                t0 = time.perf_counter()
+                _job_lifecycle(i, "conn")
+                samples.append(time.perf_counter() - t0)
+        finally:
+            db.get_conn = real_get_conn
+        results[mode] = samples
+        print(f"{mode:>18}: mean {_fmt_ms(statistics.mean(samples))}  p50 {_fmt_ms(_percentile(samples, 50))}  "
+              f"p99 {_fmt_ms(_percentile(samples, 99))}  -> {len(samples) / sum(samples):8.0f} jobs/s")
+    before = statistics.mean(results["per-call connect"])
+    after = statistics.mean(results["cached connection"])
+    print(f"speedup: {before / after:.2f}x")
+
+
+def _write_jsonl(path: str, count: int, prefix: str):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            f.write(json.dumps({"id": f"{prefix}-{i}", "command": "true", "priority": i % 5}) + "\n")
+
+
+def bench_enqueue(args):
+    """Insert throughput: save_job per job vs. `enqueue --jsonl` batches."""
+    tmpdir = args.dir or tempfile.mkdtemp(prefix="queuectl-bench-")
+    src = os.path.join(tmpdir, "bench_enqueue.jsonl")
+    _write_jsonl(src, args.jobs, "bulk")
+    print(f"enqueue throughput: {args.jobs} jobs from {src}")
+
+    _fresh_db(tmpdir, "bench_enqueue.db")
+    n = min(args.jobs, args.single)
+    t0 = time.perf_counter()
+    for i in range(n):
+        db.save_job({"id": f"single-{i}", "command": "true", "max_retries": 3})
+    elapsed = time.perf_counter() - t0
+    print(f"{'save_job per job':>22}: {n:>8} jobs in {elapsed:7.2f}s -> {n / elapsed:9.0f} jobs/s")
+
+    for chunk_size in [int(x) for x in args.chunks.split(",") if x.strip()]:
+        _fresh_db(tmpdir, "bench_enqueue.db")
+        # imported late: queuectl runs init_db() on import, which must hit the scratch DB
+        from queuectl import enqueue_jsonl
+        t0 = time.perf_counter()
+        with open(src, encoding="utf-8") as f:
+            enqueued, _, _, errors = enqueue_jsonl(f, chunk_size, "error", None, None, None)
+        elapsed = time.perf_counter() - t0
+        label = f"--jsonl chunk {chunk_size}"
+        print(f"{label:>22}: {enqueued:>8} jobs in {elapsed:7.2f}s -> {enqueued / elapsed:9.0f} jobs/s"
+              f"{f'  ({errors} errors)' if errors else ''}")
+
+
+# ---------------------------------------------------------------------------
+# End-to-end workloads: real worker processes against a scratch DB (Linux/fork)
+
+SCENARIOS = {
+    "noop": {"noop": 1},
+    "sleep": {"sleep": 1},
+    "fail": {"noop": 4, "fail": 1},
+    "scheduled": {"scheduled": 1},
+    "priority": {"priority": 1},
+    "python": {"python": 1},
+    "mixed": {"noop": 5, "sleep": 2, "fail": 1, "scheduled": 1, "priority": 1},
+}
+
+
+def _make_job(kind: str, i: int, rng: random.Random, args) -> Dict:
+    job = {"id": f"{kind}-{i}", "command": "true"}
+    if kind == "sleep":
+        job["command"] = f"sleep {args.sleep}"
+    elif kind == "fail":
+        job["command"] = "false"
+        job["max_retries"] = args.retries
+    elif kind == "scheduled":
+        # seconds after enqueue; made absolute when the job is enqueued
+        job["delay"] = rng.uniform(1.0, args.spread)
+    elif kind == "priority":
+        job["priority"] = rng.randint(0, 9)
+    elif kind == "python":
+        # in-process callable: the pool's cost per job without fork+exec
+        job.update(kind="python", command="time:sleep", args=[0])
+    return job
+
+
+def _generate(args) -> List[Dict]:
+    """Same --seed, same jobs in the same order: runs are replayable."""
+    if args.mix:
+        weights = {k: float(v) for k, v in (part.split("=") for part in args.mix.split(","))}
+    else:
+        weights = SCENARIOS[args.scenario]
+    unknown = set(weights) - {"noop", "sleep", "fail", "scheduled", "priority", "python"}
+    if unknown:
+        raise SystemExit(f"unknown job kind(s) in --mix: {', '.join(sorted(unknown))}")
+    rng = random.Random(args.seed)
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=args.jobs)
+    return [_make_job(kind, i, rng, args) for i, kind in enumerate(kinds)]
+
+
+def _bench_worker(engine: str, batch_size: int, concurrency: int):
+    # keep per-job worker chatter out of the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    if engine == "async":
+        from async_worker import async_worker_loop
+        async_worker_loop(concurrency)
+    else:
+        from worker import worker_loop
+        worker_loop(batch_size=batch_size)
+
+
+def _enqueue_all(jobs: List[Dict], rate: float, due_at: Dict[str, float]):
+    from notify import poke
+    chunk = max(1, int(rate / 20)) if rate else 5000
+    start = time.time()
+    for i in range(0, len(jobs), chunk):
+        if rate:
+            # open loop: hold the offered rate regardless of how workers keep up
+            time.sleep(max(0.0, start + i / rate - time.time()))
+        now = time.time()
+        batch = []
+        for job in jobs[i:i + chunk]:
+            job = dict(job)
+            delay = job.pop("delay", None)
+            due = now
+            if delay is not None:
+                job["next_run_at"] = int(now + delay)
+                due = float(job["next_run_at"])
+            due_at[job["id"]] = due
+            batch.append(job)
+        db.save_jobs(batch)
+        poke()
+
+
+def _stats_line(label: str, samples: List[float]) -> str:
+    if not samples:
+        return f"{label:<22} {'-':>8}"
+    return (f"{label:<22} {len(samples):>8} {_fmt_ms(statistics.mean(samples))} "
+            f"{_fmt_ms(_percentile(samples, 50))} {_fmt_ms(_percentile(samples, 99))} {_fmt_ms(max(samples))}")
+
+
+def _summary(samples: List[float]) -> Dict:
+    if not samples:
+        return {"n": 0}
+    return {"n": len(samples), "mean": statistics.mean(samples), "p50": _percentile(samples, 50),
+            "p99": _percentile(samples, 99), "max": max(samples)}
+
+
+def bench_workload(args):
+    """Enqueue a synthetic workload, run real workers until it drains, report latencies."""
+    if sys.platform == "win32":
+        raise SystemExit("bench.py workload needs fork (Linux/macOS)")
+    import metrics
+    import worker
+    from notify import poke
+
+    tmpdir = args.dir or tempfile.mkdtemp(prefix="queuectl-bench-")
+    _fresh_db(tmpdir, "bench_workload.db")
+    db.set_config("backoff_base", str(args.backoff_base))
+    db.set_config("log_dir", os.path.join(tmpdir, "logs"))
+    jobs = _generate(args)
+    engine = f"{args.workers} x async(concurrency {args.concurrency})" if args.engine == "async" \
+        else f"{args.workers} x process(batch {args.batch_size})"
+    print(f"workload {args.mix or args.scenario}: {len(jobs)} jobs, seed {args.seed}, {engine}, db in {tmpdir}")
+
+    ctx = multiprocessing.get_context("fork")
+    worker.shutdown_flag.clear()
+    db.close_conn()
+    procs = [ctx.Process(target=_bench_worker, args=(args.engine, args.batch_size, args.concurrency))
+             for _ in range(args.workers)]
+    for p in procs:
+        p.start()
+    time.sleep(0.5)  # let workers register their wakeup ports
+
+    due_at: Dict[str, float] = {}
+    t0 = time.time()
+    drained = False
+    try:
+        _enqueue_all(jobs, args.rate, due_at)
+        enqueued_in = time.time() - t0
+        while time.time() - t0 < args.timeout:
+            summary = db.stats_summary()
+            if summary.get("completed", 0) + summary.get("dead", 0) >= len(jobs):
+                drained = True
+                break
+            time.sleep(0.05)
+    finally:
+        worker.shutdown_flag.set()
+        poke()
+        for p in procs:
+            p.join(timeout=30)
+            if p.is_alive():
+                p.terminate()
+    if not drained:
+        print(f"WARNING: timed out after {args.timeout}s with {db.stats_summary()}")
+
+    rows = db.get_conn().execute(
+        "SELECT id, state, priority, attempts, enqueued_at, next_run_at, claimed_at, finished_at FROM jobs"
+    ).fetchall()
+    finished = [r for r in rows if r["finished_at"] is not None]
+    wall = (max(r["finished_at"] for r in finished) - t0) if finished else 0.0
+    groups: Dict[str, Dict[str, List[float]]] = {}
+
+    def add(group: str, pickup: float, done: float):
+        g = groups.setdefault(group, {"pickup": [], "completion": []})
+        g["pickup"].append(pickup)
+        g["completion"].append(done)
+
+    for r in finished:
+        kind = r["id"].split("-", 1)[0]
+        # pickup of the last attempt; completion is end to end, retries included
+        pickup = r["claimed_at"] - max(r["enqueued_at"], r["next_run_at"] or 0)
+        done = r["finished_at"] - due_at[r["id"]]
+        add("all", pickup, done)
+        add(kind, pickup, done)
+        if kind == "priority":
+            add("priority 5-9" if r["priority"] >= 5 else "priority 0-4", pickup, done)
+
+    histograms, _ = metrics.collect()
+    results = {
+        "params": {k: v for k, v in vars(args).items() if k != "func"},
+        "jobs": len(jobs), "finished": len(finished), "drained": drained,
+        "dead": sum(1 for r in rows if r["state"] == "dead"),
+        "enqueue_seconds": enqueued_in, "wall_seconds": wall,
+        "jobs_per_second": len(finished) / wall if wall else 0.0,
+        "latency": {g: {k: _summary(v) for k, v in d.items()} for g, d in groups.items()},
+        "stages": {stage: {"count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                   for stage, h in histograms.items()},
+    }
+
+    print(f"finished {len(finished)}/{len(jobs)} ({results['dead']} dead) in {wall:.2f}s "
+          f"-> {results['jobs_per_second']:.0f} jobs/s (enqueue took {enqueued_in:.2f}s)")
+    print(f"{'latency':<22} {'n':>8} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10}")
+    for group in sorted(groups, key=lambda g: (g != "all", g)):
+        print(_stats_line(f"pickup {group}", groups[group]["pickup"]))
+        print(_stats_line(f"completion {group}", groups[group]["completion"]))
+    lock = histograms["lock_wait"]
+    print(f"db lock wait: {lock.count} transactions, total {lock.sum:.3f}s, "
+          f"p99 ~{(lock.quantile(0.99) or 0) * 1000:.2f}ms; claim p99 ~{(histograms['claim'].quantile(0.99) or 0) * 1000:.2f}ms, "
+          f"commit p99 ~{(histograms['commit'].quantile(0.99) or 0) * 1000:.2f}ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QueueCTL benchmarks")
+    parser.add_argument("--dir", default=None, help="Directory for scratch DBs (default: a new temp dir)")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("claim", help="claim_one_pending latency vs. completed-job count")
+    p.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated completed-job counts")
+    p.add_argument("--pending", type=int, default=2000, help="Pending jobs present at each size")
+    p.add_argument("--claims", type=int, default=1000, help="Claims to time at each size")
+    p.add_argument("--future", type=int, default=2000,
+                   help="Higher-priority pending jobs not due yet, present at each size")
+    p.set_defaults(func=bench_claim)
+
+    p = sub.add_parser("conn", help="per-job DB overhead, fresh vs. cached connections")
+    p.add_argument("--jobs", type=int, default=2000, help="Job lifecycles to time per mode")
+    p.set_defaults(func=bench_conn)
+
+    p = sub.add_parser("enqueue", help="insert throughput, per-job save_job vs. bulk --jsonl")
+    p.add_argument("--jobs", type=int, default=200000, help="Jobs in the generated JSONL file")
+    p.add_argument("--single", type=int, default=5000, help="Jobs to time through save_job one by one")
+    p.add_argument("--chunks", default="1000,5000,20000", help="Comma-separated --chunk-size values to try")
+    p.set_defaults(func=bench_enqueue)
+
+    p = sub.add_parser("workload", help="end-to-end run with real workers: jobs/s, pickup/completion latency, lock wait")
+    p.add_argument("scenario", nargs="?", default="mixed", choices=sorted(SCENARIOS))
+    p.add_argument("--mix", default=None, help="Custom weights instead of a scenario, e.g. noop=8,fail=1,scheduled=1")
+    p.add_argument("--jobs", type=int, default=2000)
+    p.add_argument("--seed", type=int, default=1, help="Workload seed; same seed, same jobs")
+    p.add_argument("--workers", type=int, default=4, help="Worker processes")
+    p.add_argument("--engine", choices=["process", "async"], default="process")
+    p.add_argument("--batch-size", type=int, default=1, help="Claim batch size (process engine)")
+    p.add_argument("--concurrency", type=int, default=50, help="Jobs per process (async engine)")
+    p.add_argument("--rate", type=float, default=0, help="Enqueue at this many jobs/s (default: all at once)")
+    p.add_argument("--sleep", type=float, default=0.1, help="Seconds per sleep job")
+    p.add_argument("--retries", type=int, default=2, help="max_retries of failing jobs")
+    p.add_argument("--backoff-base", type=int, default=1, help="backoff_base for the run")
+    p.add_argument("--spread", type=float, default=5.0, help="Scheduled jobs are due 1..spread seconds out")
+    p.add_argument("--timeout", type=float, default=300.0, help="Give up waiting for the queue to drain after this")
+    p.add_argument("--json", default=None, help="Also write params and results to this JSON file")
+    p.set_defaults(func=bench_workload)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
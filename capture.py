@@ -0,0 +1,191 @@
+# capture.py - streamed, bounded capture of job stdout/stderr
+#
+# Output is read from the pipes in chunks as the job runs. Only the first and
+# last cap/2 bytes of each stream are kept in memory (and stored in
+# jobs.last_stdout / last_stderr). Once a stream outgrows the cap, everything
+# it writes is also spilled to <log_dir>/<job_id>.<stream>.log.gz, which
+# `queuectl logs` and the dashboard can tail without loading it whole.
+import asyncio
+import gzip
+import os
+import re
+import signal
+import subprocess
+import threading
+from collections import deque
+from typing import List, Optional, Tuple
+
+import db
+
+DEFAULT_OUTPUT_CAP = 64 * 1024
+READ_CHUNK = 64 * 1024
+STREAMS = ("stdout", "stderr")
+
+
+def output_settings() -> Tuple[int, str]:
+    """(cap in bytes, spill directory) from config, with defaults."""
+    cap = int(db.get_config("output_cap_bytes") or DEFAULT_OUTPUT_CAP)
+    log_dir = db.get_config("log_dir") or os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), "logs")
+    return max(cap, 2), log_dir
+
+
+def log_path(log_dir: str, job_id: str, stream: str) -> str:
+    safe_id = re.sub(r"[^A-Za-z0-9_.@-]", "_", job_id)
+    return os.path.join(log_dir, f"{safe_id}.{stream}.log.gz")
+
+
+class OutputCapture:
+    """
+    Collects one output stream with bounded memory: head + tail of `cap`
+    bytes total, the full stream going to a gzip spill file past the cap.
+    """
+
+    def __init__(self, path: str, cap: int = DEFAULT_OUTPUT_CAP):
+        self.path = path
+        self.half = cap // 2
+        self.cap = cap
+        self.total = 0
+        self._buf = bytearray()     # everything, until the cap is exceeded
+        self._head = b""
+        self._tail = bytearray()
+        self._spill = None
+        # a previous attempt's spill file would otherwise shadow this run
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def feed(self, chunk: bytes):
+        if not chunk:
+            return
+        self.total += len(chunk)
+        if self._spill is None:
+            self._buf += chunk
+            if len(self._buf) <= self.cap:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._spill = gzip.open(self.path, "wb", compresslevel=6)
+            self._spill.write(self._buf)
+            self._head = bytes(self._buf[:self.half])
+            self._tail = self._buf[-self.half:]
+            self._buf = bytearray()
+            return
+        self._spill.write(chunk)
+        self._tail += chunk
+        if len(self._tail) > self.half:
+            del self._tail[:-self.half]
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+
+    def text(self) -> str:
+        if self._spill is None:
+            return _decode(bytes(self._buf))
+        omitted = self.total - len(self._head) - len(self._tail)
+        marker = f"\n...[{omitted} bytes omitted; full log: {self.path}]...\n"
+        return (_decode(self._head) + marker + _decode(bytes(self._tail))).strip()
+
+
+def _decode(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace").strip()
+
+
+def kill_tree(proc):
+    # the shell's children would otherwise keep the pipes (and wait()) open
+    if os.name == "posix":
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+        except ProcessLookupError:
+            return
+        except OSError:
+            pass
+    proc.kill()
+
+
+def _pump(pipe, capture: OutputCapture):
+    try:
+        for chunk in iter(lambda: pipe.read1(READ_CHUNK), b""):
+            capture.feed(chunk)
+    finally:
+        pipe.close()
+
+
+def run_captured(cmd: str, timeout: Optional[float], job_id: str,
+                 cap: int, log_dir: str) -> Tuple[Optional[int], str, str]:
+    """
+    Run a shell command, streaming its output into bounded captures.
+    Returns (returncode, stdout, stderr); returncode is None on timeout.
+    """
+    out = OutputCapture(log_path(log_dir, job_id, "stdout"), cap)
+    err = OutputCapture(log_path(log_dir, job_id, "stderr"), cap)
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            start_new_session=(os.name == "posix"))
+    readers = [threading.Thread(target=_pump, args=(proc.stdout, out), daemon=True),
+               threading.Thread(target=_pump, args=(proc.stderr, err), daemon=True)]
+    for t in readers:
+        t.start()
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_tree(proc)
+        proc.wait()
+        returncode = None
+    for t in readers:
+        t.join()
+    out.close()
+    err.close()
+    return returncode, out.text(), err.text()
+
+
+async def _apump(stream, capture: OutputCapture):
+    while True:
+        chunk = await stream.read(READ_CHUNK)
+        if not chunk:
+            return
+        capture.feed(chunk)
+
+
+async def run_captured_async(cmd: str, timeout: Optional[float], job_id: str,
+                             cap: int, log_dir: str) -> Tuple[Optional[int], str, str]:
+    """Event-loop version of run_captured(); no threads involved."""
+    out = OutputCapture(log_path(log_dir, job_id, "stdout"), cap)
+    err = OutputCapture(log_path(log_dir, job_id, "stderr"), cap)
+    proc = await asyncio.create_subprocess_shell(
+        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        start_new_session=(os.name == "posix"))
+    pumps = asyncio.gather(_apump(proc.stdout, out), _apump(proc.stderr, err))
+    try:
+        await asyncio.wait_for(asyncio.shield(proc.wait()), timeout=timeout)
+        returncode = proc.returncode
+    except asyncio.TimeoutError:
+        kill_tree(proc)
+        await proc.wait()
+        returncode = None
+    try:
+        # pipes hit EOF once the process group is gone
+        await pumps
+    finally:
+        out.close()
+        err.close()
+    return returncode, out.text(), err.text()
+
+
+def tail_log(log_dir: str, job_id: str, stream: str = "stdout", lines: int = 100) -> Optional[List[str]]:
+    """
+    Last `lines` lines of a spilled log, decompressed as a stream so memory
+    stays at O(lines). None if the job has no spill file for that stream.
+    """
+    path = log_path(log_dir, job_id, stream)
+    if not os.path.exists(path):
+        return None
+    last = deque(maxlen=max(1, lines))
+    try:
+        with gzip.open(path, "rt", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                last.append(line.rstrip("\n"))
+    except EOFError:
+        # still being written by a running job; show what's flushed so far
+        pass
+    return list(last)
@@ -1,23 +1,99 @@
 # db.py - SQLite helper for QueueCTL (with job_events and pagination)
+import base64
+import json
+import os
 import sqlite3
+import threading
 import time
-from typing import Optional, List, Dict, Tuple
+from contextlib import contextmanager
+from typing import Callable, Optional, List, Dict, Tuple
 
 DB_PATH = "queue.db"
 
+# how long a claim stays valid without a heartbeat (overridable via config)
+DEFAULT_LEASE_SECONDS = 60
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
-    conn.execute("PRAGMA journal_mode=WAL;")
+BUSY_TIMEOUT_MS = 30000
+# per-connection prepared statement cache (sqlite3's LRU of compiled SQL)
+STATEMENT_CACHE_SIZE = 256
+
+# Applied once per new connection. WAL + synchronous=NORMAL keeps commits
+# durable against process crashes and only fsyncs at checkpoints.
+CONN_PRAGMAS = (
+    # only takes effect on a brand-new file (or at the next VACUUM), so it
+    # has to come before journal_mode; lets `queuectl gc` return free pages
+    "PRAGMA auto_vacuum=INCREMENTAL;",
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS};",
+    "PRAGMA cache_size=-16000;",       # ~16 MB page cache
+    "PRAGMA mmap_size=268435456;",     # 256 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA journal_size_limit=67108864;",  # truncate the WAL back to 64 MB after checkpoints
+    # INSERT OR REPLACE only fires the jobs DELETE trigger (queue_stats) with this
+    # on; without it a replaced job would be counted twice
+    "PRAGMA recursive_triggers=ON;",
+)
+
+_local = threading.local()
+
+# called with the seconds each BEGIN IMMEDIATE spent waiting for the write
+# lock (metrics.py hooks its "lock_wait" histogram in here)
+LOCK_WAIT_HOOK: Optional[Callable[[float], None]] = None
+
+
+def _begin_immediate(cur):
+    if LOCK_WAIT_HOOK is None:
+        cur.execute("BEGIN IMMEDIATE;")
+        return
+    t0 = time.perf_counter()
+    cur.execute("BEGIN IMMEDIATE;")
+    LOCK_WAIT_HOOK(time.perf_counter() - t0)
+
+
+def _open_conn(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000.0, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in CONN_PRAGMAS:
+        conn.execute(pragma)
     conn.row_factory = sqlite3.Row
     return conn
 
 
-def init_db():
+def get_conn() -> sqlite3.Connection:
+    """
+    Return this thread's connection to DB_PATH, opening it on first use.
+    Connections are cached per (process, thread, DB_PATH): a forked child or a
+    changed DB_PATH gets a fresh one, and sqlite3's thread check is kept.
+    Callers must not close() it; use close_conn() instead.
+    """
+    key = (os.getpid(), DB_PATH)
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.key == key:
+        return conn
+    if conn is not None and _local.key[0] == key[0]:
+        # same process, DB_PATH changed: drop the old handle
+        conn.close()
+    # (a connection inherited across fork is abandoned, never closed, so the
+    # parent's locks are left alone)
+    conn = _open_conn(DB_PATH)
+    _local.conn = conn
+    _local.key = key
+    return conn
+
+
+def close_conn():
+    """Close this thread's cached connection, if any."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.key[0] == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+def init_db() -> List[int]:
     """
-    Create tables if not exists. For new DBs, this creates the schema with
-    priority, timeout, last_stdout, last_stderr and job_events.
-    For existing DBs, use migrate.py to add missing columns/tables.
+    Create tables if not exists, then apply any pending schema migrations
+    (see MIGRATIONS below). Returns the migration versions applied.
     """
     conn = get_conn()
     cur = conn.cursor()
@@ -54,20 +130,546 @@ def init_db():
     # set defaults if not present
     cur.execute("INSERT OR IGNORE INTO config(key, value) VALUES (?, ?)", ("backoff_base", "2"))
     cur.execute("INSERT OR IGNORE INTO config(key, value) VALUES (?, ?)", ("default_max_retries", "3"))
+    cur.execute("INSERT OR IGNORE INTO config(key, value) VALUES (?, ?)", ("lease_seconds", str(DEFAULT_LEASE_SECONDS)))
     conn.commit()
-    conn.close()
+    applied = migrate_db(conn)
+    return applied
+
+
+# ---------------------------------------------------------------------------
+# Schema migrations
+#
+# The applied schema version is stored in PRAGMA user_version. Each migration
+# runs in its own BEGIN IMMEDIATE transaction together with the version bump,
+# so a crash mid-migration leaves the DB at the previous version.
+# ---------------------------------------------------------------------------
+
+def _table_columns(cur, table: str) -> List[str]:
+    return [r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _run_script(cur, script: str):
+    """
+    Execute a multi-statement script inside the current transaction
+    (executescript() would COMMIT it first).
+    """
+    pending = ""
+    for line in script.splitlines(keepends=True):
+        pending += line
+        if sqlite3.complete_statement(pending):
+            cur.execute(pending)
+            pending = ""
+    if pending.strip():
+        cur.execute(pending)
+
+
+def _add_column(cur, table: str, column: str, decl: str):
+    if column not in _table_columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _m001_base_columns(cur):
+    # columns/tables that older DBs used to get from migrate.py / migrate_events.py
+    _add_column(cur, "jobs", "priority", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(cur, "jobs", "timeout", "INTEGER")
+    _add_column(cur, "jobs", "last_stdout", "TEXT")
+    _add_column(cur, "jobs", "last_stderr", "TEXT")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS job_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_id TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        message TEXT,
+        created_at TEXT
+    )
+    """)
+
+
+def _m002_indexes(cur):
+    # Partial index matching the claim query exactly: only pending rows are
+    # indexed, in claim order, and it carries next_run_at, id and state so the
+    # claim SELECT never touches the table. Size is bounded by the pending
+    # backlog, not by how many completed jobs have accumulated.
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_jobs_claim
+    ON jobs(priority DESC, created_at, next_run_at, id, state)
+    WHERE state='pending'
+    """)
+    # list_jobs(state) / get_jobs_paginated(state=...)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, priority DESC, created_at, id)")
+    # unfiltered listing / pagination order
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_order ON jobs(priority DESC, created_at, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events(job_id, created_at)")
+
+
+def _m003_leases(cur):
+    _add_column(cur, "jobs", "lease_owner", "TEXT")
+    _add_column(cur, "jobs", "lease_expires_at", "INTEGER")
+    # the reaper's range scan: only processing rows, ordered by expiry
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_jobs_lease
+    ON jobs(lease_expires_at)
+    WHERE state='processing'
+    """)
+    # jobs already stuck in 'processing' get a short grace lease so the
+    # reaper picks them up if nobody is actually working on them
+    cur.execute(
+        "UPDATE jobs SET lease_expires_at=? WHERE state='processing' AND lease_expires_at IS NULL",
+        (int(time.time()) + DEFAULT_LEASE_SECONDS,),
+    )
+
+
+def _m004_due_index(cur):
+    # earliest future next_run_at among pending jobs (worker idle sleep)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_jobs_pending_due
+    ON jobs(next_run_at)
+    WHERE state='pending'
+    """)
+
+
+# minutes of per-minute throughput kept in queue_throughput
+THROUGHPUT_RETENTION_MINUTES = 24 * 60
+
+
+def _m005_queue_stats(cur):
+    # per-state counters and per-minute throughput, kept current in the same
+    # transaction as every jobs write, so reading them is O(1). Updates and
+    # deletes go through triggers; inserts are counted per batch by
+    # save_job()/save_jobs() (_count_inserted), since a per-row insert
+    # trigger costs bulk enqueue ~40% of its throughput.
+    _run_script(cur, f"""
+    CREATE TABLE IF NOT EXISTS queue_stats (
+        state TEXT PRIMARY KEY,
+        jobs INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS queue_throughput (
+        minute INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (minute, kind)
+    );
+
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_stats_delete AFTER DELETE ON jobs BEGIN
+        UPDATE queue_stats SET jobs=jobs-1, attempts=attempts-OLD.attempts WHERE state=OLD.state;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_stats_update AFTER UPDATE OF state, attempts ON jobs
+    WHEN OLD.state IS NOT NEW.state OR OLD.attempts IS NOT NEW.attempts BEGIN
+        UPDATE queue_stats SET jobs=jobs-1, attempts=attempts-OLD.attempts WHERE state=OLD.state;
+        INSERT INTO queue_stats(state, jobs, attempts) VALUES (NEW.state, 1, NEW.attempts)
+          ON CONFLICT(state) DO UPDATE SET jobs=jobs+1, attempts=attempts+excluded.attempts;
+        -- a failed attempt (retry, DLQ or expired lease) always bumps attempts
+        INSERT INTO queue_throughput(minute, kind, count)
+          SELECT CAST(strftime('%s','now') AS INTEGER)/60, kind, 1 FROM (
+            SELECT 'completed' AS kind WHERE NEW.state='completed' AND OLD.state IS NOT 'completed'
+            UNION ALL SELECT 'failed' WHERE NEW.attempts > OLD.attempts
+            UNION ALL SELECT 'dead' WHERE NEW.state='dead' AND OLD.state IS NOT 'dead'
+          ) WHERE 1
+          ON CONFLICT(minute, kind) DO UPDATE SET count=count+1;
+    END;
+
+    -- first row of a new minute: drop the ones past retention
+    CREATE TRIGGER IF NOT EXISTS trg_throughput_retention AFTER INSERT ON queue_throughput BEGIN
+        DELETE FROM queue_throughput WHERE minute < NEW.minute - {THROUGHPUT_RETENTION_MINUTES};
+    END;
+    """)
+    _rebuild_queue_stats(cur)
+
+
+def _rebuild_queue_stats(cur):
+    cur.execute("DELETE FROM queue_stats")
+    cur.execute("""
+    INSERT INTO queue_stats(state, jobs, attempts)
+    SELECT state, COUNT(*), COALESCE(SUM(attempts), 0) FROM jobs GROUP BY state
+    """)
+
 
+def _recount_queues(cur):
+    cur.execute("INSERT OR IGNORE INTO queues(name) SELECT DISTINCT queue FROM jobs")
+    cur.execute("UPDATE queues SET pending=(SELECT COUNT(*) FROM jobs "
+                "WHERE jobs.queue=queues.name AND jobs.state='pending')")
 
-def save_job(job: Dict):
+
+def rebuild_queue_stats():
+    """Recount queue_stats and queues.pending from jobs, e.g. after inserting rows with raw SQL."""
     conn = get_conn()
     cur = conn.cursor()
-    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    _begin_immediate(cur)
+    try:
+        _rebuild_queue_stats(cur)
+        _recount_queues(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _m006_metrics(cur):
+    # created_at is a whole-second string; queue wait needs sub-second precision
+    _add_column(cur, "jobs", "enqueued_at", "REAL")
+    # latest histogram snapshot of each worker process (see metrics.py)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS worker_metrics (
+        worker TEXT PRIMARY KEY,
+        updated_at REAL NOT NULL,
+        data TEXT NOT NULL
+    )
+    """)
+
+
+def _m007_retention(cur):
+    # finished jobs by age, for `queuectl gc` (updated_at is an ISO string)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_jobs_finished
+    ON jobs(updated_at)
+    WHERE state IN ('completed', 'dead')
+    """)
+    # named, expiring locks so only one process runs a maintenance task
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS locks (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+
+
+def _m008_job_timing(cur):
+    # when the current attempt was claimed and when the job finished, so
+    # per-job pickup and end-to-end latency can be measured (bench.py)
+    _add_column(cur, "jobs", "claimed_at", "REAL")
+    _add_column(cur, "jobs", "finished_at", "REAL")
+
+
+def _m009_job_kind(cur):
+    # 'shell' runs `command` through /bin/sh; 'python' calls the
+    # "module:function" it names with the JSON `args` (see pyjobs.py)
+    _add_column(cur, "jobs", "kind", "TEXT NOT NULL DEFAULT 'shell'")
+    _add_column(cur, "jobs", "args", "TEXT")
+
+
+
+DEFAULT_QUEUE = "default"
+
+
+def _m010_queues(cur):
+    _add_column(cur, "jobs", "queue", f"TEXT NOT NULL DEFAULT '{DEFAULT_QUEUE}'")
+    # per-queue twin of idx_jobs_claim: a claim from one queue is a single
+    # seek however many queues exist
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_jobs_queue_claim
+    ON jobs(queue, priority DESC, created_at, next_run_at, id)
+    WHERE state='pending'
+    """)
+    # every queue ever enqueued to, with its fair-share weight (fairshare.py)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS queues (
+        name TEXT PRIMARY KEY,
+        weight INTEGER NOT NULL DEFAULT 1
+    )
+    """)
+    cur.execute("INSERT OR IGNORE INTO queues(name) SELECT DISTINCT queue FROM jobs")
+    cur.execute("INSERT OR IGNORE INTO queues(name) VALUES (?)", (DEFAULT_QUEUE,))
+
+
+
+def _m011_concurrency_keys(cur):
+    _add_column(cur, "jobs", "concurrency_key", "TEXT")
+    # The claim indexes now hold unkeyed jobs only; keyed jobs are claimed
+    # per key through idx_jobs_key_claim, so a saturated key's backlog is
+    # never scanned (see claim_batch).
+    _run_script(cur, """
+    DROP INDEX IF EXISTS idx_jobs_claim;
+    CREATE INDEX idx_jobs_claim
+    ON jobs(priority DESC, created_at, next_run_at, id, state)
+    WHERE state='pending' AND concurrency_key IS NULL;
+
+    DROP INDEX IF EXISTS idx_jobs_queue_claim;
+    CREATE INDEX idx_jobs_queue_claim
+    ON jobs(queue, priority DESC, created_at, next_run_at, id)
+    WHERE state='pending' AND concurrency_key IS NULL;
+
+    CREATE INDEX IF NOT EXISTS idx_jobs_key_claim
+    ON jobs(concurrency_key, queue, priority DESC, created_at, next_run_at, id)
+    WHERE state='pending' AND concurrency_key IS NOT NULL;
+
+    -- one row per key ever enqueued: its limits, token bucket, and pending /
+    -- in-flight counts. Counts follow jobs through triggers (inserts are
+    -- counted by save_job()/save_jobs(), as for queue_stats).
+    CREATE TABLE IF NOT EXISTS concurrency_keys (
+        key TEXT PRIMARY KEY,
+        max_inflight INTEGER,
+        rate REAL,
+        burst REAL,
+        tokens REAL,
+        refilled_at REAL,
+        pending INTEGER NOT NULL DEFAULT 0,
+        inflight INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_concurrency_keys_pending ON concurrency_keys(key) WHERE pending > 0;
+
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_key_update AFTER UPDATE OF state ON jobs
+    WHEN NEW.concurrency_key IS NOT NULL AND OLD.state IS NOT NEW.state BEGIN
+        UPDATE concurrency_keys
+        SET pending = pending + (NEW.state='pending') - (OLD.state='pending'),
+            inflight = inflight + (NEW.state='processing') - (OLD.state='processing')
+        WHERE key=NEW.concurrency_key;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_key_delete AFTER DELETE ON jobs
+    WHEN OLD.concurrency_key IS NOT NULL BEGIN
+        UPDATE concurrency_keys
+        SET pending = pending - (OLD.state='pending'), inflight = inflight - (OLD.state='processing')
+        WHERE key=OLD.concurrency_key;
+    END;
+    """)
+
+
+def _m012_job_deps(cur):
+    # pending_deps counts a job's unfinished parents. Jobs waiting on any are
+    # 'blocked', which keeps them out of the (pending-only) claim indexes;
+    # each parent's completion decrements its children and releases the
+    # ones that reach zero, so nothing rescans blocked jobs (see
+    # _release_children).
+    _add_column(cur, "jobs", "pending_deps", "INTEGER NOT NULL DEFAULT 0")
+    _run_script(cur, """
+    CREATE TABLE IF NOT EXISTS job_deps (
+        parent_id TEXT NOT NULL,
+        child_id TEXT NOT NULL,
+        PRIMARY KEY (parent_id, child_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_job_deps_child ON job_deps(child_id);
+    """)
+
+
+def _m013_schedules(cur):
+    # recurring job definitions, fired by scheduler.py. `job` is the JSON
+    # template of every instance; next_fire_at (epoch seconds) is the first
+    # fire not yet enqueued and only ever moves in the same transaction that
+    # inserts the instances. updated_at changes on edits only, so the
+    # scheduler can tell cheaply when to reload.
     cur.execute("""
+    CREATE TABLE IF NOT EXISTS schedules (
+        name TEXT PRIMARY KEY,
+        spec TEXT NOT NULL,
+        job TEXT NOT NULL,
+        misfire TEXT NOT NULL DEFAULT 'once',
+        next_fire_at INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """)
+
+
+def _m014_dedup_keys(cur):
+    # at most one unfinished job per dedup key, enforced by the index itself;
+    # finished jobs keep their key (for dedup windows) without holding it.
+    # Jobs without a key stay out of both indexes.
+    _add_column(cur, "jobs", "dedup_key", "TEXT")
+    _run_script(cur, """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedup_live ON jobs(dedup_key)
+    WHERE dedup_key IS NOT NULL AND state IN ('pending', 'blocked', 'processing');
+    CREATE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs(dedup_key, enqueued_at)
+    WHERE dedup_key IS NOT NULL;
+    """)
+
+
+# when a limited key may take its next claim: NULL while it has no pending
+# jobs, is at max_inflight, or is not limited at all (its jobs are claimed
+# with unkeyed ones); otherwise 0, or the moment its bucket gets a token
+_KEY_READY_AT = """
+    CASE
+        WHEN NEW.max_inflight IS NULL AND NEW.rate IS NULL THEN NULL
+        WHEN NEW.pending <= 0 THEN NULL
+        WHEN NEW.max_inflight IS NOT NULL AND NEW.inflight >= NEW.max_inflight THEN NULL
+        WHEN NEW.rate IS NULL OR NEW.tokens IS NULL OR NEW.tokens >= 1 THEN 0
+        WHEN NEW.rate <= 0 THEN NULL
+        ELSE COALESCE(NEW.refilled_at, 0) + (1 - NEW.tokens) / NEW.rate
+    END"""
+
+
+def _m015_key_ready(cur):
+    # Only jobs whose key has limits (key_limited=1) are claimed per key;
+    # jobs with an unlimited key go back on the plain claim indexes. Each
+    # limited key keeps ready_at (see _KEY_READY_AT) up to date through a
+    # trigger, so a claim reads only the keys that can take one now, never
+    # the saturated or idle ones.
+    _add_column(cur, "jobs", "key_limited", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(cur, "concurrency_keys", "ready_at", "REAL")
+    cur.execute("UPDATE jobs SET key_limited=1 WHERE concurrency_key IN "
+                "(SELECT key FROM concurrency_keys WHERE max_inflight IS NOT NULL OR rate IS NOT NULL)")
+    _run_script(cur, f"""
+    DROP INDEX IF EXISTS idx_jobs_claim;
+    CREATE INDEX idx_jobs_claim
+    ON jobs(priority DESC, created_at, next_run_at, id, state)
+    WHERE state='pending' AND key_limited=0;
+
+    DROP INDEX IF EXISTS idx_jobs_queue_claim;
+    CREATE INDEX idx_jobs_queue_claim
+    ON jobs(queue, priority DESC, created_at, next_run_at, id)
+    WHERE state='pending' AND key_limited=0;
+
+    DROP INDEX IF EXISTS idx_jobs_key_claim;
+    CREATE INDEX idx_jobs_key_claim
+    ON jobs(concurrency_key, queue, priority DESC, created_at, next_run_at, id)
+    WHERE state='pending' AND key_limited=1;
+
+    DROP INDEX IF EXISTS idx_concurrency_keys_pending;
+    CREATE INDEX IF NOT EXISTS idx_concurrency_keys_ready ON concurrency_keys(ready_at)
+    WHERE ready_at IS NOT NULL;
+
+    CREATE TRIGGER IF NOT EXISTS trg_concurrency_keys_ready
+    AFTER UPDATE OF pending, inflight, tokens, refilled_at, max_inflight, rate ON concurrency_keys BEGIN
+        UPDATE concurrency_keys SET ready_at={_KEY_READY_AT} WHERE key=NEW.key;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_concurrency_keys_ready_insert AFTER INSERT ON concurrency_keys BEGIN
+        UPDATE concurrency_keys SET ready_at={_KEY_READY_AT} WHERE key=NEW.key;
+    END;
+    """)
+    cur.execute(f"UPDATE concurrency_keys SET ready_at={_KEY_READY_AT.replace('NEW.', '')}")
+
+
+def _m016_queue_pending(cur):
+    # queues.pending counts each queue's pending jobs (due or not), so
+    # FairShare can walk only the backlogged queues through
+    # idx_queues_backlogged, however many queues were ever created. The
+    # triggers upsert, so a row removed by prune_queues() comes back with
+    # its next pending job; inserts are counted by _register_queues().
+    _add_column(cur, "queues", "pending", "INTEGER NOT NULL DEFAULT 0")
+    _recount_queues(cur)
+    _run_script(cur, """
+    CREATE INDEX IF NOT EXISTS idx_queues_backlogged ON queues(name, weight) WHERE pending > 0;
+
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_queue_update AFTER UPDATE OF state ON jobs
+    WHEN OLD.state IS NOT NEW.state AND 'pending' IN (OLD.state, NEW.state) BEGIN
+        INSERT INTO queues(name, pending) VALUES (NEW.queue, (NEW.state='pending') - (OLD.state='pending'))
+        ON CONFLICT(name) DO UPDATE SET pending=pending+excluded.pending;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_jobs_queue_delete AFTER DELETE ON jobs
+    WHEN OLD.state='pending' BEGIN
+        UPDATE queues SET pending=pending-1 WHERE name=OLD.queue;
+    END;
+    """)
+
+
+def _m017_backlog_epoch(cur):
+    # one counter, bumped whenever a queue goes from no pending jobs to some,
+    # so FairShare can tell with one lookup whether its list of backlogged
+    # queues is stale (see backlog_epoch()).
+    _run_script(cur, """
+    CREATE TABLE IF NOT EXISTS queue_backlog (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        epoch INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO queue_backlog(id, epoch) VALUES (0, 0);
+
+    CREATE TRIGGER IF NOT EXISTS trg_queues_backlogged AFTER UPDATE OF pending ON queues
+    WHEN OLD.pending <= 0 AND NEW.pending > 0 BEGIN
+        UPDATE queue_backlog SET epoch = epoch + 1 WHERE id = 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_queues_backlogged_insert AFTER INSERT ON queues
+    WHEN NEW.pending > 0 BEGIN
+        UPDATE queue_backlog SET epoch = epoch + 1 WHERE id = 0;
+    END;
+    """)
+
+
+def _m018_due_probes(cur):
+    # "is anything due?" probes (has_due) range over next_run_at instead of
+    # walking the claim indexes in priority order, where pending jobs not yet
+    # due would be skipped one by one. idx_jobs_pending_due leads with
+    # key_limited so the unlimited probe is one range; next_due_at and
+    # count_due read both halves.
+    _run_script(cur, """
+    DROP INDEX IF EXISTS idx_jobs_pending_due;
+    CREATE INDEX idx_jobs_pending_due
+    ON jobs(key_limited, next_run_at)
+    WHERE state='pending';
+
+    CREATE INDEX IF NOT EXISTS idx_jobs_queue_due
+    ON jobs(queue, key_limited, next_run_at)
+    WHERE state='pending';
+
+    CREATE INDEX IF NOT EXISTS idx_jobs_key_due
+    ON jobs(concurrency_key, next_run_at)
+    WHERE state='pending' AND key_limited=1;
+    """)
+
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "base columns and job_events", _m001_base_columns),
+    (2, "claim/list/event indexes", _m002_indexes),
+    (3, "job leases", _m003_leases),
+    (4, "pending next_run_at index", _m004_due_index),
+    (5, "materialized queue counters", _m005_queue_stats),
+    (6, "enqueue timestamps and worker metrics", _m006_metrics),
+    (7, "finished-job index and maintenance locks", _m007_retention),
+    (8, "claim/finish timestamps", _m008_job_timing),
+    (9, "python callable jobs", _m009_job_kind),
+    (10, "named queues", _m010_queues),
+    (11, "concurrency keys and limits", _m011_concurrency_keys),
+    (12, "job dependencies", _m012_job_deps),
+    (13, "recurring job schedules", _m013_schedules),
+    (14, "job deduplication keys", _m014_dedup_keys),
+    (15, "claim-ready concurrency keys", _m015_key_ready),
+    (16, "queue pending counts", _m016_queue_pending),
+    (17, "queue backlog epoch", _m017_backlog_epoch),
+    (18, "due probe indexes", _m018_due_probes),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn=None) -> int:
+    conn = conn or get_conn()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_db(conn=None) -> List[int]:
+    """
+    Apply pending schema migrations in order. Returns the versions applied.
+    Safe to call repeatedly and from several processes at once.
+    """
+    conn = conn or get_conn()
+    applied = []
+    cur = conn.cursor()
+    for version, _desc, fn in MIGRATIONS:
+        if get_schema_version(conn) >= version:
+            continue
+        _begin_immediate(cur)
+        try:
+            # re-check under the write lock; another process may have won
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            fn(cur)
+            cur.execute(f"PRAGMA user_version={int(version)}")
+            conn.commit()
+            applied.append(version)
+        except Exception:
+            conn.rollback()
+            raise
+    if applied:
+        cur.execute("ANALYZE")
+    return applied
+
+
+JOB_INSERT_SQL = """
     INSERT INTO jobs(
       id, command, state, attempts, max_retries, priority, timeout,
-      created_at, updated_at, next_run_at, last_error, last_stdout, last_stderr
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+      created_at, updated_at, next_run_at, last_error, last_stdout, last_stderr, enqueued_at,
+      kind, args, queue, concurrency_key, pending_deps, dedup_key, key_limited
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+
+def _job_row(job: Dict, now: str, now_ts: float, limited: frozenset = frozenset()) -> Tuple:
+    """The JOB_INSERT_SQL row for job; `limited` holds the keys that have limits (_limited_keys)."""
+    return (
         job["id"],
         job["command"],
         job.get("state", "pending"),
@@ -81,9 +683,476 @@ def save_job(job: Dict):
         job.get("last_error", None),
         job.get("last_stdout", None),
         job.get("last_stderr", None),
-    ))
-    conn.commit()
-    conn.close()
+        job.get("enqueued_at", now_ts),
+        job.get("kind") or "shell",
+        _encode_args(job.get("args")),
+        job.get("queue") or DEFAULT_QUEUE,
+        job.get("concurrency_key") or None,
+        job.get("pending_deps", 0),
+        job.get("dedup_key") or None,
+        1 if job.get("concurrency_key") in limited else 0,
+    )
+
+
+def _limited_keys(cur, jobs: List[Dict]) -> frozenset:
+    """The concurrency keys of jobs that have limits set (see set_key_limit)."""
+    keys = list({job["concurrency_key"] for job in jobs if job.get("concurrency_key")})
+    limited = set()
+    for i in range(0, len(keys), _ID_LOOKUP_CHUNK):
+        part = keys[i:i + _ID_LOOKUP_CHUNK]
+        cur.execute(f"SELECT key FROM concurrency_keys WHERE key IN ({','.join('?' * len(part))}) "
+                    "AND (max_inflight IS NOT NULL OR rate IS NOT NULL)", part)
+        limited.update(r["key"] for r in cur.fetchall())
+    return frozenset(limited)
+
+
+def _encode_args(args) -> Optional[str]:
+    # stored as JSON text; already-encoded strings pass through
+    if args is None or isinstance(args, str):
+        return args
+    return json.dumps(args)
+
+
+def _count_inserted(cur, rows: List[Tuple]):
+    """Add freshly inserted job rows to queue_stats / queue_throughput."""
+    if not rows:
+        return
+    per_state: Dict[str, List[int]] = {}
+    for row in rows:
+        acc = per_state.setdefault(row[2], [0, 0])
+        acc[0] += 1
+        acc[1] += row[3]
+    cur.executemany(
+        "INSERT INTO queue_stats(state, jobs, attempts) VALUES (?, ?, ?) "
+        "ON CONFLICT(state) DO UPDATE SET jobs=jobs+excluded.jobs, attempts=attempts+excluded.attempts",
+        [(state, n, attempts) for state, (n, attempts) in per_state.items()],
+    )
+    cur.execute(
+        "INSERT INTO queue_throughput(minute, kind, count) VALUES (?, 'enqueued', ?) "
+        "ON CONFLICT(minute, kind) DO UPDATE SET count=count+excluded.count",
+        (int(time.time()) // 60, len(rows)),
+    )
+
+
+def save_job(job: Dict) -> str:
+    """
+    Insert one job. Returns its id, or, if its dedup_key is held by another
+    job (see _dedup), that job's id and nothing is inserted. Raises
+    ValueError if the id already exists.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    now_ts = time.time()
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now_ts))
+    _begin_immediate(cur)
+    try:
+        if job.get("dedup_key"):
+            _, deduped = _dedup(cur, [job], now_ts, now)
+            if deduped:
+                conn.commit()
+                return deduped[job["id"]]
+        (job,), edges = _link_deps(cur, [job])
+        row = _job_row(job, now, now_ts, _limited_keys(cur, [job]))
+        try:
+            cur.execute(JOB_INSERT_SQL, row)
+        except sqlite3.IntegrityError:
+            if cur.execute("SELECT 1 FROM jobs WHERE id=?", (job["id"],)).fetchone():
+                raise ValueError(f"job id '{job['id']}' already exists") from None
+            raise
+        _store_deps(cur, edges)
+        _count_inserted(cur, [row])
+        _register_queues(cur, [row])
+        _count_keyed(cur, [row])
+        conn.commit()
+        return job["id"]
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _register_queues(cur, rows: List[Tuple]):
+    """List the queues of freshly inserted job rows in `queues` and count their pending ones."""
+    per_queue: Dict[str, int] = {}
+    for row in rows:
+        per_queue[row[16]] = per_queue.get(row[16], 0) + (row[2] == "pending")
+    cur.executemany(
+        "INSERT INTO queues(name, pending) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET pending=pending+excluded.pending",
+        list(per_queue.items()),
+    )
+
+
+def _count_keyed(cur, rows: List[Tuple]):
+    """Add freshly inserted keyed job rows to concurrency_keys."""
+    per_key: Dict[str, List[int]] = {}
+    for row in rows:
+        if row[17] is None:
+            continue
+        acc = per_key.setdefault(row[17], [0, 0])
+        acc[0] += row[2] == "pending"
+        acc[1] += row[2] == "processing"
+    if per_key:
+        cur.executemany(
+            "INSERT INTO concurrency_keys(key, pending, inflight) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET pending=pending+excluded.pending, inflight=inflight+excluded.inflight",
+            [(key, p, f) for key, (p, f) in per_key.items()],
+        )
+
+
+# SQLite's default limit on host parameters is 999 on older builds
+_ID_LOOKUP_CHUNK = 500
+
+
+def redirect_deduped(jobs: List[Dict], deduped: Dict[str, str]) -> List[Dict]:
+    """The jobs, with each depends_on id of a deduplicated job ({id: holder's id}) pointed at its holder."""
+    if not deduped:
+        return jobs
+    out = []
+    for job in jobs:
+        parents = job.get("depends_on")
+        if parents and any(p in deduped for p in parents):
+            job = dict(job, depends_on=[deduped.get(p, p) for p in parents])
+        out.append(job)
+    return out
+
+
+def _link_deps(cur, jobs: List[Dict]) -> Tuple[List[Dict], List[Tuple[str, str]]]:
+    """
+    Resolve the `depends_on` ids of jobs about to be inserted. Parents may be
+    existing jobs or other jobs of the same batch (in any order). Returns the
+    jobs, with those waiting on unfinished parents made 'blocked' (counting
+    them in pending_deps) and those with a dead parent made 'dead', plus the
+    (parent_id, child_id) edges to store. Raises ValueError on unknown
+    parents or a cycle.
+    """
+    if not any(job.get("depends_on") for job in jobs):
+        return jobs, []
+    batch = {job["id"]: job for job in jobs}
+    parents_of = {job_id: list(dict.fromkeys(job.get("depends_on") or ())) for job_id, job in batch.items()}
+    outside = list({p for deps in parents_of.values() for p in deps if p not in batch})
+    state_of: Dict[str, str] = {}
+    for i in range(0, len(outside), _ID_LOOKUP_CHUNK):
+        part = outside[i:i + _ID_LOOKUP_CHUNK]
+        cur.execute(f"SELECT id, state FROM jobs WHERE id IN ({','.join('?' * len(part))})", part)
+        state_of.update((r["id"], r["state"]) for r in cur.fetchall())
+    missing = sorted(p for p in outside if p not in state_of)
+    if missing:
+        raise ValueError(f"unknown dependencies (enqueue parents first): {', '.join(missing[:10])}")
+
+    # parents within the batch are resolved before their children (Kahn's order)
+    waiting = {job_id: sum(p in batch for p in deps) for job_id, deps in parents_of.items()}
+    children: Dict[str, List[str]] = {}
+    for job_id, deps in parents_of.items():
+        for p in deps:
+            if p in batch:
+                children.setdefault(p, []).append(job_id)
+    ready = [job_id for job_id, n in waiting.items() if n == 0]
+    resolved: Dict[str, Dict] = {}
+    edges: List[Tuple[str, str]] = []
+    while ready:
+        job_id = ready.pop()
+        job, deps = batch[job_id], parents_of[job_id]
+        if deps and job.get("state", "pending") == "pending":
+            dead = [p for p in deps if state_of[p] == "dead"]
+            unfinished = sum(state_of[p] != "completed" for p in deps)
+            if dead:
+                job = dict(job, state="dead", pending_deps=0, last_error=f"dependency {dead[0]} is dead")
+            elif unfinished:
+                job = dict(job, state="blocked", pending_deps=unfinished)
+        edges += [(p, job_id) for p in deps]
+        resolved[job_id] = job
+        state_of[job_id] = job.get("state", "pending")
+        for child in children.get(job_id, ()):
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                ready.append(child)
+    if len(resolved) < len(batch):
+        cycle = sorted(job_id for job_id in batch if job_id not in resolved)
+        raise ValueError(f"dependency cycle among: {', '.join(cycle[:10])}")
+    return [resolved[job["id"]] for job in jobs], edges
+
+
+DEDUP_POLICIES = ("ignore", "replace", "bump")
+
+
+def _dedup(cur, jobs: List[Dict], now_ts: float, now: str) -> Tuple[List[Dict], Dict[str, str]]:
+    """
+    Resolve the dedup_key of jobs about to be inserted. A key is held by
+    its unfinished job (idx_jobs_dedup_live allows one) and, for a new job
+    with dedup_window=N, also by a finished job enqueued in the last N
+    seconds, or by an earlier job of the same batch. A job whose key is
+    held is not inserted; its on_conflict policy decides what happens to
+    the holder:
+      ignore   nothing (the default)
+      replace  a still waiting holder takes the new job's command, args,
+               priority, timeout, max_retries and run time
+      bump     an unfinished holder's priority is raised to the new job's
+    Returns the jobs to insert and {id of each job left out: holder's id}.
+    One indexed lookup per _ID_LOOKUP_CHUNK keys, no per-job queries.
+    """
+    keys = list({job["dedup_key"] for job in jobs if job.get("dedup_key")})
+    if not keys:
+        return jobs, {}
+    # the newest holder per key: the unfinished one, else the last enqueued
+    holders: Dict[str, Dict] = {}
+    cutoff = now_ts - max(float(job.get("dedup_window") or 0) for job in jobs)
+    for i in range(0, len(keys), _ID_LOOKUP_CHUNK):
+        part = keys[i:i + _ID_LOOKUP_CHUNK]
+        cur.execute(
+            "SELECT id, dedup_key, state, priority, enqueued_at FROM jobs "
+            f"WHERE dedup_key IN ({','.join('?' * len(part))}) "
+            "AND (state IN ('pending', 'blocked', 'processing') OR enqueued_at>=?) ORDER BY enqueued_at",
+            part + [cutoff],
+        )
+        for r in cur.fetchall():
+            if holders.get(r["dedup_key"], {}).get("state") not in ("pending", "blocked", "processing"):
+                holders[r["dedup_key"]] = dict(r)
+    fresh: List[Dict] = []
+    index: Dict[str, int] = {}
+    deduped: Dict[str, str] = {}
+    bumps, replaces = [], []
+    # save_jobs(replace=True) may overwrite a holder with another key (or
+    # none): from then on it no longer holds its old one
+    key_of = {holder["id"]: key for key, holder in holders.items()}
+    for job in jobs:
+        key = job.get("dedup_key")
+        holder = holders.get(key) if key else None
+        if holder is not None and holder["id"] == job["id"]:
+            # save_jobs(replace=True) overwriting the holder itself
+            holder = None
+        if holder is not None and holder["state"] in ("completed", "dead"):
+            if (holder["enqueued_at"] or 0) < now_ts - float(job.get("dedup_window") or 0):
+                holder = None
+        if holder is None:
+            old_key = key_of.pop(job["id"], None)
+            if old_key is not None and old_key != key and holders[old_key]["id"] == job["id"]:
+                del holders[old_key]
+            if key:
+                holders[key] = {"id": job["id"], "state": job.get("state", "pending"),
+                                "priority": job.get("priority", 0), "enqueued_at": now_ts}
+                key_of[job["id"]] = key
+                index[job["id"]] = len(fresh)
+            fresh.append(job)
+            continue
+        deduped[job["id"]] = holder["id"]
+        policy = job.get("on_conflict") or "ignore"
+        priority = job.get("priority", 0)
+        if policy == "bump" and holder["state"] in ("pending", "blocked", "processing") \
+                and priority > holder["priority"]:
+            holder["priority"] = priority
+            if holder["id"] in index:
+                fresh[index[holder["id"]]] = dict(fresh[index[holder["id"]]], priority=priority)
+            else:
+                bumps.append((holder["id"], job["id"], priority))
+        elif policy == "replace" and holder["state"] in ("pending", "blocked"):
+            holder["priority"] = priority
+            if holder["id"] in index:
+                fresh[index[holder["id"]]] = dict(job, id=holder["id"])
+            else:
+                replaces.append((holder["id"], job))
+    conn = cur.connection
+    cur.executemany("UPDATE jobs SET priority=?, updated_at=? WHERE id=?",
+                    [(priority, now, holder_id) for holder_id, _job_id, priority in bumps])
+    for holder_id, job_id, priority in bumps:
+        _record_event(conn, holder_id, "dedup:bump", f"priority {priority} from {job_id}")
+    cur.executemany(
+        "UPDATE jobs SET command=?, kind=?, args=?, priority=?, timeout=?, max_retries=?, next_run_at=?, "
+        "updated_at=? WHERE id=?",
+        [(job["command"], job.get("kind") or "shell", _encode_args(job.get("args")), job.get("priority", 0),
+          job.get("timeout"), job.get("max_retries", 3), job.get("next_run_at", 0), now, holder_id)
+         for holder_id, job in replaces],
+    )
+    for holder_id, job in replaces:
+        _record_event(conn, holder_id, "dedup:replace", f"replaced by {job['id']}")
+    return fresh, deduped
+
+
+def dependency_errors(jobs: List[Dict], deduped: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Which jobs of a batch _link_deps() would reject, so a caller can drop
+    just those: {job id: reason} for unknown parents, cycles, and jobs
+    depending (transitively) on a rejected job of the batch. Parents that
+    were deduplicated earlier ({id: holder's id}) count as their holder.
+    Read-only.
+    """
+    jobs = redirect_deduped(jobs, deduped or {})
+    deps = {job["id"]: list(dict.fromkeys(job.get("depends_on") or ())) for job in jobs}
+    outside = list({p for parents in deps.values() for p in parents if p not in deps})
+    known = set()
+    conn = get_conn()
+    for i in range(0, len(outside), _ID_LOOKUP_CHUNK):
+        part = outside[i:i + _ID_LOOKUP_CHUNK]
+        rows = conn.execute(f"SELECT id FROM jobs WHERE id IN ({','.join('?' * len(part))})", part).fetchall()
+        known.update(r["id"] for r in rows)
+    errors: Dict[str, str] = {}
+    for job_id, parents in deps.items():
+        missing = [p for p in parents if p not in deps and p not in known]
+        if missing:
+            errors[job_id] = f"unknown dependencies (enqueue parents first): {', '.join(missing[:10])}"
+    # parents before children (Kahn's order); whatever is left is on or behind a cycle
+    waiting = {job_id: sum(p in deps for p in parents) for job_id, parents in deps.items()}
+    children: Dict[str, List[str]] = {}
+    for job_id, parents in deps.items():
+        for p in parents:
+            if p in deps:
+                children.setdefault(p, []).append(job_id)
+    ready = [job_id for job_id, n in waiting.items() if n == 0]
+    resolved = set()
+    while ready:
+        job_id = ready.pop()
+        resolved.add(job_id)
+        rejected = next((p for p in deps[job_id] if p in errors), None)
+        if rejected is not None and job_id not in errors:
+            errors[job_id] = f"dependency '{rejected}' was rejected"
+        for child in children.get(job_id, ()):
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                ready.append(child)
+    for job_id in deps:
+        if job_id not in resolved:
+            errors.setdefault(job_id, "dependency cycle")
+    return errors
+
+
+def _store_deps(cur, edges: List[Tuple[str, str]]):
+    if edges:
+        cur.executemany("INSERT OR IGNORE INTO job_deps(parent_id, child_id) VALUES (?, ?)", edges)
+
+
+def _release_children(conn, parent_id: str, now_ts: int) -> List[str]:
+    """
+    `parent_id` just completed: take one off each blocked child's
+    pending_deps and make the children that reach zero 'pending'.
+    Returns the ids released. Touches only this parent's children.
+    """
+    rows = conn.execute(
+        "SELECT j.id, j.pending_deps FROM job_deps d JOIN jobs j ON j.id=d.child_id "
+        "WHERE d.parent_id=? AND j.state='blocked'",
+        (parent_id,),
+    ).fetchall()
+    if not rows:
+        return []
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now_ts))
+    released = [r["id"] for r in rows if r["pending_deps"] <= 1]
+    still = [r["id"] for r in rows if r["pending_deps"] > 1]
+    conn.executemany("UPDATE jobs SET pending_deps=pending_deps-1, updated_at=? WHERE id=?",
+                     [(now, job_id) for job_id in still])
+    # due from now on (or its own run_at, if later), so queue wait excludes the time blocked
+    conn.executemany(
+        "UPDATE jobs SET state='pending', pending_deps=0, next_run_at=MAX(COALESCE(next_run_at, 0), ?), "
+        "updated_at=? WHERE id=?",
+        [(now_ts, now, job_id) for job_id in released],
+    )
+    for job_id in still:
+        _record_event(conn, job_id, "dependency_done", parent_id)
+    for job_id in released:
+        _record_event(conn, job_id, "state:pending", f"dependencies done (last: {parent_id})")
+    return released
+
+
+def _bury_descendants(conn, parent_id: str) -> List[str]:
+    """`parent_id` went to 'dead': so do all jobs (transitively) blocked on it. Returns their ids."""
+    now_ts = time.time()
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now_ts))
+    buried: List[str] = []
+    frontier = [parent_id]
+    while frontier:
+        parent = frontier.pop()
+        rows = conn.execute(
+            "SELECT j.id FROM job_deps d JOIN jobs j ON j.id=d.child_id "
+            "WHERE d.parent_id=? AND j.state='blocked'",
+            (parent,),
+        ).fetchall()
+        for r in rows:
+            msg = f"dependency {parent} is dead"
+            conn.execute(
+                "UPDATE jobs SET state='dead', pending_deps=0, last_error=?, finished_at=?, updated_at=? WHERE id=?",
+                (msg, now_ts, now, r["id"]),
+            )
+            _record_event(conn, r["id"], "state:dead", msg)
+            buried.append(r["id"])
+            frontier.append(r["id"])
+    return buried
+
+
+def save_jobs(jobs: List[Dict], replace: bool = False, deduped: Optional[Dict[str, str]] = None) -> List[str]:
+    """
+    Insert many jobs in one transaction with executemany.
+    Ids that already exist (or repeat within `jobs`) are skipped and
+    returned, unless replace=True, in which case they overwrite the old row
+    (except rows being processed, which are skipped and returned).
+    Jobs whose dedup_key is held (see _dedup) are skipped and returned too;
+    pass a dict as `deduped` to get {their id: holder's id}.
+    """
+    if not jobs:
+        return []
+    conn = get_conn()
+    cur = conn.cursor()
+    _begin_immediate(cur)
+    try:
+        skipped, merged = _insert_jobs(cur, jobs, replace)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if deduped is not None:
+        deduped.update(merged)
+    return skipped + list(merged)
+
+
+def _insert_jobs(cur, jobs: List[Dict], replace: bool = False) -> Tuple[List[str], Dict[str, str]]:
+    """
+    save_jobs() inside the caller's write transaction. Returns the ids
+    skipped as duplicates and the deduplicated {id: holder's id}.
+    """
+    now_ts = time.time()
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now_ts))
+    skipped = []
+    if replace:
+        # a running job is left to its lease holder, which would otherwise
+        # finish a row (and attempts) reset under it
+        ids = [job["id"] for job in jobs]
+        running = set()
+        for i in range(0, len(ids), _ID_LOOKUP_CHUNK):
+            part = ids[i:i + _ID_LOOKUP_CHUNK]
+            cur.execute(f"SELECT id FROM jobs WHERE id IN ({','.join('?' * len(part))}) AND state='processing'",
+                        part)
+            running.update(r["id"] for r in cur.fetchall())
+        skipped = [job["id"] for job in jobs if job["id"] in running]
+        jobs = [job for job in jobs if job["id"] not in running]
+        jobs, deduped = _dedup(cur, jobs, now_ts, now)
+        # children of a deduplicated job wait on its holder instead
+        jobs, edges = _link_deps(cur, redirect_deduped(jobs, deduped))
+        limited = _limited_keys(cur, jobs)
+        rows = [_job_row(job, now, now_ts, limited) for job in jobs]
+        cur.executemany(JOB_INSERT_SQL.replace("INSERT INTO", "INSERT OR REPLACE INTO"), rows)
+        # the replaced rows were uncounted by the jobs delete trigger;
+        # their old parents are replaced too
+        cur.executemany("DELETE FROM job_deps WHERE child_id=?", [(row[0],) for row in rows])
+    else:
+        ids = [job["id"] for job in jobs]
+        existing = set()
+        for i in range(0, len(ids), _ID_LOOKUP_CHUNK):
+            part = ids[i:i + _ID_LOOKUP_CHUNK]
+            cur.execute(f"SELECT id FROM jobs WHERE id IN ({','.join('?' * len(part))})", part)
+            existing.update(r["id"] for r in cur.fetchall())
+        fresh = []
+        for job in jobs:
+            if job["id"] in existing:
+                skipped.append(job["id"])
+                continue
+            existing.add(job["id"])
+            fresh.append(job)
+        fresh, deduped = _dedup(cur, fresh, now_ts, now)
+        fresh, edges = _link_deps(cur, redirect_deduped(fresh, deduped))
+        limited = _limited_keys(cur, fresh)
+        rows = [_job_row(job, now, now_ts, limited) for job in fresh]
+        cur.executemany(JOB_INSERT_SQL, rows)
+    _store_deps(cur, edges)
+    _count_inserted(cur, rows)
+    _register_queues(cur, rows)
+    _count_keyed(cur, rows)
+    return skipped, deduped
 
 
 def list_jobs(state: Optional[str] = None) -> List[sqlite3.Row]:
@@ -94,36 +1163,138 @@ def list_jobs(state: Optional[str] = None) -> List[sqlite3.Row]:
     else:
         cur.execute("SELECT * FROM jobs ORDER BY priority DESC, created_at")
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
+JOB_COLUMNS = (
+    "id", "command", "state", "attempts", "max_retries", "priority", "timeout",
+    "created_at", "updated_at", "next_run_at", "last_error", "last_stdout", "last_stderr",
+    "enqueued_at", "claimed_at", "finished_at", "kind", "args", "queue", "concurrency_key",
+    "pending_deps", "dedup_key",
+)
+# what list views need: everything but the (up to output_cap_bytes) output columns
+LIST_COLUMNS = tuple(c for c in JOB_COLUMNS if c not in ("last_stdout", "last_stderr"))
+
+def find_jobs(state: Optional[str] = None, prefix: Optional[str] = None, limit: Optional[int] = None,
+              columns=JOB_COLUMNS) -> List[sqlite3.Row]:
+    """
+    Jobs in list order (priority, then age), optionally only one state and/or
+    ids starting with `prefix` (a range on the primary key), at most `limit`.
+    `columns` must come from JOB_COLUMNS.
+    """
+    where, params = [], []
+    if state:
+        where.append("state=?")
+        params.append(state)
+    if prefix:
+        where.append("id>=? AND id<?")
+        params += [prefix, prefix + "\U0010ffff"]
+    sql = f"SELECT {', '.join(columns)} FROM jobs"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY priority DESC, created_at"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return get_conn().execute(sql, params).fetchall()
+
+def count_jobs(state: Optional[str] = None) -> int:
+    """Number of jobs (in `state`, if given), read from queue_stats in O(1)."""
+    conn = get_conn()
+    if state:
+        row = conn.execute("SELECT jobs FROM queue_stats WHERE state=?", (state,)).fetchone()
+        return row["jobs"] if row else 0
+    return conn.execute("SELECT COALESCE(SUM(jobs), 0) AS total FROM queue_stats").fetchone()["total"]
+
+
 def get_jobs_paginated(page: int = 1, per_page: int = 20, state: Optional[str] = None) -> Tuple[List[sqlite3.Row], int]:
     """
     Return (rows, total_count) for given page/per_page. page is 1-based.
+    OFFSET gets slower the deeper the page; prefer get_jobs_page().
     """
     offset = (max(1, page) - 1) * per_page
     conn = get_conn()
     cur = conn.cursor()
+    total = count_jobs(state)
     if state:
-        cur.execute("SELECT COUNT(*) as cnt FROM jobs WHERE state=?", (state,))
-        total = cur.fetchone()["cnt"]
-        cur.execute("SELECT * FROM jobs WHERE state=? ORDER BY priority DESC, created_at LIMIT ? OFFSET ?", (state, per_page, offset))
+        cur.execute("SELECT * FROM jobs WHERE state=? ORDER BY priority DESC, created_at, id LIMIT ? OFFSET ?", (state, per_page, offset))
     else:
-        cur.execute("SELECT COUNT(*) as cnt FROM jobs")
-        total = cur.fetchone()["cnt"]
-        cur.execute("SELECT * FROM jobs ORDER BY priority DESC, created_at LIMIT ? OFFSET ?", (per_page, offset))
+        cur.execute("SELECT * FROM jobs ORDER BY priority DESC, created_at, id LIMIT ? OFFSET ?", (per_page, offset))
     rows = cur.fetchall()
-    conn.close()
     return rows, total
 
 
+def encode_cursor(row) -> str:
+    """Opaque continuation token for the list position just after `row`."""
+    raw = json.dumps([row["priority"], row["created_at"], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[int, str, str]:
+    """Inverse of encode_cursor(). Raises ValueError on a malformed token."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        priority, created_at, job_id = json.loads(raw)
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(priority, int) or not isinstance(created_at, str) or not isinstance(job_id, str):
+        raise ValueError("invalid cursor")
+    return priority, created_at, job_id
+
+
+def get_jobs_page(state: Optional[str] = None, limit: int = 20, cursor: Optional[str] = None,
+                  columns=LIST_COLUMNS) -> Tuple[List[sqlite3.Row], Optional[str]]:
+    """
+    Keyset pagination in list order (priority DESC, created_at, id).
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    Every page is an index seek, however deep: idx_jobs_state with a state
+    filter, idx_jobs_order without.
+    """
+    unknown = [c for c in columns if c not in JOB_COLUMNS]
+    if unknown:
+        raise ValueError(f"unknown column(s): {', '.join(unknown)}")
+    # the cursor needs the sort key, whatever the caller asked for
+    select = ", ".join(dict.fromkeys(("id", "priority", "created_at") + tuple(columns)))
+    where, params = ("state=? AND ", [state]) if state else ("", [])
+    index = "idx_jobs_state" if state else "idx_jobs_order"
+    conn = get_conn()
+    cur = conn.cursor()
+    # fetch one extra row to know whether there is a next page
+    want = limit + 1
+    rows: List[sqlite3.Row] = []
+    if cursor:
+        priority, created_at, job_id = decode_cursor(cursor)
+        # mixed sort directions rule out a single row-value comparison, so
+        # finish the cursor's priority first, then move on to lower ones
+        cur.execute(
+            f"SELECT {select} FROM jobs INDEXED BY {index} WHERE {where}priority=? AND (created_at, id)>(?, ?) "
+            "ORDER BY created_at, id LIMIT ?",
+            params + [priority, created_at, job_id, want],
+        )
+        rows = cur.fetchall()
+        if len(rows) < want:
+            cur.execute(
+                f"SELECT {select} FROM jobs INDEXED BY {index} WHERE {where}priority<? "
+                "ORDER BY priority DESC, created_at, id LIMIT ?",
+                params + [priority, want - len(rows)],
+            )
+            rows += cur.fetchall()
+    else:
+        cur.execute(
+            f"SELECT {select} FROM jobs INDEXED BY {index} WHERE {where}1 "
+            "ORDER BY priority DESC, created_at, id LIMIT ?",
+            params + [want],
+        )
+        rows = cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
 def get_job(job_id: str) -> Optional[sqlite3.Row]:
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT * FROM jobs WHERE id=?", (job_id,))
     r = cur.fetchone()
-    conn.close()
     return r
 
 
@@ -132,7 +1303,6 @@ def get_config(key: str) -> Optional[str]:
     cur = conn.cursor()
     cur.execute("SELECT value FROM config WHERE key=?", (key,))
     row = cur.fetchone()
-    conn.close()
     return row["value"] if row else None
 
 
@@ -141,45 +1311,306 @@ def set_config(key: str, value: str):
     cur = conn.cursor()
     cur.execute("INSERT OR REPLACE INTO config(key, value) VALUES (?, ?)", (key, value))
     conn.commit()
-    conn.close()
 
 
-def claim_one_pending(now_ts: int) -> Optional[str]:
+def _key_capacity(row, now: float) -> Tuple[Optional[int], Optional[float]]:
+    """
+    How many more jobs of a concurrency key may be claimed right now (None:
+    unlimited), and its refilled token count if it is rate limited.
+    """
+    cap = None
+    if row["max_inflight"] is not None:
+        cap = max(0, row["max_inflight"] - row["inflight"])
+    tokens = None
+    if row["rate"] is not None:
+        burst = row["burst"] if row["burst"] is not None else max(1.0, row["rate"])
+        held = row["tokens"] if row["tokens"] is not None else burst
+        tokens = min(burst, held + max(0.0, now - (row["refilled_at"] or now)) * row["rate"])
+        cap = int(tokens) if cap is None else min(cap, int(tokens))
+    return cap, tokens
+
+
+def _ready_keys(cur, now: float) -> List[Tuple[str, Optional[int], Optional[float]]]:
+    """
+    (key, capacity, tokens) of limited keys with pending jobs that may take
+    another claim now: a range of idx_concurrency_keys_ready, which holds
+    neither saturated nor idle keys.
+    """
+    rows = cur.execute(
+        "SELECT key, max_inflight, inflight, rate, burst, tokens, refilled_at "
+        "FROM concurrency_keys INDEXED BY idx_concurrency_keys_ready WHERE ready_at<=?", (now,)
+    ).fetchall()
+    ready = []
+    for row in rows:
+        cap, tokens = _key_capacity(row, now)
+        if cap is None or cap > 0:
+            ready.append((row["key"], cap, tokens))
+    return ready
+
+
+def _unlimited_sql(queue: Optional[str]) -> str:
+    # the claim indexes are partial + covering; pin them, since the planner
+    # otherwise tends to pick idx_jobs_state and visit the table per row
+    index, where = ("idx_jobs_claim", "") if queue is None else ("idx_jobs_queue_claim", "queue=? AND ")
+    return (f"SELECT id, priority, created_at FROM jobs INDEXED BY {index} WHERE {where}state='pending' "
+            f"AND key_limited=0 AND next_run_at<=? ORDER BY priority DESC, created_at LIMIT ?")
+
+
+def _limited_sql(queue: Optional[str]) -> str:
+    where = "" if queue is None else "queue=? AND "
+    return (f"SELECT id, priority, created_at FROM jobs INDEXED BY idx_jobs_key_claim "
+            f"WHERE concurrency_key=? AND {where}state='pending' AND key_limited=1 AND next_run_at<=? "
+            f"ORDER BY priority DESC, created_at LIMIT ?")
+
+
+def has_due(now_ts: int, queue: Optional[str] = None) -> bool:
+    """
+    Whether any pending job (in `queue`, if given) is due and claimable
+    under its key's limits: one seek on a next_run_at range, plus one per
+    limited key ready for a claim, however many pending jobs are not due
+    yet. Takes no write lock.
+    """
+    cur = get_conn().cursor()
+    if queue is None:
+        unlimited = cur.execute("SELECT 1 FROM jobs INDEXED BY idx_jobs_pending_due "
+                                "WHERE key_limited=0 AND state='pending' AND next_run_at<=? LIMIT 1", (now_ts,))
+    else:
+        unlimited = cur.execute("SELECT 1 FROM jobs INDEXED BY idx_jobs_queue_due "
+                                "WHERE queue=? AND key_limited=0 AND state='pending' AND next_run_at<=? LIMIT 1",
+                                (queue, now_ts))
+    if unlimited.fetchone():
+        return True
+    where, qp = ("", ()) if queue is None else (" AND queue=?", (queue,))
+    for key, _cap, _tokens in _ready_keys(cur, time.time()):
+        if cur.execute(f"SELECT 1 FROM jobs INDEXED BY idx_jobs_key_due WHERE concurrency_key=? "
+                       f"AND state='pending' AND key_limited=1 AND next_run_at<=?{where} LIMIT 1",
+                       (key, now_ts) + qp).fetchone():
+            return True
+    return False
+
+
+def claim_batch(now_ts: int, n: int = 1, owner: Optional[str] = None,
+                lease_seconds: int = DEFAULT_LEASE_SECONDS, queue: Optional[str] = None) -> List[str]:
+    """
+    Atomically move up to n due pending jobs (from `queue`, or from any
+    queue) to 'processing' under a single write lock and return their ids in
+    claim order (priority, then age). Each claim is leased to `owner` until
+    now_ts + lease_seconds; see extend_leases() and reap_expired_leases().
+
+    Jobs with a concurrency_key respect that key's max_inflight and token
+    bucket, checked in the same transaction. Jobs without a limited key
+    come from one index range; those of limited keys from one seek per key
+    ready for a claim (idx_concurrency_keys_ready), so saturated, idle and
+    unlimited keys cost nothing however many there are.
+    """
+    if n < 1:
+        return []
     conn = get_conn()
     cur = conn.cursor()
     try:
-        cur.execute("BEGIN IMMEDIATE;")
-        cur.execute(
-            "SELECT id FROM jobs WHERE state='pending' AND next_run_at<=? ORDER BY priority DESC, created_at LIMIT 1",
-            (now_ts,),
-        )
-        row = cur.fetchone()
-        if not row:
+        # cheap read-only probe first, so polling an empty queue never takes
+        # the write lock
+        if not has_due(now_ts, queue):
+            return []
+        _begin_immediate(cur)
+        qp = () if queue is None else (queue,)
+        now_f = time.time()
+        candidates = [(r["priority"], r["created_at"], r["id"], None) for r in
+                      cur.execute(_unlimited_sql(queue), qp + (now_ts, n))]
+        buckets = {}
+        for key, cap, tokens in _ready_keys(cur, now_f):
+            limit = n if cap is None else min(cap, n)
+            candidates += [(r["priority"], r["created_at"], r["id"], key) for r in
+                           cur.execute(_limited_sql(queue),
+                                       (key,) + qp + (now_ts, limit))]
+            if tokens is not None:
+                buckets[key] = tokens
+        # each source is already capped at what its key allows
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+        chosen = candidates[:n]
+        job_ids = [c[2] for c in chosen]
+        taken: Dict[str, int] = {}
+        for c in chosen:
+            if c[3] in buckets:
+                taken[c[3]] = taken.get(c[3], 0) + 1
+        if taken:
+            cur.executemany(
+                "UPDATE concurrency_keys SET tokens=?, refilled_at=? WHERE key=?",
+                [(buckets[key] - k, now_f, key) for key, k in taken.items()],
+            )
+        if not job_ids:
             conn.rollback()
-            return None
-        job_id = row["id"]
+            return []
         now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-        cur.execute(
-            "UPDATE jobs SET state='processing', updated_at=? WHERE id=? AND state='pending'",
-            (now, job_id),
+        expires = now_ts + lease_seconds
+        # we hold the write lock, so every selected row is still pending
+        claimed_at = time.time()
+        cur.executemany(
+            "UPDATE jobs SET state='processing', lease_owner=?, lease_expires_at=?, claimed_at=?, updated_at=? "
+            "WHERE id=? AND state='pending'",
+            [(owner, expires, claimed_at, now, job_id) for job_id in job_ids],
         )
-        if cur.rowcount == 1:
-            # record event
-            cur.execute("INSERT INTO job_events(job_id, event_type, message, created_at) VALUES (?, ?, ?, ?)",
-                        (job_id, "claimed", None, now))
-            conn.commit()
-            return job_id
-        else:
+        cur.executemany(
+            "INSERT INTO job_events(job_id, event_type, message, created_at) VALUES (?, ?, ?, ?)",
+            [(job_id, "claimed", owner, now) for job_id in job_ids],
+        )
+        conn.commit()
+        return job_ids
+    except Exception:
+        try:
             conn.rollback()
-            return None
+        except Exception:
+            pass
+        return []
+
+
+def claim_one_pending(now_ts: int, owner: Optional[str] = None,
+                      lease_seconds: int = DEFAULT_LEASE_SECONDS) -> Optional[str]:
+    job_ids = claim_batch(now_ts, 1, owner=owner, lease_seconds=lease_seconds)
+    return job_ids[0] if job_ids else None
+
+
+def next_due_at(now_ts: int) -> Optional[int]:
+    """
+    Earliest future moment a worker has something to do: the next scheduled
+    or backed-off pending job, the next lease expiry to reap, or the next
+    token of a rate-limited key with work waiting. None if the queue is
+    idle. Each lookup is a single index seek.
+    """
+    cur = get_conn().cursor()
+    due = cur.execute(
+        "SELECT MIN(t) AS t FROM (SELECT MIN(next_run_at) AS t FROM jobs INDEXED BY idx_jobs_pending_due "
+        "WHERE key_limited=0 AND state='pending' AND next_run_at > ? UNION ALL "
+        "SELECT MIN(next_run_at) FROM jobs INDEXED BY idx_jobs_pending_due "
+        "WHERE key_limited=1 AND state='pending' AND next_run_at > ?)", (now_ts, now_ts)
+    ).fetchone()["t"]
+    lease = cur.execute(
+        "SELECT MIN(lease_expires_at) AS t FROM jobs INDEXED BY idx_jobs_lease WHERE state='processing'"
+    ).fetchone()["t"]
+    # rate-limited keys with work waiting get their next token
+    token = cur.execute(
+        "SELECT MIN(ready_at) AS t FROM concurrency_keys INDEXED BY idx_concurrency_keys_ready WHERE ready_at > ?",
+        (now_ts,)
+    ).fetchone()["t"]
+    times = [t for t in (due, lease, token) if t is not None]
+    return min(times) if times else None
+
+
+def count_due(now_ts: int, limit: int = 100000) -> int:
+    """Pending jobs due by now_ts, counted up to `limit` (an index range scan)."""
+    return get_conn().execute(
+        "SELECT COUNT(*) AS n FROM (SELECT 1 FROM jobs INDEXED BY idx_jobs_pending_due "
+        "WHERE key_limited IN (0, 1) AND state='pending' AND next_run_at<=? LIMIT ?)", (now_ts, limit)
+    ).fetchone()["n"]
+
+
+def extend_leases(job_ids: List[str], owner: Optional[str], until_ts: int) -> List[str]:
+    """
+    Heartbeat: push the lease expiry of jobs still held by `owner` out to
+    until_ts. Returns the ids that are still ours; anything missing was
+    reaped (and possibly re-claimed elsewhere) and must not be completed.
+    """
+    if not job_ids:
+        return []
+    conn = get_conn()
+    cur = conn.cursor()
+    held = []
+    try:
+        _begin_immediate(cur)
+        for job_id in job_ids:
+            cur.execute(
+                "UPDATE jobs SET lease_expires_at=? WHERE id=? AND state='processing' AND lease_owner IS ?",
+                (until_ts, job_id, owner),
+            )
+            if cur.rowcount == 1:
+                held.append(job_id)
+        conn.commit()
     except Exception:
         try:
             conn.rollback()
         except Exception:
             pass
-        return None
-    finally:
-        conn.close()
+        # don't drop jobs on a transient lock error; the next beat retries
+        return list(job_ids)
+    return held
+
+
+def reap_expired_leases(now_ts: int, limit: int = 100) -> List[str]:
+    """
+    Return jobs whose lease expired (worker died or hung) to 'pending',
+    counting the lost run as an attempt; jobs out of retries go to 'dead'.
+    Both the probe and the update walk idx_jobs_lease, so an idle reaper
+    costs one index seek and never takes the write lock.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        probe = cur.execute(
+            "SELECT 1 FROM jobs INDEXED BY idx_jobs_lease "
+            "WHERE state='processing' AND lease_expires_at < ? LIMIT 1",
+            (now_ts,),
+        ).fetchone()
+        if not probe:
+            return []
+        _begin_immediate(cur)
+        rows = cur.execute(
+            "SELECT id, attempts, max_retries, lease_owner FROM jobs INDEXED BY idx_jobs_lease "
+            "WHERE state='processing' AND lease_expires_at < ? ORDER BY lease_expires_at LIMIT ?",
+            (now_ts, limit),
+        ).fetchall()
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        reaped = []
+        for r in rows:
+            attempts = int(r["attempts"] or 0) + 1
+            state = "dead" if attempts > int(r["max_retries"]) else "pending"
+            msg = f"lease expired (owner {r['lease_owner']})"
+            cur.execute(
+                "UPDATE jobs SET state=?, attempts=?, next_run_at=?, last_error=?, "
+                "lease_owner=NULL, lease_expires_at=NULL, finished_at=?, updated_at=? WHERE id=?",
+                (state, attempts, now_ts, msg, time.time() if state == "dead" else None, now, r["id"]),
+            )
+            cur.execute("INSERT INTO job_events(job_id, event_type, message, created_at) VALUES (?, ?, ?, ?)",
+                        (r["id"], f"lease_expired:{state}", msg, now))
+            if state == "dead":
+                _bury_descendants(conn, r["id"])
+            reaped.append(r["id"])
+        conn.commit()
+        return reaped
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return []
+
+
+def release_jobs(job_ids: List[str], reason: str = "worker shutdown", owner: Optional[str] = None):
+    """
+    Hand claimed-but-unstarted jobs back to 'pending' without counting an
+    attempt (e.g. the rest of a batch when a worker is asked to stop).
+    If owner is given, only jobs still leased to that worker are released.
+    """
+    if not job_ids:
+        return
+    conn = get_conn()
+    cur = conn.cursor()
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    _begin_immediate(cur)
+    try:
+        for job_id in job_ids:
+            sql = ("UPDATE jobs SET state='pending', lease_owner=NULL, lease_expires_at=NULL, updated_at=? "
+                   "WHERE id=? AND state='processing'")
+            params = [now, job_id]
+            if owner is not None:
+                sql += " AND lease_owner=?"
+                params.append(owner)
+            cur.execute(sql, params)
+            if cur.rowcount == 1:
+                _record_event(conn, job_id, "released", reason)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
 def _record_event(conn, job_id: str, event_type: str, message: Optional[str] = None):
@@ -197,9 +1628,13 @@ def update_job_state(job_id: str,
                      last_stdout: Optional[str] = None,
                      last_stderr: Optional[str] = None,
                      timeout: Optional[int] = None,
-                     priority: Optional[int] = None):
+                     priority: Optional[int] = None,
+                     owner: Optional[str] = None) -> bool:
     """
     Update job fields; supports event logging to job_events table.
+    If owner is given, the update only applies while that worker still holds
+    the job's lease. Moving a job out of 'processing' clears its lease.
+    Returns False if nothing was updated.
     """
     conn = get_conn()
     cur = conn.cursor()
@@ -221,6 +1656,9 @@ def update_job_state(job_id: str,
         parts.append("timeout=?"); params.append(timeout)
     if priority is not None:
         parts.append("priority=?"); params.append(priority)
+    if state is not None and state != "processing":
+        parts.append("lease_owner=NULL")
+        parts.append("lease_expires_at=NULL")
 
     # always update updated_at
     parts.append("updated_at=?")
@@ -228,7 +1666,12 @@ def update_job_state(job_id: str,
 
     params.append(job_id)
     sql = "UPDATE jobs SET " + ", ".join(parts) + " WHERE id=?"
+    if owner is not None:
+        sql += " AND state='processing' AND lease_owner=?"
+        params.append(owner)
     cur.execute(sql, tuple(params))
+    if cur.rowcount == 0:
+        return False
 
     # insert an event capturing the change
     # choose event_type based on state or attempts
@@ -242,26 +1685,577 @@ def update_job_state(job_id: str,
         pass
 
     conn.commit()
-    conn.close()
+    return True
+
+
+def complete_job(job_id: str, owner: Optional[str] = None,
+                 stdout: Optional[str] = None, stderr: Optional[str] = None) -> Optional[List[str]]:
+    """
+    Mark a processing job completed and store its output, with the event, in
+    one transaction that also releases dependents left with no unfinished
+    parents. With owner, only applies while that worker holds the lease.
+    Returns the ids of the released dependents, or None if the job was no
+    longer ours to complete.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    now_ts = time.time()
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now_ts))
+    sql = ("UPDATE jobs SET state='completed', last_stdout=?, last_stderr=?, "
+           "lease_owner=NULL, lease_expires_at=NULL, finished_at=?, updated_at=? WHERE id=? AND state='processing'")
+    params = [stdout, stderr, now_ts, now, job_id]
+    if owner is not None:
+        sql += " AND lease_owner=?"
+        params.append(owner)
+    _begin_immediate(cur)
+    try:
+        cur.execute(sql, params)
+        if cur.rowcount != 1:
+            conn.rollback()
+            return None
+        _record_event(conn, job_id, "state:completed", stderr)
+        released = _release_children(conn, job_id, int(now_ts))
+        conn.commit()
+        return released
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def fail_job(job_id: str, error: str, owner: Optional[str] = None,
+             stdout: Optional[str] = None, stderr: Optional[str] = None,
+             now_ts: Optional[int] = None) -> Optional[Tuple[str, int, int]]:
+    """
+    Record a failed run in one transaction: bump attempts, then either
+    schedule a retry (delay = backoff_base ** attempts) or move the job to
+    'dead' (with every job blocked on it), storing the error/output and the
+    event alongside.
+    Returns (new_state, attempts, delay_seconds), or None if the job was no
+    longer ours (lease lost).
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    now_ts = int(time.time()) if now_ts is None else now_ts
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now_ts))
+    _begin_immediate(cur)
+    try:
+        sql = "SELECT attempts, max_retries FROM jobs WHERE id=? AND state='processing'"
+        params = [job_id]
+        if owner is not None:
+            sql += " AND lease_owner=?"
+            params.append(owner)
+        row = cur.execute(sql, params).fetchone()
+        if not row:
+            conn.rollback()
+            return None
+        attempts = int(row["attempts"] or 0) + 1
+        max_retries = int(row["max_retries"]) if row["max_retries"] is not None else 3
+        if attempts > max_retries:
+            state, delay = "dead", 0
+        else:
+            base_row = cur.execute("SELECT value FROM config WHERE key='backoff_base'").fetchone()
+            base = int(base_row["value"]) if base_row and base_row["value"] else 2
+            state, delay = "pending", base ** attempts
+        cur.execute(
+            "UPDATE jobs SET state=?, attempts=?, next_run_at=COALESCE(?, next_run_at), last_error=?, "
+            "last_stdout=?, last_stderr=?, lease_owner=NULL, lease_expires_at=NULL, finished_at=?, updated_at=? "
+            "WHERE id=?",
+            (state, attempts, now_ts + delay if state == "pending" else None, error, stdout,
+             stderr if stderr else error, time.time() if state == "dead" else None, now, job_id),
+        )
+        _record_event(conn, job_id, f"state:{state}", error)
+        if state == "dead":
+            _bury_descendants(conn, job_id)
+        conn.commit()
+        return state, attempts, delay
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _unfinished_parents(conn, job_id: str) -> Tuple[int, int]:
+    """(parents not completed, of which dead) of one job."""
+    row = conn.execute(
+        "SELECT COUNT(*) AS n, COALESCE(SUM(p.state='dead'), 0) AS dead "
+        "FROM job_deps d JOIN jobs p ON p.id=d.parent_id WHERE d.child_id=? AND p.state!='completed'",
+        (job_id,),
+    ).fetchone()
+    return row["n"], row["dead"]
+
+
+def _dedup_holder(cur, key: Optional[str]) -> Optional[str]:
+    """Id of the unfinished job holding dedup key `key`, if any."""
+    if not key:
+        return None
+    row = cur.execute("SELECT id FROM jobs WHERE dedup_key=? AND state IN ('pending', 'blocked', 'processing')",
+                      (key,)).fetchone()
+    return row["id"] if row else None
+
+
+def retry_dead_job(job_id: str) -> Optional[str]:
+    """
+    Requeue a job from the DLQ with its attempts reset: 'pending', or
+    'blocked' while some of its parents are unfinished. Dependents that were
+    dead-lettered only because of it (they never ran) are put back to wait
+    on it, unless another of their parents is still dead.
+    Returns the job's new state, or None if it was not dead. Raises
+    ValueError if an unfinished job has taken over its dedup_key.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    reset = ("UPDATE jobs SET state=?, pending_deps=?, attempts=0, next_run_at=0, last_error=NULL, "
+             "last_stdout=NULL, last_stderr=NULL, lease_owner=NULL, lease_expires_at=NULL, finished_at=NULL, "
+             "updated_at=? WHERE id=?")
+    _begin_immediate(cur)
+    try:
+        row = cur.execute("SELECT state, dedup_key FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if not row or row["state"] != "dead":
+            conn.rollback()
+            return None
+        holder = _dedup_holder(cur, row["dedup_key"])
+        if holder:
+            raise ValueError(f"dedup key '{row['dedup_key']}' is held by job '{holder}'")
+        waiting, _dead = _unfinished_parents(conn, job_id)
+        state = "blocked" if waiting else "pending"
+        cur.execute(reset, (state, waiting, now, job_id))
+        _record_event(conn, job_id, f"state:{state}", "retried from DLQ")
+        frontier = [job_id]
+        while frontier:
+            parent = frontier.pop()
+            rows = cur.execute(
+                "SELECT j.id, j.dedup_key FROM job_deps d JOIN jobs j ON j.id=d.child_id "
+                "WHERE d.parent_id=? AND j.state='dead' AND j.attempts=0",
+                (parent,),
+            ).fetchall()
+            for r in rows:
+                waiting, dead = _unfinished_parents(conn, r["id"])
+                if dead or _dedup_holder(cur, r["dedup_key"]):
+                    continue
+                cur.execute(reset, ("blocked", waiting, now, r["id"]))
+                _record_event(conn, r["id"], "state:blocked", f"dependency {parent} retried")
+                frontier.append(r["id"])
+        conn.commit()
+        return state
+    except Exception:
+        conn.rollback()
+        raise
 
 
 def stats_summary() -> Dict[str, int]:
+    """Job count per state plus "total", from the trigger-maintained queue_stats."""
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT state, COUNT(*) as cnt FROM jobs GROUP BY state")
-    rows = cur.fetchall()
-    summary = {r["state"]: r["cnt"] for r in rows}
-    cur.execute("SELECT COUNT(*) as total FROM jobs")
-    total = cur.fetchone()["total"]
-    conn.close()
-    summary["total"] = total
+    cur.execute("SELECT state, jobs FROM queue_stats WHERE jobs>0 ORDER BY state")
+    summary = {r["state"]: r["jobs"] for r in cur.fetchall()}
+    summary["total"] = sum(summary.values())
     return summary
 
 
+def avg_attempts() -> float:
+    conn = get_conn()
+    row = conn.execute("SELECT SUM(jobs) AS jobs, SUM(attempts) AS attempts FROM queue_stats").fetchone()
+    return round(row["attempts"] / row["jobs"], 2) if row["jobs"] else 0.0
+
+
+def throughput(minutes: int = 5) -> Dict[str, float]:
+    """
+    Average jobs per minute over the last `minutes` minutes (the current,
+    partial minute included) for enqueued, completed, failed and dead.
+    """
+    minutes = max(1, min(minutes, THROUGHPUT_RETENTION_MINUTES))
+    since = int(time.time()) // 60 - (minutes - 1)
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT kind, SUM(count) AS n FROM queue_throughput WHERE minute>=? GROUP BY kind", (since,)
+    ).fetchall()
+    counts = {r["kind"]: r["n"] for r in rows}
+    return {kind: round(counts.get(kind, 0) / minutes, 2) for kind in ("enqueued", "completed", "failed", "dead")}
+
+
+@contextmanager
+def read_snapshot():
+    """
+    Run several reads on this thread's connection against one consistent
+    view of the DB (a deferred read transaction).
+    """
+    conn = get_conn()
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.commit()
+
+
+def change_watermark() -> Tuple[int, int]:
+    """
+    (last job_events id, last jobs rowid). Every change to a job records an
+    event and every insert gets a new, higher rowid (REPLACE included), so
+    job_changes() can find what moved past a watermark with two range scans.
+    """
+    conn = get_conn()
+    ev = conn.execute("SELECT MAX(id) AS m FROM job_events").fetchone()["m"] or 0
+    rid = conn.execute("SELECT MAX(rowid) AS m FROM jobs").fetchone()["m"] or 0
+    return ev, rid
+
+
+def job_changes(since: Tuple[int, int]) -> Tuple[List[sqlite3.Row], List[str], Tuple[int, int]]:
+    """
+    Jobs inserted or changed after the `since` watermark.
+    Returns (rows, ids of jobs that no longer exist, new watermark).
+    Use inside read_snapshot() when combining with other reads.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    watermark = change_watermark()
+    if watermark == tuple(since):
+        return [], [], watermark
+    cur.execute("SELECT DISTINCT job_id FROM job_events WHERE id>? AND id<=?", (since[0], watermark[0]))
+    changed = [r["job_id"] for r in cur.fetchall()]
+    cur.execute("SELECT * FROM jobs WHERE rowid>? AND rowid<=?", (since[1], watermark[1]))
+    found = {r["id"]: r for r in cur.fetchall()}
+    todo = [job_id for job_id in changed if job_id not in found]
+    for i in range(0, len(todo), _ID_LOOKUP_CHUNK):
+        part = todo[i:i + _ID_LOOKUP_CHUNK]
+        cur.execute(f"SELECT * FROM jobs WHERE id IN ({','.join('?' * len(part))})", part)
+        found.update((r["id"], r) for r in cur.fetchall())
+    removed = [job_id for job_id in changed if job_id not in found]
+    return list(found.values()), removed, watermark
+
+
+# snapshots from workers silent this long are dropped from the metrics
+WORKER_METRICS_RETENTION = 24 * 3600
+
+
+def save_worker_metrics(worker: str, data: str):
+    """Store a worker's latest metrics snapshot (JSON), replacing the previous one."""
+    conn = get_conn()
+    now = time.time()
+    _begin_immediate(conn)
+    try:
+        conn.execute("INSERT OR REPLACE INTO worker_metrics(worker, updated_at, data) VALUES (?, ?, ?)",
+                     (worker, now, data))
+        conn.execute("DELETE FROM worker_metrics WHERE updated_at<?", (now - WORKER_METRICS_RETENTION,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def load_worker_metrics() -> List[sqlite3.Row]:
+    conn = get_conn()
+    return conn.execute("SELECT worker, updated_at, data FROM worker_metrics ORDER BY worker").fetchall()
+
+
+def list_queues() -> List[sqlite3.Row]:
+    """Known queues and their fair-share weights."""
+    return get_conn().execute("SELECT name, weight FROM queues ORDER BY name").fetchall()
+
+
+def backlogged_queues() -> List[sqlite3.Row]:
+    """Queues with pending jobs, their weights and pending counts: a range of idx_queues_backlogged."""
+    return get_conn().execute(
+        "SELECT name, weight, pending FROM queues INDEXED BY idx_queues_backlogged WHERE pending > 0 ORDER BY name"
+    ).fetchall()
+
+
+def backlog_epoch() -> int:
+    """A counter that moves whenever some queue goes from no pending jobs to some."""
+    return get_conn().execute("SELECT epoch FROM queue_backlog WHERE id=0").fetchone()["epoch"]
+
+
+def prune_queues() -> int:
+    """
+    Forget queues with no pending jobs and the default weight; they are
+    listed again when next enqueued to. Returns how many were removed.
+    """
+    conn = get_conn()
+    _begin_immediate(conn)
+    try:
+        removed = conn.execute("DELETE FROM queues WHERE pending<=0 AND weight=1 AND name!=?",
+                               (DEFAULT_QUEUE,)).rowcount
+        conn.commit()
+        return removed
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def set_queue_weight(name: str, weight: int):
+    conn = get_conn()
+    _begin_immediate(conn)
+    try:
+        conn.execute("INSERT INTO queues(name, weight) VALUES (?, ?) "
+                     "ON CONFLICT(name) DO UPDATE SET weight=excluded.weight", (name, weight))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def count_queue(name: str) -> Tuple[int, int]:
+    """(due, pending) jobs in one queue: its range of idx_jobs_queue_claim plus limited-key jobs."""
+    conn = get_conn()
+    now_ts = int(time.time())
+    due = pending = 0
+    for sql in ("SELECT COUNT(*) AS pending, COALESCE(SUM(next_run_at<=?), 0) AS due "
+                "FROM jobs INDEXED BY idx_jobs_queue_claim "
+                "WHERE queue=? AND state='pending' AND key_limited=0",
+                "SELECT COUNT(*) AS pending, COALESCE(SUM(next_run_at<=?), 0) AS due "
+                "FROM jobs INDEXED BY idx_jobs_key_claim "
+                "WHERE queue=? AND state='pending' AND key_limited=1"):
+        row = conn.execute(sql, (now_ts, name)).fetchone()
+        due += row["due"]
+        pending += row["pending"]
+    return due, pending
+
+
+def set_key_limit(key: str, max_inflight: Optional[int] = None, rate: Optional[float] = None,
+                  burst: Optional[float] = None):
+    """
+    Limit a concurrency key to max_inflight running jobs and/or `rate`
+    claims per second (token bucket of `burst`, default max(1, rate)).
+    None lifts that limit. The bucket starts full. Moving a key between
+    limited and unlimited re-flags its jobs (a scan of jobs; an admin
+    operation, not a hot path).
+    """
+    conn = get_conn()
+    now = time.time()
+    tokens = None
+    if rate is not None:
+        tokens = burst if burst is not None else max(1.0, rate)
+    _begin_immediate(conn)
+    try:
+        conn.execute(
+            "INSERT INTO concurrency_keys(key, max_inflight, rate, burst, tokens, refilled_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET max_inflight=excluded.max_inflight, "
+            "rate=excluded.rate, burst=excluded.burst, tokens=excluded.tokens, refilled_at=excluded.refilled_at",
+            (key, max_inflight, rate, burst, tokens, now),
+        )
+        limited = int(max_inflight is not None or rate is not None)
+        conn.execute("UPDATE jobs SET key_limited=? WHERE concurrency_key=? AND key_limited!=?",
+                     (limited, key, limited))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def list_key_limits() -> List[sqlite3.Row]:
+    """Every concurrency key with its limits and current pending / in-flight counts."""
+    return get_conn().execute(
+        "SELECT key, max_inflight, rate, burst, tokens, refilled_at, pending, inflight "
+        "FROM concurrency_keys ORDER BY key"
+    ).fetchall()
+
+
+def save_schedule(name: str, spec: str, job: str, misfire: str, next_fire_at: int):
+    """Create or replace a schedule (job is the JSON instance template)."""
+    conn = get_conn()
+    _begin_immediate(conn)
+    try:
+        conn.execute(
+            "INSERT INTO schedules(name, spec, job, misfire, next_fire_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET spec=excluded.spec, job=excluded.job, misfire=excluded.misfire, "
+            "next_fire_at=excluded.next_fire_at, updated_at=excluded.updated_at",
+            (name, spec, job, misfire, next_fire_at, time.time()),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def delete_schedule(name: str) -> bool:
+    conn = get_conn()
+    cur = conn.execute("DELETE FROM schedules WHERE name=?", (name,))
+    return cur.rowcount > 0
+
+
+def list_schedules() -> List[sqlite3.Row]:
+    return get_conn().execute(
+        "SELECT name, spec, job, misfire, next_fire_at, updated_at FROM schedules ORDER BY name"
+    ).fetchall()
+
+
+def schedules_version() -> Tuple[int, float]:
+    """(count, last edit time) of schedules: changes whenever one is added, edited or removed."""
+    row = get_conn().execute("SELECT COUNT(*) AS n, COALESCE(MAX(updated_at), 0) AS at FROM schedules").fetchone()
+    return row["n"], row["at"]
+
+
+def enqueue_scheduled(jobs: List[Dict], fired: List[Tuple[str, int, float]]) -> List[str]:
+    """
+    Insert schedule instances and move each fired schedule's next_fire_at
+    forward, given as (name, next_fire_at, updated_at it was loaded with),
+    in one transaction, so a crash neither loses nor repeats a fire. A
+    schedule edited since it was loaded keeps its new next_fire_at.
+    Instances whose id already exists, or whose dedup_key is held, are
+    skipped and returned.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    _begin_immediate(cur)
+    try:
+        skipped, deduped = _insert_jobs(cur, jobs) if jobs else ([], {})
+        skipped += list(deduped)
+        cur.executemany("UPDATE schedules SET next_fire_at=? WHERE name=? AND updated_at=?",
+                        [(next_fire_at, name, updated_at) for name, next_fire_at, updated_at in fired])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return skipped
+
+
+def acquire_lock(name: str, owner: str, ttl: float) -> bool:
+    """Take (or renew) the named lock for ttl seconds unless someone else holds it."""
+    conn = get_conn()
+    now = time.time()
+    _begin_immediate(conn)
+    try:
+        cur = conn.execute(
+            "INSERT INTO locks(name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at "
+            "WHERE locks.owner=excluded.owner OR locks.expires_at<?",
+            (name, owner, now + ttl, now),
+        )
+        got = cur.rowcount > 0
+        conn.commit()
+        return got
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def release_lock(name: str, owner: str):
+    conn = get_conn()
+    conn.execute("DELETE FROM locks WHERE name=? AND owner=?", (name, owner))
+
+
+# ---------------------------------------------------------------------------
+# Retention (see retention.py). Reads happen without the write lock; each
+# delete is one short BEGIN IMMEDIATE so workers are never stalled for long.
+
+FINISHED_STATES = ("completed", "dead")
+
+
+def finished_jobs_before(cutoff: str, limit: int) -> List[sqlite3.Row]:
+    """Up to `limit` completed/dead jobs last updated before `cutoff` (ISO), oldest first."""
+    conn = get_conn()
+    return conn.execute(
+        "SELECT * FROM jobs INDEXED BY idx_jobs_finished "
+        "WHERE state IN ('completed', 'dead') AND updated_at<? ORDER BY updated_at LIMIT ?",
+        (cutoff, limit),
+    ).fetchall()
+
+
+def count_finished_before(cutoff: str) -> int:
+    conn = get_conn()
+    return conn.execute(
+        "SELECT COUNT(*) AS n FROM jobs INDEXED BY idx_jobs_finished "
+        "WHERE state IN ('completed', 'dead') AND updated_at<?",
+        (cutoff,),
+    ).fetchone()["n"]
+
+
+def events_for_jobs(job_ids: List[str]) -> List[sqlite3.Row]:
+    conn = get_conn()
+    rows: List[sqlite3.Row] = []
+    for i in range(0, len(job_ids), _ID_LOOKUP_CHUNK):
+        part = job_ids[i:i + _ID_LOOKUP_CHUNK]
+        rows += conn.execute(
+            f"SELECT * FROM job_events WHERE job_id IN ({','.join('?' * len(part))}) ORDER BY id", part
+        ).fetchall()
+    return rows
+
+
+def delete_finished_jobs(snapshot: List[Tuple[str, str]]) -> List[str]:
+    """
+    Delete jobs (and their events) given as (id, updated_at) pairs, but only
+    those still finished and unchanged since they were read. Returns the
+    ids actually deleted; a job retried in the meantime is left alone.
+    """
+    if not snapshot:
+        return []
+    conn = get_conn()
+    cur = conn.cursor()
+    deleted = []
+    _begin_immediate(cur)
+    try:
+        for job_id, updated_at in snapshot:
+            cur.execute("DELETE FROM jobs WHERE id=? AND updated_at=? AND state IN ('completed', 'dead')",
+                        (job_id, updated_at))
+            if cur.rowcount:
+                deleted.append(job_id)
+        for i in range(0, len(deleted), _ID_LOOKUP_CHUNK):
+            part = deleted[i:i + _ID_LOOKUP_CHUNK]
+            marks = ','.join('?' * len(part))
+            cur.execute(f"DELETE FROM job_events WHERE job_id IN ({marks})", part)
+            cur.execute(f"DELETE FROM job_deps WHERE parent_id IN ({marks})", part)
+            cur.execute(f"DELETE FROM job_deps WHERE child_id IN ({marks})", part)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return deleted
+
+
+def prune_events_before(cutoff: str, limit: int) -> int:
+    """
+    Delete up to `limit` of the oldest events created before `cutoff`.
+    Event ids grow with time, so this walks the rowid from the start and
+    stops at the first recent event. Returns how many were deleted.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    rows = cur.execute("SELECT id, created_at FROM job_events ORDER BY id LIMIT ?", (limit,)).fetchall()
+    old = []
+    for r in rows:
+        if r["created_at"] is not None and r["created_at"] >= cutoff:
+            break
+        old.append(r["id"])
+    if not old:
+        return 0
+    _begin_immediate(cur)
+    try:
+        cur.execute("DELETE FROM job_events WHERE id>=? AND id<=?", (old[0], old[-1]))
+        n = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return n
+
+
+def auto_vacuum_mode() -> int:
+    """0 none, 1 full, 2 incremental (see PRAGMA auto_vacuum)."""
+    return get_conn().execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def free_pages() -> int:
+    return get_conn().execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def incremental_vacuum(pages: int) -> int:
+    """Return up to `pages` free pages to the OS in one write transaction. Returns the pages freed."""
+    conn = get_conn()
+    before = free_pages()
+    # the pragma frees one page per step; executescript() steps it to the end
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return before - free_pages()
+
+
+def vacuum():
+    """Rebuild the whole file (and switch it to incremental auto_vacuum). Blocks writers throughout."""
+    conn = get_conn()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+
 def get_job_events(job_id: str, limit: int = 100) -> List[sqlite3.Row]:
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT * FROM job_events WHERE job_id=? ORDER BY created_at DESC LIMIT ?", (job_id, limit))
     rows = cur.fetchall()
-    conn.close()
     return rows
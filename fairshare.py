@@ -0,0 +1,101 @@
+# fairshare.py - deficit round robin claiming across named queues
+#
+# Each worker keeps one FairShare. Backlogged queues take turns: on its turn a
+# queue is credited its weight (from the `queues` table; `queuectl queue
+# weight`) and may hand out that many jobs before the turn passes on, so over
+# time every backlogged queue gets claims in proportion to its weight however
+# many high-priority jobs the others hold. A queue with nothing due loses its
+# turn and its leftover credit, as in classic DRR. Each round rebuilds the
+# ring from the trigger-maintained pending counts (idx_queues_backlogged),
+# re-read whenever a queue has become backlogged, so that queue gets a turn
+# in the next round, and each claim reads a single queue through
+# idx_jobs_queue_claim: idle and empty queues cost nothing however many
+# exist. Priority still orders jobs within a queue.
+from typing import Dict, List, Optional, Set, Tuple
+
+from db import DEFAULT_LEASE_SECONDS, backlog_epoch, backlogged_queues, claim_batch, has_due
+
+
+class FairShare:
+    def __init__(self, queues: Optional[List[str]] = None):
+        # None: every queue, including ones created later
+        self.only = set(queues) if queues else None
+        self.weights: Dict[str, int] = {}
+        self.ring: List[str] = []
+        self.deficit: Dict[str, float] = {}
+        self._pos = 0
+        self._credited = False
+        self._new_round = True
+        # backlogged queues and weights as last read, and the (backlog
+        # epoch, second) of that read
+        self._backlog: Dict[str, int] = {}
+        self._read_at: Tuple[int, int] = (-1, -1)
+        # queues found with nothing due since that read
+        self._drained: Set[str] = set()
+
+    def _refresh(self, now_ts: int):
+        """
+        Start a round: rebuild the ring from the backlogged queues and their
+        weights. They are re-read (one range of idx_queues_backlogged) when a
+        queue has become backlogged since the last read, else once a
+        second; in between, queues found with nothing due sit out, so queues
+        holding only future jobs cost a probe a second, not one a round.
+        """
+        read_at = (backlog_epoch(), now_ts)
+        if read_at != self._read_at:
+            self._backlog = {r["name"]: max(1, r["weight"]) for r in backlogged_queues()
+                             if self.only is None or r["name"] in self.only}
+            self._drained.clear()
+            self._read_at = read_at
+        self.weights = {name: w for name, w in self._backlog.items() if name not in self._drained}
+        self.ring = list(self.weights)
+        self.deficit = {name: self.deficit.get(name, 0.0) for name in self.ring}
+        self._pos, self._credited, self._new_round = 0, False, False
+
+    def _next(self, drop: bool):
+        """Pass the turn on, taking the current queue out of the ring if drop."""
+        if drop:
+            queue = self.ring.pop(self._pos)
+            del self.deficit[queue]
+            self._drained.add(queue)
+        else:
+            self._pos += 1
+        self._credited = False
+        if self._pos >= len(self.ring):
+            self._pos, self._new_round = 0, True
+
+    def claim(self, now_ts: int, n: int, owner: Optional[str] = None,
+              lease_seconds: int = DEFAULT_LEASE_SECONDS) -> List[str]:
+        """Claim up to n jobs, taking backlogged queues in deficit-round-robin order."""
+        if self.only is None and not has_due(now_ts):
+            # idle: one probe instead of one per queue
+            return []
+        got: List[str] = []
+        idle_round = False
+        while len(got) < n:
+            if self._new_round:
+                # stop after a round that found nothing, so queues holding
+                # only future jobs are not probed over and over
+                if idle_round:
+                    break
+                self._refresh(now_ts)
+                if not self.ring:
+                    self._new_round = True
+                    break
+                idle_round = True
+            queue = self.ring[self._pos]
+            if not self._credited:
+                self.deficit[queue] += self.weights[queue]
+                self._credited = True
+            want = min(int(self.deficit[queue]), n - len(got))
+            ids = claim_batch(now_ts, want, owner=owner, lease_seconds=lease_seconds, queue=queue)
+            got += ids
+            self.deficit[queue] -= len(ids)
+            if ids:
+                idle_round = False
+            if len(ids) < want:
+                # nothing more due here: the turn and its credit are gone
+                self._next(drop=True)
+            elif self.deficit[queue] < 1:
+                self._next(drop=False)
+        return got
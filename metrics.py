@@ -0,0 +1,189 @@
+# metrics.py - per-stage latency histograms for the job hot path
+#
+# Each worker process records into its own in-memory Registry (an observe()
+# is a bisect and two additions) and periodically stores a JSON snapshot in
+# the worker_metrics table. `/metrics` and `queuectl metrics` merge the
+# snapshots of all workers. Counts are cumulative per worker process, the
+# way Prometheus expects histograms to behave.
+import bisect
+import json
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import db
+
+# bucket upper bounds in seconds, 1ms .. 15min
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 150.0, 300.0, 900.0)
+
+STAGES = {
+    "wait": "Time from a job becoming due (enqueue or run_at) to being claimed",
+    "claim": "Duration of a successful claim transaction",
+    "run": "Command run time",
+    "commit": "Time to record a job outcome (complete/fail transaction)",
+    "lock_wait": "Time BEGIN IMMEDIATE waited for the SQLite write lock",
+    "retry_delay": "Backoff delay scheduled for retried jobs",
+}
+
+# how often workers write their snapshot to the DB
+FLUSH_INTERVAL = 10.0
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate from the buckets (linear within a bucket); None if empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                if i == len(BUCKETS):
+                    return lower
+                return lower + (BUCKETS[i] - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+    def to_dict(self) -> Dict:
+        return {"counts": self.counts, "sum": self.sum, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "Histogram":
+        h = cls()
+        counts = list(d.get("counts", []))
+        if len(counts) == len(h.counts):
+            h.counts = counts
+            h.sum = float(d.get("sum", 0.0))
+            h.count = int(d.get("count", 0))
+        return h
+
+
+class Registry:
+    """One process's histograms, one per stage in STAGES."""
+
+    def __init__(self):
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self._flushed_at = time.time()
+
+    def observe(self, stage: str, seconds: float):
+        self.histograms[stage].observe(max(0.0, seconds))
+
+    @contextmanager
+    def timer(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def snapshot(self) -> str:
+        return json.dumps({stage: h.to_dict() for stage, h in self.histograms.items()})
+
+    def flush_due(self) -> bool:
+        return time.time() - self._flushed_at >= FLUSH_INTERVAL
+
+    def flush(self, worker: str, force: bool = False):
+        """Store the snapshot at most every FLUSH_INTERVAL seconds (or now, if forced)."""
+        if not force and not self.flush_due():
+            return
+        self._flushed_at = time.time()
+        try:
+            db.save_worker_metrics(worker, self.snapshot())
+        except Exception as e:
+            # metrics must never take a worker down
+            print(f"[METRICS] flush failed: {e}")
+
+
+# this process's registry
+METRICS = Registry()
+db.LOCK_WAIT_HOOK = lambda seconds: METRICS.observe("lock_wait", seconds)
+
+
+def observe_wait(job, claimed_at: float):
+    """Queue wait of a just-claimed job: claim time minus when it became due."""
+    enqueued_at = job["enqueued_at"]
+    if enqueued_at is None:
+        return
+    METRICS.observe("wait", claimed_at - max(enqueued_at, job["next_run_at"] or 0))
+
+
+def collect() -> Tuple[Dict[str, Histogram], int]:
+    """All workers' stored snapshots merged per stage, and how many there were."""
+    merged = {stage: Histogram() for stage in STAGES}
+    rows = db.load_worker_metrics()
+    for row in rows:
+        try:
+            data = json.loads(row["data"])
+        except ValueError:
+            continue
+        for stage, h in data.items():
+            if stage in merged:
+                merged[stage].merge(Histogram.from_dict(h))
+    return merged, len(rows)
+
+
+def _fmt_le(bound: float) -> str:
+    return f"{bound:g}"
+
+
+def render_prometheus(histograms: Dict[str, Histogram], states: Dict[str, int],
+                      rates: Dict[str, float], workers: int) -> str:
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines: List[str] = [
+        "# HELP queuectl_stage_seconds Job hot-path latency per stage.",
+        "# TYPE queuectl_stage_seconds histogram",
+    ]
+    for stage, h in histograms.items():
+        cumulative = 0
+        for bound, n in zip(BUCKETS, h.counts):
+            cumulative += n
+            lines.append(f'queuectl_stage_seconds_bucket{{stage="{stage}",le="{_fmt_le(bound)}"}} {cumulative}')
+        lines.append(f'queuectl_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+        lines.append(f'queuectl_stage_seconds_sum{{stage="{stage}"}} {h.sum:.6f}')
+        lines.append(f'queuectl_stage_seconds_count{{stage="{stage}"}} {h.count}')
+    lines += ["# HELP queuectl_jobs Jobs currently in each state.", "# TYPE queuectl_jobs gauge"]
+    for state, n in states.items():
+        lines.append(f'queuectl_jobs{{state="{state}"}} {n}')
+    lines += ["# HELP queuectl_jobs_per_minute Average jobs per minute over the last 5 minutes.",
+              "# TYPE queuectl_jobs_per_minute gauge"]
+    for kind, rate in rates.items():
+        lines.append(f'queuectl_jobs_per_minute{{kind="{kind}"}} {rate}')
+    lines += ["# HELP queuectl_workers_reporting Worker processes with a stored metrics snapshot.",
+              "# TYPE queuectl_workers_reporting gauge",
+              f"queuectl_workers_reporting {workers}"]
+    return "\n".join(lines) + "\n"
+
+
+def exposition() -> str:
+    """Everything /metrics serves, read from the DB."""
+    states = db.stats_summary()
+    states.pop("total", None)
+    histograms, workers = collect()
+    return render_prometheus(histograms, states, db.throughput(5), workers)
+
+
+def summary_rows(histograms: Dict[str, Histogram]) -> Iterable[tuple]:
+    """(stage, count, mean, p50, p90, p99) per stage, for human-readable output."""
+    for stage, h in histograms.items():
+        mean = h.sum / h.count if h.count else None
+        yield stage, h.count, mean, h.quantile(0.5), h.quantile(0.9), h.quantile(0.99)
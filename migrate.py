@@ -1,27 +1,13 @@
-# migrate.py -- add missing columns safely
-import sqlite3
-conn = sqlite3.connect("queue.db")
-cur = conn.cursor()
-cols = [c[1] for c in cur.execute("PRAGMA table_info(jobs)").fetchall()]
+# migrate.py -- bring an existing queue.db up to the current schema version
+from db import init_db, get_schema_version, SCHEMA_VERSION, MIGRATIONS
 
-# Add columns if missing
-altered = False
-if 'priority' not in cols:
-    cur.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
-    altered = True
-if 'timeout' not in cols:
-    cur.execute("ALTER TABLE jobs ADD COLUMN timeout INTEGER")
-    altered = True
-if 'last_stdout' not in cols:
-    cur.execute("ALTER TABLE jobs ADD COLUMN last_stdout TEXT")
-    altered = True
-if 'last_stderr' not in cols:
-    cur.execute("ALTER TABLE jobs ADD COLUMN last_stderr TEXT")
-    altered = True
+before = get_schema_version()
+applied = init_db()
 
-if altered:
-    print("Migration applied: added missing columns.")
+if applied:
+    descs = {v: d for v, d, _ in MIGRATIONS}
+    for v in applied:
+        print(f"Migration {v} applied: {descs[v]}")
+    print(f"Schema version {before} -> {SCHEMA_VERSION}.")
 else:
-    print("No migration needed.")
-conn.commit()
-conn.close()
+    print(f"No migration needed (schema version {before}).")
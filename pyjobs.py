@@ -0,0 +1,247 @@
+# pyjobs.py - in-process Python callable jobs, run by a pre-warmed process pool
+#
+# A job with kind "python" names a callable as "package.module:function" (or
+# "module:Class.method") and passes its JSON `args`: a list becomes positional
+# arguments, an object keyword arguments. Calls run in long-lived child
+# processes, started when the worker meets its first Python job (or when it
+# starts, with config python_pool_warm=1), so there is no /bin/sh fork+exec
+# per job and imported modules stay cached between jobs. A child is only
+# replaced when a job times out (it is killed, like a shell job's process
+# group) or takes the process down. Children come from a forkserver (spawn
+# where there is none), never a fork of the worker: by then it runs its
+# heartbeat thread, and a fork taken while another thread holds a lock
+# (sqlite, logging, stdio) leaves that lock held in the child for good.
+#
+# Semantics match shell jobs: returning (or sys.exit(0)) is success, an
+# exception is exit code 1 with the traceback on stderr, and whatever the
+# callable prints is streamed to the worker into the same bounded capture,
+# so a killed job keeps what it wrote. A non-None return value is appended
+# to stdout as a line of JSON.
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Callable, Dict, List, Optional, Tuple
+
+import db
+from capture import OutputCapture, log_path
+
+KINDS = ("shell", "python")
+
+
+def resolve(target: str) -> Callable:
+    """Import "module:attr.path" and return the object it names."""
+    module_name, sep, attr_path = target.partition(":")
+    if not sep or not module_name or not attr_path:
+        raise ValueError(f"python job command must look like 'module:function', got {target!r}")
+    obj = importlib.import_module(module_name)
+    for attr in attr_path.split("."):
+        obj = getattr(obj, attr)
+    if not callable(obj):
+        raise TypeError(f"{target} is not callable")
+    return obj
+
+
+def split_args(args) -> Tuple[list, dict]:
+    """Job args (JSON text or decoded) -> (positional, keyword) arguments."""
+    if isinstance(args, str):
+        args = json.loads(args) if args else None
+    if args is None:
+        return [], {}
+    if isinstance(args, list):
+        return args, {}
+    if isinstance(args, dict):
+        return [], args
+    return [args], {}
+
+
+class _Sink(io.TextIOBase):
+    """Text stream sending what is written to the worker, for redirect_stdout/stderr."""
+
+    def __init__(self, conn, stream: str, lock: threading.Lock):
+        self.conn = conn
+        self.stream = stream
+        # threads started by the job share the pipe
+        self.lock = lock
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        if s:
+            with self.lock:
+                self.conn.send((self.stream, s.encode("utf-8", errors="replace")))
+        return len(s)
+
+
+def _call(conn, resolved: Dict[str, Callable], target: str, args: list, kwargs: dict) -> int:
+    lock = threading.Lock()
+    returncode = 0
+    with redirect_stdout(_Sink(conn, "stdout", lock)), redirect_stderr(_Sink(conn, "stderr", lock)):
+        try:
+            fn = resolved.get(target)
+            if fn is None:
+                fn = resolved[target] = resolve(target)
+            result = fn(*args, **kwargs)
+            if result is not None:
+                print(json.dumps(result, default=str))
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                returncode = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+    return returncode
+
+
+def _serve(conn, parent_end, preload: List[str]):
+    """Child process: run calls sent over `conn` until told to stop or the worker goes away."""
+    # a forked copy of the worker's end would keep recv() from ever seeing EOF
+    parent_end.close()
+    # Ctrl+C goes to the whole process group; the worker decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # job modules are usually found relative to where the worker was started
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"[PY] preload of {name} failed: {e}")
+    resolved: Dict[str, Callable] = {}
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            return
+        if msg is None:
+            return
+        conn.send(("exit", _call(conn, resolved, *msg)))
+
+
+def _context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    # imported once in the (single-threaded) server, inherited by every child
+    ctx.set_forkserver_preload(["__main__", "pyjobs"])
+    return ctx
+
+
+class _Child:
+    def __init__(self, preload: List[str]):
+        ctx = _context()
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=_serve, args=(child_conn, self.conn, preload), name="queuectl-py")
+        self.proc.start()
+        child_conn.close()
+
+    def kill(self):
+        self.proc.terminate()
+        self.proc.join(1.0)
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.proc.join(2.0)
+        if self.proc.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+
+class PythonPool:
+    """
+    Up to `size` child processes running Python jobs, one job per child at a
+    time. Children are started as jobs need them (all of them up front with
+    warm=True); callers beyond `size` wait for a free child. Safe to use
+    from several threads.
+    """
+
+    def __init__(self, size: int = 1, preload: Optional[List[str]] = None, warm: bool = False):
+        self.size = max(1, size)
+        self.preload = list(preload or [])
+        self._idle: List[_Child] = [_Child(self.preload) for _ in range(self.size)] if warm else []
+        self._free = threading.Semaphore(self.size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def run(self, target: str, args, timeout: Optional[float], job_id: str,
+            cap: int, log_dir: str) -> Tuple[Optional[int], str, str]:
+        """Same contract as capture.run_captured(): returncode is None on timeout."""
+        positional, keyword = split_args(args)
+        self._free.acquire()
+        try:
+            with self._lock:
+                child = self._idle.pop() if self._idle else None
+            if child is None or not child.proc.is_alive():
+                child = _Child(self.preload)
+            out = OutputCapture(log_path(log_dir, job_id, "stdout"), cap)
+            err = OutputCapture(log_path(log_dir, job_id, "stderr"), cap)
+            captures = {"stdout": out, "stderr": err}
+            deadline = time.monotonic() + timeout if timeout else None
+            returncode: Optional[int] = None
+            try:
+                child.conn.send((target, positional, keyword))
+                while True:
+                    # checked before each read, so a chatty job cannot outrun its timeout
+                    left = None if deadline is None else deadline - time.monotonic()
+                    if left is not None and (left <= 0 or not child.conn.poll(left)):
+                        child.kill()
+                        return None, out.text(), err.text()
+                    kind, data = child.conn.recv()
+                    if kind == "exit":
+                        returncode = data
+                        break
+                    captures[kind].feed(data)
+            except (EOFError, OSError):
+                # the job killed its process (os._exit, a crash, OOM killer)
+                child.kill()
+                code = child.proc.exitcode
+                err.feed(f"\npython job process exited with code {code}".encode())
+                return code if code else -1, out.text(), err.text()
+            finally:
+                out.close()
+                err.close()
+            with self._lock:
+                if self._closed:
+                    child.stop()
+                else:
+                    self._idle.append(child)
+            return returncode, out.text(), err.text()
+        finally:
+            self._free.release()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for child in idle:
+            child.stop()
+
+
+def start_pool(size: int = 1) -> PythonPool:
+    """A pool sized, preloaded and warmed from config (python_pool_size, python_preload, python_pool_warm)."""
+    configured = db.get_config("python_pool_size")
+    if configured:
+        size = int(configured)
+    preload = [m.strip() for m in (db.get_config("python_preload") or "").split(",") if m.strip()]
+    warm = (db.get_config("python_pool_warm") or "").lower() in ("1", "true", "yes", "on")
+    return PythonPool(size, preload, warm)
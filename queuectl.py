@@ -3,8 +3,20 @@ import click
 import json
 import time
 import os
+import signal
+from collections import Counter
 from datetime import datetime, timezone
-from db import init_db, save_job, list_jobs, get_config, set_config, get_job, update_job_state, stats_summary
+from db import (init_db, save_job, save_jobs, list_jobs, get_config, set_config, get_job, retry_dead_job,
+                stats_summary, avg_attempts, throughput, acquire_lock, release_lock, vacuum as vacuum_db,
+                list_queues, set_queue_weight, prune_queues, count_queue, DEFAULT_QUEUE, set_key_limit,
+                list_key_limits, save_schedule, delete_schedule, list_schedules, DEDUP_POLICIES,
+                dependency_errors, redirect_deduped)
+from notify import poke
+from capture import output_settings, tail_log
+from pyjobs import KINDS
+from scheduler import MISFIRE_POLICIES, parse_interval, parse_spec, run_scheduler
+import metrics as metrics_mod
+import retention
 
 init_db()  # ensure DB exists when the module is imported
 
@@ -40,17 +52,212 @@ def cli():
     pass
 
 
+def prepare_job(job, priority=None, timeout=None, run_at=None, default_max_retries=3, queue=None,
+                concurrency_key=None, depends_on=None, dedup_key=None, dedup_window=None, on_conflict=None):
+    """
+    Validate a job dict and apply CLI overrides/defaults in place.
+    Raises click.BadParameter on invalid input.
+    """
+    if not isinstance(job, dict) or "id" not in job or "command" not in job:
+        raise click.BadParameter("Job must include 'id' and 'command'")
+    kind = job.setdefault("kind", "shell")
+    if kind not in KINDS:
+        raise click.BadParameter(f"Job kind must be one of {', '.join(KINDS)}")
+    if kind == "python":
+        if ":" not in job["command"]:
+            raise click.BadParameter("Python jobs need command 'module:function'")
+        if isinstance(job.get("args"), str):
+            try:
+                json.loads(job["args"])
+            except ValueError:
+                raise click.BadParameter("Job args must be JSON")
+
+    # CLI flags override JSON fields if provided
+    if queue:
+        job["queue"] = queue
+    if "queue" in job and (not isinstance(job["queue"], str) or not job["queue"].strip()):
+        raise click.BadParameter("Job queue must be a non-empty string")
+    if concurrency_key:
+        job["concurrency_key"] = concurrency_key
+    if job.get("concurrency_key") is not None and not isinstance(job["concurrency_key"], str):
+        raise click.BadParameter("Job concurrency_key must be a string")
+    if depends_on:
+        job["depends_on"] = list(job.get("depends_on") or []) + list(depends_on)
+    if isinstance(job.get("depends_on"), str):
+        job["depends_on"] = [job["depends_on"]]
+    deps = job.get("depends_on")
+    if deps is not None and (not isinstance(deps, list) or not all(isinstance(d, str) and d for d in deps)):
+        raise click.BadParameter("Job depends_on must be a list of job ids")
+    if deps and job["id"] in deps:
+        raise click.BadParameter("A job cannot depend on itself")
+    if dedup_key:
+        job["dedup_key"] = dedup_key
+    if dedup_window is not None:
+        job["dedup_window"] = dedup_window
+    if on_conflict:
+        job["on_conflict"] = on_conflict
+    if job.get("dedup_key") is not None and (not isinstance(job["dedup_key"], str) or not job["dedup_key"]):
+        raise click.BadParameter("Job dedup_key must be a non-empty string")
+    if isinstance(job.get("dedup_window"), str):
+        try:
+            job["dedup_window"] = parse_interval(job["dedup_window"])
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    window = job.get("dedup_window")
+    if window is not None and (not isinstance(window, (int, float)) or window < 0):
+        raise click.BadParameter("Job dedup_window must be a number of seconds >= 0")
+    if job.get("on_conflict") is not None and job["on_conflict"] not in DEDUP_POLICIES:
+        raise click.BadParameter(f"Job on_conflict must be one of {', '.join(DEDUP_POLICIES)}")
+    if priority is not None:
+        job["priority"] = priority
+    if timeout is not None:
+        job["timeout"] = timeout
+    if run_at:
+        job["next_run_at"] = parse_iso_to_epoch(run_at)
+    else:
+        # if job JSON has run_at (string), convert it
+        if "run_at" in job and job.get("run_at"):
+            job["next_run_at"] = parse_iso_to_epoch(job["run_at"])
+
+    # default max_retries
+    if "max_retries" not in job:
+        job["max_retries"] = default_max_retries
+
+    # set priority default
+    if "priority" not in job:
+        job["priority"] = 0
+    return job
+
+
+def enqueue_jsonl(stream, chunk_size, on_duplicate, priority, timeout, run_at, queue=None, concurrency_key=None,
+                  depends_on=None, dedup_window=None, on_conflict=None):
+    """
+    Stream jobs from a JSONL file object, inserting chunk_size jobs per
+    transaction. Bad lines are reported with their line number and skipped,
+    including jobs whose dependencies cannot be resolved (and the jobs of
+    the chunk depending on them). Returns (enqueued, deduplicated, skipped,
+    errors).
+    """
+    default_max_retries = int(get_config("default_max_retries") or 3)
+    enqueued = merged = skipped = errors = 0
+    chunk, line_of = [], {}
+    # {deduplicated id: holder's id} of earlier chunks, so later lines may depend on either
+    merged_into = {}
+
+    def flush():
+        nonlocal enqueued, merged, skipped, errors
+        if not chunk:
+            return
+        if any(job.get("depends_on") for job in chunk):
+            chunk[:] = redirect_deduped(chunk, merged_into)
+            rejected = dependency_errors(chunk)
+            if rejected:
+                for job_id, reason in rejected.items():
+                    for lineno in line_of.pop(job_id):
+                        click.echo(f"line {lineno}: {reason}", err=True)
+                        errors += 1
+                chunk[:] = [job for job in chunk if job["id"] not in rejected]
+                if not chunk:
+                    return
+        deduped = {}
+        try:
+            dups = save_jobs(chunk, replace=(on_duplicate == "replace"), deduped=deduped)
+        except ValueError as e:
+            lines = sorted(n for numbers in line_of.values() for n in numbers)
+            click.echo(f"lines {lines[0]}-{lines[-1]}: {e}", err=True)
+            errors += len(chunk)
+            chunk.clear()
+            line_of.clear()
+            return
+        enqueued += len(chunk) - len(dups)
+        merged += len(deduped)
+        merged_into.update(deduped)
+        dups = [job_id for job_id in dups if job_id not in deduped]
+        if on_duplicate == "error":
+            # the skipped copies of an id are always its last occurrences
+            for job_id, count in Counter(dups).items():
+                for lineno in line_of[job_id][-count:]:
+                    click.echo(f"line {lineno}: duplicate job id '{job_id}'", err=True)
+            errors += len(dups)
+        else:
+            if on_duplicate == "replace":
+                # only jobs being processed are left in place
+                for job_id in set(dups):
+                    for lineno in line_of[job_id]:
+                        click.echo(f"line {lineno}: job '{job_id}' is processing, not replaced", err=True)
+            skipped += len(dups)
+        chunk.clear()
+        line_of.clear()
+        # let workers start on this chunk while we parse the next
+        poke()
+
+    for lineno, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = prepare_job(json.loads(line), priority, timeout, run_at, default_max_retries, queue,
+                              concurrency_key, depends_on, dedup_window=dedup_window, on_conflict=on_conflict)
+        except (ValueError, click.BadParameter) as e:
+            errors += 1
+            click.echo(f"line {lineno}: {e}", err=True)
+            continue
+        line_of.setdefault(job["id"], []).append(lineno)
+        chunk.append(job)
+        if len(chunk) >= chunk_size:
+            flush()
+    flush()
+    return enqueued, merged, skipped, errors
+
+
 @cli.command()
 @click.option("--file", "file_path", type=click.Path(), help="Path to a JSON file containing the job")
-@click.option("--priority", type=int, default=0, help="Job priority (higher processed first)")
+@click.option("--jsonl", "jsonl_path", type=click.Path(allow_dash=True),
+              help="Enqueue many jobs from a JSON Lines file, one job per line ('-' reads stdin)")
+@click.option("--chunk-size", default=5000, type=click.IntRange(min=1), help="Jobs per transaction with --jsonl")
+@click.option("--on-duplicate", type=click.Choice(["error", "skip", "replace"]), default="error",
+              help="What --jsonl does with ids that already exist")
+@click.option("--priority", type=int, default=None, help="Job priority (higher processed first)")
 @click.option("--timeout", type=int, default=None, help="Job timeout in seconds (optional)")
 @click.option("--run-at", "run_at", type=str, default=None, help="Schedule job at ISO time (UTC), e.g. 2025-11-12T15:30:00Z")
+@click.option("--queue", default=None, help="Named queue to put the job(s) in (default: 'default')")
+@click.option("--concurrency-key", default=None, help="Key whose limits apply to the job(s); see `queuectl limit`")
+@click.option("--depends-on", "depends_on", multiple=True,
+              help="Job id that must complete first (repeatable); adds to the job's own depends_on")
+@click.option("--dedup-key", default=None,
+              help="Skip the job while another unfinished job has this key (single job only)")
+@click.option("--dedup-window", default=None,
+              help="Also skip it if a job with the key was enqueued this long ago (e.g. 30s, 10m, 1h)")
+@click.option("--on-conflict", type=click.Choice(DEDUP_POLICIES), default=None,
+              help="What a skipped duplicate does to the job holding its key (default: ignore)")
 @click.argument("job_json", required=False)
-def enqueue(file_path, priority, timeout, run_at, job_json):
+def enqueue(file_path, jsonl_path, chunk_size, on_duplicate, priority, timeout, run_at, queue, concurrency_key,
+            depends_on, dedup_key, dedup_window, on_conflict, job_json):
     """
-    Add a new job to the queue. Provide JSON string or use --file <path>.
+    Add a new job to the queue. Provide JSON string or use --file <path>,
+    or bulk-load many jobs with --jsonl <path|->.
     Extra CLI options can set priority, timeout, and scheduled run time.
     """
+    if dedup_window is not None:
+        try:
+            dedup_window = parse_interval(dedup_window)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--dedup-window")
+    if jsonl_path:
+        if dedup_key:
+            raise click.UsageError("--dedup-key would make every line a duplicate; set dedup_key per line instead")
+        started = time.time()
+        with click.open_file(jsonl_path, "r", encoding="utf-8") as f:
+            enqueued, merged, skipped, errors = enqueue_jsonl(f, chunk_size, on_duplicate, priority, timeout, run_at,
+                                                              queue, concurrency_key, depends_on, dedup_window,
+                                                              on_conflict)
+        elapsed = max(time.time() - started, 1e-9)
+        click.echo(f"Enqueued {enqueued} job(s), deduplicated {merged}, skipped {skipped}, errors {errors} "
+                   f"in {elapsed:.2f}s ({enqueued / elapsed:.0f} jobs/s)")
+        if errors:
+            raise SystemExit(1)
+        return
+
     try:
         if file_path:
             with open(file_path, "r", encoding="utf-8") as f:
@@ -59,37 +266,25 @@ def enqueue(file_path, priority, timeout, run_at, job_json):
             if not job_json:
                 raise click.UsageError("Either provide job JSON or use --file <path>")
             job = json.loads(job_json)
-        if "id" not in job or "command" not in job:
-            raise click.BadParameter("Job must include 'id' and 'command'")
-
-        # CLI flags override JSON fields if provided
-        if priority is not None:
-            job["priority"] = priority
-        if timeout is not None:
-            job["timeout"] = timeout
-        if run_at:
-            job["next_run_at"] = parse_iso_to_epoch(run_at)
-        else:
-            # if job JSON has run_at (string), convert it
-            if "run_at" in job and job.get("run_at"):
-                job["next_run_at"] = parse_iso_to_epoch(job["run_at"])
-
-        # default max_retries
-        if "max_retries" not in job:
-            job["max_retries"] = int(get_config("default_max_retries") or 3)
-
-        # set priority default
-        if "priority" not in job:
-            job["priority"] = 0
-
-        save_job(job)
-        click.echo(f"Job '{job['id']}' enqueued. priority={job.get('priority')} run_at={job.get('next_run_at',0)} timeout={job.get('timeout')}")
+        prepare_job(job, priority, timeout, run_at, int(get_config("default_max_retries") or 3), queue,
+                    concurrency_key, depends_on, dedup_key, dedup_window, on_conflict)
+
+        holder = save_job(job)
+        if holder != job["id"]:
+            click.echo(f"Job '{job['id']}' not enqueued: job '{holder}' holds dedup key '{job['dedup_key']}' "
+                       f"(on_conflict={job.get('on_conflict') or 'ignore'}).")
+            if job.get("on_conflict") in ("replace", "bump"):
+                poke()
+            return
+        poke()
+        click.echo(f"Job '{job['id']}' enqueued. queue={job.get('queue', DEFAULT_QUEUE)} priority={job.get('priority')} run_at={job.get('next_run_at',0)} timeout={job.get('timeout')}"
+                   + (f" state={get_job(job['id'])['state']}" if job.get("depends_on") else ""))
     except Exception as e:
         click.echo(f"Error: {e}")
 
 
 @cli.command(name="list")
-@click.option("--state", help="Filter jobs by state (pending, processing, completed, failed, dead)")
+@click.option("--state", help="Filter jobs by state (pending, blocked, processing, completed, failed, dead)")
 @click.option("--verbose", is_flag=True, help="Show stdout/stderr for jobs")
 def list_jobs_cmd(state, verbose):
     """List jobs by state (or all)"""
@@ -116,14 +311,78 @@ def status():
             click.echo(f"Total jobs: {count}")
         else:
             click.echo(f"{state}: {count}")
-    # simple extra metrics
-    # avg attempts
-    rows = list_jobs()
-    if rows:
-        avg_attempts = sum([r["attempts"] for r in rows]) / len(rows)
-    else:
-        avg_attempts = 0
-    click.echo(f"Avg attempts per job: {avg_attempts:.2f}")
+    # simple extra metrics, all from the queue_stats / queue_throughput counters
+    click.echo(f"Avg attempts per job: {avg_attempts():.2f}")
+    rates = throughput(5)
+    click.echo("Per minute (last 5 min): " + ", ".join(f"{kind} {rate:g}" for kind, rate in rates.items()))
+
+
+@cli.command()
+@click.option("--prometheus", is_flag=True, help="Print the Prometheus text served at /metrics")
+def metrics(prometheus):
+    """Show per-stage latency histograms merged from all workers"""
+    if prometheus:
+        click.echo(metrics_mod.exposition(), nl=False)
+        return
+    histograms, workers = metrics_mod.collect()
+    click.echo(f"=== Stage latency ({workers} worker snapshot(s)) ===")
+    click.echo(f"{'stage':<12} {'count':>8} {'mean':>10} {'p50':>10} {'p90':>10} {'p99':>10}")
+
+    def fmt(v):
+        return "-" if v is None else (f"{v * 1000:.1f}ms" if v < 1 else f"{v:.2f}s")
+
+    for stage, count, mean, p50, p90, p99 in metrics_mod.summary_rows(histograms):
+        click.echo(f"{stage:<12} {count:>8} {fmt(mean):>10} {fmt(p50):>10} {fmt(p90):>10} {fmt(p99):>10}")
+
+
+@cli.command()
+@click.option("--days", type=float, default=None,
+              help="Archive completed/dead jobs not updated for this many days (default: config retention_days, else 7)")
+@click.option("--event-days", type=float, default=None, help="Delete events older than this (default: --days)")
+@click.option("--batch-size", default=retention.DEFAULT_BATCH_SIZE, type=click.IntRange(min=1),
+              help="Jobs per delete transaction")
+@click.option("--no-archive", is_flag=True, help="Delete without writing the gzip JSONL archive")
+@click.option("--dry-run", is_flag=True, help="Only report how many jobs would go")
+@click.option("--vacuum", is_flag=True,
+              help="Finish with a full VACUUM (one-off for DBs created before incremental auto_vacuum; blocks writers)")
+def gc(days, event_days, batch_size, no_archive, dry_run, vacuum):
+    """Archive and delete old finished jobs, prune events, compact the DB"""
+    if days is None:
+        days = float(get_config("retention_days") or 7)
+    owner = f"cli:{os.getpid()}"
+    if not dry_run and not acquire_lock(retention.LOCK_NAME, owner, 24 * 3600):
+        click.echo("Another process is running retention right now; try again later.")
+        raise SystemExit(1)
+    try:
+        stats = retention.gc(days, event_days, batch_size=batch_size, archive=not no_archive,
+                             dry_run=dry_run, log=click.echo)
+        if vacuum and not dry_run:
+            click.echo("Running VACUUM...")
+            vacuum_db()
+    finally:
+        if not dry_run:
+            release_lock(retention.LOCK_NAME, owner)
+    if not dry_run:
+        click.echo(f"Deleted {stats['jobs']} job(s) and {stats['logs']} log file(s), pruned {stats['events']} "
+                   f"event(s), freed {stats['pages']} page(s).")
+
+
+@cli.command()
+@click.argument("job_id")
+@click.option("--stream", type=click.Choice(["stdout", "stderr"]), default="stdout", help="Which output stream")
+@click.option("--lines", "-n", default=50, type=click.IntRange(min=1), help="Number of lines from the end")
+def logs(job_id, stream, lines):
+    """Show the tail of a job's output (from the full spilled log if it exceeded the cap)"""
+    j = get_job(job_id)
+    if not j:
+        click.echo("Job not found.")
+        return
+    _, log_dir = output_settings()
+    tail = tail_log(log_dir, job_id, stream, lines)
+    if tail is None:
+        tail = (j["last_" + stream] or "").splitlines()[-lines:]
+    for line in tail:
+        click.echo(line)
 
 
 @cli.group()
@@ -156,11 +415,194 @@ def worker():
 
 
 @worker.command("start")
-@click.option("--count", default=1, help="Number of worker processes to start")
+@click.option("--count", "--min", "count", default=1, type=click.IntRange(min=1),
+              help="Number of worker processes to start (minimum when autoscaling)")
+@click.option("--max", "max_count", default=None, type=click.IntRange(min=1),
+              help="Autoscale up to this many workers by queue depth and job run time")
+@click.option("--max-jobs-per-worker", default=None, type=click.IntRange(min=1),
+              help="Replace each worker process after it has run this many jobs")
+@click.option("--drain-timeout", default=None, type=float,
+              help="On stop, kill workers still busy after this many seconds (default: wait)")
 @click.option("--foreground", is_flag=True, help="Run single worker in foreground (no multiprocessing) - useful for debugging")
-def worker_start(count, foreground):
+@click.option("--batch-size", default=1, type=click.IntRange(min=1), help="Jobs each worker claims per transaction")
+@click.option("--concurrency", default=1, type=click.IntRange(min=1),
+              help="Jobs each worker runs at once (>1 uses the asyncio engine)")
+@click.option("--queues", default=None, help="Comma-separated queues to take jobs from (default: all)")
+@click.option("--no-scheduler", is_flag=True,
+              help="Don't fire recurring schedules from this supervisor (see `queuectl scheduler run`)")
+def worker_start(count, max_count, max_jobs_per_worker, drain_timeout, foreground, batch_size, concurrency, queues,
+                 no_scheduler):
     click.echo(f"Starting {count} worker(s){' (foreground)' if foreground else ''}...")
-    start_workers(count if not foreground else 1, foreground=foreground)
+    names = [q.strip() for q in queues.split(",") if q.strip()] if queues else None
+    start_workers(count if not foreground else 1, foreground=foreground, batch_size=batch_size,
+                  concurrency=concurrency, max_count=max_count, max_jobs=max_jobs_per_worker,
+                  drain_timeout=drain_timeout, queues=names, schedules=not no_scheduler)
+
+
+@cli.group()
+def queue():
+    """Named queues and their fair-share weights"""
+    pass
+
+
+@queue.command("list")
+def queue_list():
+    rows = list_queues()
+    if not rows:
+        click.echo("No queues.")
+        return
+    for r in rows:
+        due, pending = count_queue(r["name"])
+        click.echo(f"{r['name']} | weight={r['weight']} | due={due} | pending={pending}")
+
+
+@queue.command("weight")
+@click.argument("name")
+@click.argument("weight", type=click.IntRange(min=1))
+def queue_weight(name, weight):
+    """Workers serving several queues give NAME `weight` claims per turn."""
+    set_queue_weight(name, weight)
+    click.echo(f"Queue '{name}' weight set to {weight}")
+
+
+@queue.command("prune")
+def queue_prune():
+    """Forget idle queues that keep the default weight (listed again on next enqueue)."""
+    click.echo(f"Pruned {prune_queues()} queue(s)")
+
+
+def parse_rate(value: str) -> float:
+    """'5', '5/s', '120/m' or '1000/h' -> claims per second."""
+    per = {"s": 1.0, "m": 60.0, "h": 3600.0}
+    count, _, unit = value.partition("/")
+    try:
+        rate = float(count) / per[unit.strip().lower() or "s"]
+    except (KeyError, ValueError):
+        raise click.BadParameter("Use N, N/s, N/m or N/h")
+    if rate <= 0:
+        raise click.BadParameter("Rate must be positive")
+    return rate
+
+
+@cli.group()
+def limit():
+    """Per-key concurrency and rate limits (jobs' concurrency_key)"""
+    pass
+
+
+@limit.command("set")
+@click.argument("key")
+@click.option("--max-inflight", type=click.IntRange(min=1), default=None, help="At most this many running at once")
+@click.option("--rate", default=None, help="Claims per second, or N/m, N/h")
+@click.option("--burst", type=float, default=None, help="Token bucket size (default: max(1, rate per second))")
+def limit_set(key, max_inflight, rate, burst):
+    """Replace the limits of KEY (omitted options are lifted)."""
+    set_key_limit(key, max_inflight=max_inflight, rate=parse_rate(rate) if rate else None, burst=burst)
+    click.echo(f"Key '{key}': max_inflight={max_inflight or '-'} rate={rate or '-'} burst={burst or '-'}")
+
+
+@limit.command("clear")
+@click.argument("key")
+def limit_clear(key):
+    set_key_limit(key)
+    click.echo(f"Key '{key}' is unlimited")
+
+
+@limit.command("list")
+def limit_list():
+    rows = list_key_limits()
+    if not rows:
+        click.echo("No concurrency keys.")
+        return
+    for r in rows:
+        rate = f"{r['rate']:g}/s burst {r['burst'] or max(1.0, r['rate']):g}" if r["rate"] else "-"
+        click.echo(f"{r['key']} | max_inflight={r['max_inflight'] or '-'} | rate={rate} | "
+                   f"inflight={r['inflight']} | pending={r['pending']}")
+
+
+@cli.group()
+def schedule():
+    """Recurring jobs: cron expressions or fixed intervals"""
+    pass
+
+
+@schedule.command("add")
+@click.argument("name")
+@click.argument("job_json")
+@click.option("--cron", "cron_expr", default=None,
+              help='Cron expression in UTC, e.g. "*/5 * * * *" or @hourly, @daily, @weekly')
+@click.option("--every", default=None, help="Fixed interval instead of --cron, e.g. 30s, 5m, 2h, 1d")
+@click.option("--misfire", type=click.Choice(MISFIRE_POLICIES), default="once",
+              help="Fires missed while no scheduler ran: enqueue once, all of them, or skip them")
+@click.option("--priority", type=int, default=None, help="Priority of the enqueued jobs")
+@click.option("--timeout", type=int, default=None, help="Timeout of the enqueued jobs in seconds")
+@click.option("--queue", default=None, help="Named queue of the enqueued jobs")
+@click.option("--concurrency-key", default=None, help="Concurrency key of the enqueued jobs")
+def schedule_add(name, job_json, cron_expr, every, misfire, priority, timeout, queue, concurrency_key):
+    """Create or replace schedule NAME, enqueuing JOB_JSON (no id needed) at every fire."""
+    if bool(cron_expr) == bool(every):
+        raise click.UsageError("Give exactly one of --cron or --every")
+    if "@" in name:
+        raise click.BadParameter("Schedule names cannot contain '@' (job ids are <name>@<fire time>)")
+    try:
+        spec = cron_expr.strip() if cron_expr else f"@every {parse_interval(every)}s"
+        next_fire_at = parse_spec(spec).next_after(int(time.time()))
+        job = json.loads(job_json)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    if not isinstance(job, dict):
+        raise click.BadParameter("Job must be a JSON object")
+    if job.get("depends_on") or job.get("run_at"):
+        raise click.BadParameter("Scheduled jobs cannot use depends_on or run_at")
+    job["id"] = name
+    prepare_job(job, priority, timeout, None, int(get_config("default_max_retries") or 3), queue, concurrency_key)
+    template = {k: v for k, v in job.items() if k not in ("id", "next_run_at")}
+    save_schedule(name, spec, json.dumps(template), misfire, next_fire_at)
+    click.echo(f"Schedule '{name}' saved ({spec}); next fire {_iso(next_fire_at)}.")
+
+
+def _iso(ts: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+
+@schedule.command("list")
+def schedule_list():
+    rows = list_schedules()
+    if not rows:
+        click.echo("No schedules.")
+        return
+    for r in rows:
+        job = json.loads(r["job"])
+        click.echo(f"{r['name']} | {r['spec']} | misfire={r['misfire']} | next={_iso(r['next_fire_at'])} | "
+                   f"cmd={job['command']}")
+
+
+@schedule.command("remove")
+@click.argument("name")
+def schedule_remove(name):
+    """Stop enqueuing NAME (jobs it already enqueued are kept)."""
+    if delete_schedule(name):
+        click.echo(f"Schedule '{name}' removed.")
+    else:
+        click.echo("Schedule not found.")
+
+
+@cli.group(name="scheduler")
+def scheduler_cmd():
+    """Run the component that enqueues scheduled jobs"""
+    pass
+
+
+@scheduler_cmd.command("run")
+def scheduler_run():
+    """Fire schedules in this process (`worker start` also does, unless --no-scheduler)."""
+    signals = []
+    signal.signal(signal.SIGINT, lambda signum, frame: signals.append(signum))
+    try:
+        signal.signal(signal.SIGTERM, lambda signum, frame: signals.append(signum))
+    except Exception:
+        pass
+    run_scheduler(stopped=lambda: bool(signals))
 
 
 @cli.group()
@@ -189,8 +631,13 @@ def dlq_retry(job_id):
     if j["state"] != "dead":
         click.echo("Job is not in DLQ.")
         return
-    update_job_state(job_id, state="pending", attempts=0, next_run_at=0, last_error=None, last_stdout=None, last_stderr=None)
-    click.echo(f"Requeued {job_id} from DLQ.")
+    try:
+        state = retry_dead_job(job_id)
+    except ValueError as e:
+        click.echo(f"Cannot requeue {job_id}: {e}")
+        return
+    poke()
+    click.echo(f"Requeued {job_id} from DLQ ({state}).")
 
 
 if __name__ == "__main__":
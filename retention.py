@@ -0,0 +1,168 @@
+# retention.py - archive and delete old finished jobs, prune events, compact the DB
+#
+# Completed and dead jobs older than a threshold are written (with their
+# events) to gzip JSON Lines files under <archive_dir>/, then deleted in
+# small batches. Every batch reads without the write lock and deletes in one
+# short transaction, sleeping in between, so workers keep claiming while a
+# large backlog is cleaned up. Run it with `queuectl gc`, or set the
+# `retention_days` config key to let workers do it in the background.
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+
+import db
+from capture import STREAMS, log_path, output_settings
+
+DEFAULT_BATCH_SIZE = 500
+# pause between batches, giving workers a window to take the write lock
+BATCH_PAUSE = 0.05
+VACUUM_STEP_PAGES = 2000
+
+# background retention: how often a worker tries, and how much it does per go
+BACKGROUND_INTERVAL = 300.0
+BACKGROUND_MAX_BATCHES = 20
+LOCK_NAME = "retention"
+
+
+def archive_dir() -> str:
+    return db.get_config("archive_dir") or os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), "archive")
+
+
+def _cutoff(days: float) -> str:
+    # same format as jobs.updated_at / job_events.created_at
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _remove_logs(log_dir: str, job_id: str) -> int:
+    removed = 0
+    for stream in STREAMS:
+        try:
+            os.remove(log_path(log_dir, job_id, stream))
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def gc(days: float, event_days: Optional[float] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+       archive: bool = True, dry_run: bool = False, max_batches: Optional[int] = None,
+       vacuum_pages: Optional[int] = None, log: Callable[[str], None] = print) -> Dict[str, int]:
+    """
+    Archive + delete completed/dead jobs not updated for `days`, delete
+    events older than `event_days` (default: `days`), then hand free pages
+    back with incremental vacuum. Returns counts of what was done.
+    """
+    event_days = days if event_days is None else event_days
+    cutoff = _cutoff(days)
+    stats = {"jobs": 0, "events": 0, "logs": 0, "pages": 0}
+    _, log_dir = output_settings()
+
+    if dry_run:
+        stats["jobs"] = db.count_finished_before(cutoff)
+        log(f"[GC] would archive and delete {stats['jobs']} job(s) last updated before {cutoff}")
+        return stats
+
+    out = None
+    path = None
+    batches = 0
+    try:
+        while max_batches is None or batches < max_batches:
+            rows = db.finished_jobs_before(cutoff, batch_size)
+            if not rows:
+                break
+            batches += 1
+            ids = [r["id"] for r in rows]
+            if archive:
+                if out is None:
+                    directory = archive_dir()
+                    os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, time.strftime("jobs-%Y%m%d-%H%M%S.jsonl.gz", time.gmtime()))
+                    out = gzip.open(path, "at", encoding="utf-8", compresslevel=6)
+                events: Dict[str, list] = {}
+                for e in db.events_for_jobs(ids):
+                    events.setdefault(e["job_id"], []).append(
+                        {"event_type": e["event_type"], "message": e["message"], "created_at": e["created_at"]})
+                for r in rows:
+                    record = {k: r[k] for k in r.keys()}
+                    record["events"] = events.get(r["id"], [])
+                    out.write(json.dumps(record, default=str) + "\n")
+                # the archive must be on disk before the rows are gone
+                out.flush()
+            deleted = db.delete_finished_jobs([(r["id"], r["updated_at"]) for r in rows])
+            stats["jobs"] += len(deleted)
+            for job_id in deleted:
+                stats["logs"] += _remove_logs(log_dir, job_id)
+            if len(deleted) < len(rows):
+                log(f"[GC] {len(rows) - len(deleted)} job(s) changed while archiving; kept")
+                if not deleted:
+                    # everything left is being touched right now; try again next run
+                    break
+            time.sleep(BATCH_PAUSE)
+    finally:
+        if out is not None:
+            out.close()
+    if path:
+        log(f"[GC] archived {stats['jobs']} job(s) to {path}")
+
+    event_cutoff = _cutoff(event_days)
+    while max_batches is None or batches < max_batches:
+        n = db.prune_events_before(event_cutoff, batch_size * 10)
+        if not n:
+            break
+        batches += 1
+        stats["events"] += n
+        time.sleep(BATCH_PAUSE)
+
+    if db.auto_vacuum_mode() == 2:
+        budget = vacuum_pages
+        while budget is None or budget > 0:
+            step = VACUUM_STEP_PAGES if budget is None else min(VACUUM_STEP_PAGES, budget)
+            freed = db.incremental_vacuum(step)
+            stats["pages"] += freed
+            if budget is not None:
+                budget -= step
+            if freed < step:
+                break
+            time.sleep(BATCH_PAUSE)
+    elif db.free_pages():
+        log(f"[GC] {db.free_pages()} free page(s) stay in the file: this DB predates incremental "
+            f"auto_vacuum; run `queuectl gc --vacuum` once (blocks writers while it runs)")
+    return stats
+
+
+class BackgroundRetention:
+    """
+    Called from worker loops: every BACKGROUND_INTERVAL seconds, if the
+    `retention_days` config key is set and no other process holds the
+    retention lock, run a bounded gc() pass.
+    """
+
+    def __init__(self, owner: str):
+        self.owner = owner
+        self._last = time.time()
+
+    def due(self) -> bool:
+        return time.time() - self._last >= BACKGROUND_INTERVAL
+
+    def run(self):
+        self._last = time.time()
+        try:
+            days = db.get_config("retention_days")
+            if not days or float(days) <= 0:
+                return
+            if not db.acquire_lock(LOCK_NAME, self.owner, BACKGROUND_INTERVAL):
+                return
+            try:
+                stats = gc(float(days), max_batches=BACKGROUND_MAX_BATCHES,
+                           vacuum_pages=VACUUM_STEP_PAGES * 5, log=lambda msg: None)
+            finally:
+                db.release_lock(LOCK_NAME, self.owner)
+            if stats["jobs"] or stats["events"]:
+                print(f"[GC] archived {stats['jobs']} job(s), pruned {stats['events']} event(s), "
+                      f"freed {stats['pages']} page(s)")
+        except Exception as e:
+            # retention must never take a worker down
+            print(f"[GC] background retention failed: {e}")
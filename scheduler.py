@@ -0,0 +1,281 @@
+# scheduler.py - turns recurring schedules into jobs
+#
+# A schedule (`queuectl schedule add`) is a cron expression or a fixed
+# interval plus a job template. One scheduler at a time (the holder of the
+# "scheduler" lock; every `worker start` supervisor and `queuectl scheduler
+# run` competes for it) keeps each schedule's next fire time in a heap and
+# sleeps until the earliest one, so thousands of schedules cost a heap peek
+# between fires. Everything due in one tick is inserted in a single
+# transaction that also moves the schedules' next_fire_at forward; instance
+# ids are "<schedule>@<fire time>", so a fire is never enqueued twice.
+#
+# A fire found in the past (the scheduler was down) is a misfire, handled by
+# the schedule's policy: "once" enqueues one instance for all missed fires,
+# "all" enqueues every missed fire (MAX_CATCHUP per tick), "skip" drops them
+# unless the scheduler is less than MISFIRE_GRACE seconds late.
+import heapq
+import json
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import db
+from notify import poke
+
+LOCK_NAME = "scheduler"
+LOCK_TTL = 30.0
+# how often the schedules table is checked for edits
+RELOAD_INTERVAL = 5.0
+MISFIRE_POLICIES = ("once", "all", "skip")
+MISFIRE_GRACE = 60
+# instances one schedule may catch up per tick with the "all" policy
+MAX_CATCHUP = 1000
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTHS = ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+WEEKDAYS = ("sun", "mon", "tue", "wed", "thu", "fri", "sat")
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+# a cron expression must fire within this many years (rejects "0 0 30 2 *")
+SEARCH_YEARS = 8
+
+
+def _parse_field(text: str, lo: int, hi: int, names: Tuple[str, ...] = (), first: int = 0) -> List[int]:
+    def value(token: str) -> int:
+        token = token.lower()
+        if token in names:
+            return names.index(token) + first
+        n = int(token)
+        if not lo <= n <= hi:
+            raise ValueError(f"{n} is out of range {lo}-{hi}")
+        return n
+
+    values = set()
+    for part in text.split(","):
+        part, _, step_text = part.partition("/")
+        step = int(step_text) if step_text else 1
+        if step < 1:
+            raise ValueError(f"bad step in {text!r}")
+        if part == "*":
+            start, end = lo, hi
+        elif "-" in part:
+            a, _, b = part.partition("-")
+            start, end = value(a), value(b)
+        else:
+            start = value(part)
+            # "5/15" means "5-hi/15"
+            end = hi if step_text else start
+        if start > end:
+            raise ValueError(f"bad range in {text!r}")
+        values.update(range(start, end + 1, step))
+    return sorted(values)
+
+
+class Cron:
+    """A 5-field cron expression (minute hour day month weekday), in UTC."""
+
+    def __init__(self, expr: str):
+        fields = ALIASES.get(expr.strip().lower(), expr).split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields, got {expr!r}")
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = set(_parse_field(fields[1], 0, 23))
+        self.days = set(_parse_field(fields[2], 1, 31))
+        self.months = set(_parse_field(fields[3], 1, 12, MONTHS, 1))
+        # 0 and 7 are both Sunday
+        self.weekdays = {d % 7 for d in _parse_field(fields[4], 0, 7, WEEKDAYS)}
+        # as in Vixie cron: with both day fields restricted, either may match
+        self.either_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+        self.next_after(int(time.time()))
+
+    def _day_matches(self, t: datetime) -> bool:
+        in_days = t.day in self.days
+        in_weekdays = (t.weekday() + 1) % 7 in self.weekdays
+        return in_days or in_weekdays if self.either_day else in_days and in_weekdays
+
+    def next_after(self, ts: int) -> int:
+        """The first fire time strictly after epoch second `ts`."""
+        t = datetime.fromtimestamp(ts // 60 * 60 + 60, timezone.utc)
+        last_year = t.year + SEARCH_YEARS
+        while t.year <= last_year:
+            if t.month not in self.months:
+                t = datetime(t.year + t.month // 12, t.month % 12 + 1, 1, tzinfo=timezone.utc)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            else:
+                minute = next((m for m in self.minutes if m >= t.minute), None)
+                if minute is not None:
+                    return int(t.replace(minute=minute).timestamp())
+                t = t.replace(minute=0) + timedelta(hours=1)
+        raise ValueError("cron expression never fires")
+
+
+class Every:
+    """A fixed interval, aligned to the epoch (so "1h" fires on the hour)."""
+
+    def __init__(self, seconds: int):
+        if seconds < 1:
+            raise ValueError("interval must be at least 1s")
+        self.seconds = seconds
+
+    def next_after(self, ts: int) -> int:
+        return (ts // self.seconds + 1) * self.seconds
+
+
+def parse_interval(text: str) -> int:
+    """'90', '90s', '5m', '2h' or '1d' -> seconds."""
+    text = text.strip().lower()
+    unit = text[-1:] if text[-1:] in UNITS else "s"
+    number = text[:-1] if text[-1:] in UNITS else text
+    try:
+        return int(float(number) * UNITS[unit])
+    except ValueError:
+        raise ValueError(f"bad interval {text!r}; use e.g. 30s, 5m, 2h, 1d")
+
+
+def parse_spec(spec: str):
+    """A stored schedule spec: "@every <seconds>s" or a cron expression."""
+    if spec.startswith("@every "):
+        return Every(parse_interval(spec[len("@every "):]))
+    return Cron(spec)
+
+
+def fire_times(spec, next_fire_at: int, misfire: str, now: int) -> Tuple[List[int], int]:
+    """
+    Which fires to enqueue now for a schedule due at next_fire_at, and its
+    next fire time after that, following the misfire policy.
+    """
+    if misfire == "all":
+        times, t = [], next_fire_at
+        while t <= now and len(times) < MAX_CATCHUP:
+            times.append(t)
+            t = spec.next_after(t)
+        return times, t
+    following = spec.next_after(next_fire_at)
+    if following > now:
+        # the usual case: one fire, on time or nearly
+        late = misfire == "skip" and now - next_fire_at > MISFIRE_GRACE
+        return ([] if late else [next_fire_at]), following
+    if misfire == "skip":
+        return [], spec.next_after(now)
+    return [next_fire_at], spec.next_after(now)
+
+
+def instance_id(name: str, fire_at: int) -> str:
+    return f"{name}@{time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(fire_at))}"
+
+
+class _Entry:
+    __slots__ = ("spec", "template", "misfire", "next_fire_at", "updated_at")
+
+    def __init__(self, row):
+        self.spec = parse_spec(row["spec"])
+        self.template = json.loads(row["job"])
+        self.misfire = row["misfire"]
+        self.next_fire_at = row["next_fire_at"]
+        self.updated_at = row["updated_at"]
+
+
+class Scheduler:
+    """
+    Call tick() repeatedly; it returns how long it can sleep before there is
+    anything to do. Only the lock holder fires schedules; the others just
+    retry the lock.
+    """
+
+    def __init__(self, owner: Optional[str] = None):
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.leader = False
+        self.entries: Dict[str, _Entry] = {}
+        self.heap: List[Tuple[int, str]] = []
+        self._version = None
+        self._renewed_at = 0.0
+        self._checked_at = 0.0
+
+    def tick(self) -> float:
+        now = time.time()
+        if now - self._renewed_at >= LOCK_TTL / 3:
+            self._renewed_at = now
+            leader = db.acquire_lock(LOCK_NAME, self.owner, LOCK_TTL)
+            if leader != self.leader:
+                print(f"[SCHED] {self.owner} {'is now' if leader else 'is no longer'} the scheduler.")
+                self.leader = leader
+                self._version = None
+        wake = self._renewed_at + LOCK_TTL / 3
+        if not self.leader:
+            return max(0.0, wake - now)
+        if self._version is None or now - self._checked_at >= RELOAD_INTERVAL:
+            self._checked_at = now
+            version = db.schedules_version()
+            if version != self._version:
+                self._load()
+                self._version = version
+        try:
+            self._fire(int(now))
+        except Exception as e:
+            # in-memory state may now be ahead of the DB: start over from it
+            print(f"[SCHED] enqueue failed: {e}")
+            self._version = None
+        wake = min(wake, self._checked_at + RELOAD_INTERVAL)
+        if self.heap:
+            wake = min(wake, self.heap[0][0])
+        return max(0.0, wake - time.time())
+
+    def _load(self):
+        self.entries = {}
+        for row in db.list_schedules():
+            try:
+                self.entries[row["name"]] = _Entry(row)
+            except ValueError as e:
+                print(f"[SCHED] schedule {row['name']} ignored: {e}")
+        self.heap = [(entry.next_fire_at, name) for name, entry in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def _fire(self, now: int):
+        jobs: List[Dict] = []
+        fired: List[Tuple[str, int, float]] = []
+        while self.heap and self.heap[0][0] <= now:
+            _, name = heapq.heappop(self.heap)
+            entry = self.entries[name]
+            times, entry.next_fire_at = fire_times(entry.spec, entry.next_fire_at, entry.misfire, now)
+            jobs += [dict(entry.template, id=instance_id(name, t), next_run_at=t) for t in times]
+            fired.append((name, entry.next_fire_at, entry.updated_at))
+            heapq.heappush(self.heap, (entry.next_fire_at, name))
+        if not fired:
+            return
+        skipped = db.enqueue_scheduled(jobs, fired)
+        if len(jobs) > len(skipped):
+            print(f"[SCHED] enqueued {len(jobs) - len(skipped)} job(s) from {len(fired)} schedule(s)")
+            poke()
+
+    def close(self):
+        if self.leader:
+            db.release_lock(LOCK_NAME, self.owner)
+            self.leader = False
+
+
+def run_scheduler(scheduler: Optional[Scheduler] = None, stopped=lambda: False):
+    """Run a scheduler until stopped() (checked at least every second)."""
+    scheduler = scheduler or Scheduler()
+    print(f"[SCHED] {scheduler.owner} started. Press Ctrl+C to stop.")
+    try:
+        while not stopped():
+            try:
+                wait = scheduler.tick()
+            except Exception as e:
+                print(f"[SCHED] tick failed: {e}")
+                wait = 1.0
+            time.sleep(min(1.0, wait))
+    finally:
+        scheduler.close()
@@ -0,0 +1,216 @@
+# supervisor.py - keeps a pool of worker processes sized to the queue
+#
+# `queuectl worker start` runs this in the parent process. It starts --count
+# workers and, when --max is higher, adds workers while the due backlog
+# would take longer than `autoscale_target_seconds` to drain at the observed
+# job run time, retiring them again once the queue has been quiet for
+# SCALE_DOWN_DELAY. Crashed workers are restarted (with backoff if they keep
+# crashing); workers that reach --max-jobs-per-worker exit by themselves and
+# are replaced, which caps memory growth from leaky jobs. On SIGTERM or
+# Ctrl+C every worker finishes its current job and exits; a second signal
+# kills them (their leases are then reaped as for any dead worker). Unless
+# told otherwise, the supervisor also competes to be the scheduler that
+# enqueues recurring jobs (scheduler.py).
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from typing import Dict, List, Optional
+
+import db
+from metrics import collect
+from notify import poke
+from scheduler import Scheduler
+from worker import handle_sigterm, shutdown_flag, worker_loop
+
+TICK = 1.0
+# scale down one worker per SCALE_DOWN_STEP once fewer were needed for SCALE_DOWN_DELAY
+SCALE_DOWN_DELAY = 30.0
+SCALE_DOWN_STEP = 5.0
+DEFAULT_TARGET_SECONDS = 10.0
+# assumed job run time until workers have reported metrics
+DEFAULT_JOB_SECONDS = 1.0
+# run times come from the workers' metrics snapshots, flushed every 10s
+METRICS_INTERVAL = 5.0
+# crash-looping workers are restarted after 1, 2, 4 ... seconds, up to this
+RESTART_BACKOFF_MAX = 30.0
+# a worker that lived this long before crashing resets the backoff
+STABLE_AFTER = 10.0
+
+
+def _run_worker(stop, kwargs: Dict):
+    # forked children inherit the supervisor's handlers; workers just drain
+    signal.signal(signal.SIGINT, handle_sigterm)
+    try:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+    except Exception:
+        pass
+    if "concurrency" in kwargs:
+        from async_worker import async_worker_loop
+        async_worker_loop(stop=stop, **kwargs)
+    else:
+        worker_loop(stop=stop, **kwargs)
+
+
+class _Child:
+    def __init__(self, ctx, kwargs: Dict):
+        # per-worker stop event: retire one worker without touching the rest
+        self.stop = ctx.Event()
+        self.proc = ctx.Process(target=_run_worker, args=(self.stop, kwargs))
+        self.proc.start()
+        self.started = time.time()
+        self.retiring = False
+
+
+class Supervisor:
+    def __init__(self, min_workers: int, max_workers: int, batch_size: int = 1, concurrency: int = 1,
+                 max_jobs: Optional[int] = None, drain_timeout: Optional[float] = None,
+                 queues: Optional[List[str]] = None, schedules: bool = True):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.kwargs: Dict = {"concurrency": concurrency} if concurrency > 1 else {"batch_size": batch_size}
+        if max_jobs:
+            self.kwargs["max_jobs"] = max_jobs
+        if queues:
+            self.kwargs["queues"] = list(queues)
+        self.slots = concurrency if concurrency > 1 else 1
+        self.drain_timeout = drain_timeout
+        self.ctx = multiprocessing.get_context()
+        self.children: List[_Child] = []
+        self.desired = self.min_workers
+        self.job_seconds = DEFAULT_JOB_SECONDS
+        self._run_totals = None
+        self._metrics_at = 0.0
+        self._low_since: Optional[float] = None
+        self._crashes = 0
+        self._restart_at = 0.0
+        self._signals = 0
+        self.scheduler = Scheduler(f"sup:{socket.gethostname()}:{os.getpid()}") if schedules else None
+
+    def _on_signal(self, signum, frame):
+        # only plain Python state here: setting the multiprocessing Event
+        # from a handler can deadlock on its internal lock
+        self._signals += 1
+        if self._signals == 1:
+            print("[SUP] Stop signal: workers finish their current job and exit (signal again to kill).")
+        else:
+            print("[SUP] Second stop signal: killing workers.")
+            for child in self.children:
+                if child.proc.is_alive():
+                    child.proc.kill()
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._on_signal)
+        try:
+            signal.signal(signal.SIGTERM, self._on_signal)
+        except Exception:
+            pass
+        scaling = f"{self.min_workers}..{self.max_workers}" if self.max_workers > self.min_workers \
+            else str(self.min_workers)
+        recycle = f", recycled every {self.kwargs['max_jobs']} jobs" if "max_jobs" in self.kwargs else ""
+        print(f"[SUP] Supervising {scaling} worker(s){recycle}. Press Ctrl+C to stop.")
+        try:
+            while not self._signals:
+                self._reap()
+                self._scale()
+                if self.scheduler is not None:
+                    self._schedule()
+                time.sleep(TICK)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.close()
+            self._drain()
+
+    def _schedule(self):
+        # fire times are whole seconds, so ticking every TICK is precise enough
+        try:
+            self.scheduler.tick()
+        except Exception as e:
+            # a DB hiccup must not take the supervisor (and its workers) down
+            print(f"[SUP] scheduler tick failed: {e}")
+
+    def _reap(self):
+        now = time.time()
+        for child in list(self.children):
+            if child.proc.is_alive():
+                continue
+            child.proc.join()
+            self.children.remove(child)
+            code = child.proc.exitcode
+            if child.retiring or self._signals:
+                continue
+            if code == 0:
+                # reached max_jobs; _scale() starts the replacement
+                continue
+            self._crashes = self._crashes + 1 if now - child.started < STABLE_AFTER else 1
+            delay = min(RESTART_BACKOFF_MAX, 2.0 ** (self._crashes - 1))
+            self._restart_at = now + delay
+            print(f"[SUP] Worker {child.proc.pid} died (exit code {code}); restarting in {delay:.0f}s.")
+
+    def _needed(self, now: float) -> int:
+        """Workers needed to drain the due backlog within the target time."""
+        if self.max_workers == self.min_workers:
+            return self.min_workers
+        if now - self._metrics_at >= METRICS_INTERVAL:
+            self._metrics_at = now
+            run = collect()[0]["run"]
+            if self._run_totals and run.count > self._run_totals[0]:
+                mean = (run.sum - self._run_totals[1]) / (run.count - self._run_totals[0])
+                if mean > 0:
+                    self.job_seconds = mean
+            self._run_totals = (run.count, run.sum)
+        target = float(db.get_config("autoscale_target_seconds") or DEFAULT_TARGET_SECONDS)
+        due = db.count_due(int(now))
+        busy = db.count_jobs("processing")
+        load = (busy + due * self.job_seconds / target) / self.slots
+        return max(self.min_workers, min(self.max_workers, math.ceil(load)))
+
+    def _scale(self):
+        now = time.time()
+        needed = self._needed(now)
+        if needed >= self.desired:
+            if needed > self.desired:
+                print(f"[SUP] Scaling up {self.desired} -> {needed} worker(s) (~{self.job_seconds:.2f}s per job).")
+            self.desired = needed
+            self._low_since = None
+        elif self._low_since is None:
+            self._low_since = now
+        elif now - self._low_since >= SCALE_DOWN_DELAY:
+            print(f"[SUP] Scaling down {self.desired} -> {self.desired - 1} worker(s).")
+            self.desired -= 1
+            self._low_since = now - SCALE_DOWN_DELAY + SCALE_DOWN_STEP
+
+        active = [c for c in self.children if not c.retiring]
+        if len(active) < self.desired:
+            if now < self._restart_at:
+                return
+            for _ in range(self.desired - len(active)):
+                self.children.append(_Child(self.ctx, self.kwargs))
+        elif len(active) > self.desired:
+            # the newest workers go first; they hold the least warm state
+            for child in sorted(active, key=lambda c: c.started)[self.desired:]:
+                child.retiring = True
+                child.stop.set()
+            poke()
+
+    def _drain(self):
+        shutdown_flag.set()
+        for child in self.children:
+            child.stop.set()
+        poke()
+        alive = [c for c in self.children if c.proc.is_alive()]
+        if alive:
+            print(f"[SUP] Waiting for {len(alive)} worker(s) to finish their current job...")
+        deadline = None if self.drain_timeout is None else time.time() + self.drain_timeout
+        for child in self.children:
+            while child.proc.is_alive():
+                # short joins, so a second Ctrl+C is handled promptly
+                child.proc.join(0.5)
+                if deadline is not None and time.time() >= deadline and child.proc.is_alive():
+                    print(f"[SUP] Worker {child.proc.pid} still busy after {self.drain_timeout}s; killing it.")
+                    child.proc.kill()
+                    child.proc.join()
+        self.children = []
+        print("[SUP] All workers stopped.")
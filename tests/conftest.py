@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db as db_module  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """db.py pointed at a fresh, migrated database."""
+    monkeypatch.setattr(db_module, "DB_PATH", str(tmp_path / "queue.db"))
+    db_module.init_db()
+    yield db_module
+    db_module.close_conn()
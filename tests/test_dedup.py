@@ -0,0 +1,59 @@
+def test_replace_batch_releases_old_key_of_overwritten_holder(db):
+    db.save_job({"id": "a", "command": "echo a", "dedup_key": "k1"})
+
+    deduped = {}
+    skipped = db.save_jobs([
+        # overwrites "a" by id, moving it from k1 to k2
+        {"id": "a", "command": "echo a2", "dedup_key": "k2"},
+        # k1 is free again
+        {"id": "b", "command": "echo b", "dedup_key": "k1"},
+    ], replace=True, deduped=deduped)
+
+    assert skipped == [] and deduped == {}
+    assert db.get_job("a")["dedup_key"] == "k2"
+    assert db.get_job("b")["dedup_key"] == "k1"
+
+
+def test_duplicate_key_in_batch_is_skipped(db):
+    db.save_job({"id": "a", "command": "echo a", "dedup_key": "k1"})
+
+    deduped = {}
+    skipped = db.save_jobs([{"id": "b", "command": "echo b", "dedup_key": "k1"}], deduped=deduped)
+
+    assert skipped == ["b"] and deduped == {"b": "a"}
+    assert db.get_job("b") is None
+
+
+def test_child_of_deduplicated_job_waits_on_holder(db):
+    deduped = {}
+    skipped = db.save_jobs([
+        {"id": "p1", "command": "echo p1", "dedup_key": "k"},
+        {"id": "p2", "command": "echo p2", "dedup_key": "k"},
+        {"id": "c1", "command": "echo c1", "depends_on": ["p2"]},
+        {"id": "x", "command": "echo x"},
+    ], deduped=deduped)
+
+    assert skipped == ["p2"] and deduped == {"p2": "p1"}
+    assert db.get_job("c1")["state"] == "blocked"
+    assert db.get_job("x")["state"] == "pending"
+    assert db.get_conn().execute("SELECT parent_id FROM job_deps WHERE child_id='c1'").fetchone()[0] == "p1"
+
+
+def test_jsonl_child_of_deduplicated_job_is_enqueued(db):
+    import io
+    import json
+
+    from queuectl import enqueue_jsonl
+
+    lines = [
+        {"id": "p1", "command": "echo p1", "dedup_key": "k"},
+        {"id": "p2", "command": "echo p2", "dedup_key": "k"},
+        {"id": "c1", "command": "echo c1", "depends_on": ["p2"]},
+        {"id": "x", "command": "echo x"},
+    ]
+    stream = io.StringIO("".join(json.dumps(line) + "\n" for line in lines))
+    enqueued, merged, _, errors = enqueue_jsonl(stream, 2, "skip", None, None, None)
+
+    # p2 is merged into p1 in the first chunk; c1, in the next, still finds it
+    assert (enqueued, merged, errors) == (3, 1, 0)
+    assert db.get_job("c1")["state"] == "blocked"
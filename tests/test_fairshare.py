@@ -0,0 +1,37 @@
+import time
+
+from fairshare import FairShare
+
+
+def test_newly_backlogged_queue_is_claimed_within_one_round(db):
+    db.save_jobs([{"id": f"a{i}", "command": "true", "queue": "a"} for i in range(100)])
+    fair = FairShare()
+    now = int(time.time())
+    for _ in range(10):
+        assert fair.claim(now, 1, owner="w") != []
+
+    db.save_jobs([{"id": "b0", "command": "true", "queue": "b"}])
+    # at most the rest of this round (a) and the next one (a, b)
+    got = [job_id for _ in range(3) for job_id in fair.claim(now, 1, owner="w")]
+    assert "b0" in got
+
+
+def test_weights_share_claims(db):
+    db.set_queue_weight("a", 3)
+    db.save_jobs([{"id": f"{q}{i}", "command": "true", "queue": q} for q in "ab" for i in range(100)])
+    fair = FairShare()
+    got = [job_id for _ in range(40) for job_id in fair.claim(int(time.time()), 1, owner="w")]
+    assert sum(job_id[0] == "a" for job_id in got) == 30
+
+
+def test_drained_queue_is_claimed_again_when_refilled(db):
+    db.save_jobs([{"id": f"a{i}", "command": "true", "queue": "a"} for i in range(100)]
+                 + [{"id": "b0", "command": "true", "queue": "b"}])
+    fair = FairShare()
+    now = int(time.time())
+    got = [job_id for _ in range(4) for job_id in fair.claim(now, 1, owner="w")]
+    assert "b0" in got
+
+    db.save_jobs([{"id": "b1", "command": "true", "queue": "b"}])
+    got = [job_id for _ in range(3) for job_id in fair.claim(now, 1, owner="w")]
+    assert "b1" in got
@@ -1,15 +1,28 @@
 # webapp.py - WebSocket-backed dashboard with pagination, events, and optional token auth
 import asyncio
+import hashlib
 import json
 import os
 import time
-from typing import Dict, List, Set
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, Form, HTTPException, Header, Query
-from fastapi.responses import HTMLResponse, JSONResponse
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect, Form, HTTPException, Header, Query
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 
-from db import list_jobs, get_jobs_paginated, stats_summary, get_job, update_job_state, get_job_events
+from db import (find_jobs, get_jobs_paginated, stats_summary, get_job, retry_dead_job, get_job_events,
+                avg_attempts, read_snapshot, change_watermark, job_changes,
+                get_jobs_page, count_jobs, throughput, JOB_COLUMNS, LIST_COLUMNS)
+from capture import output_settings, tail_log
+from notify import poke
+from aiodb import AsyncDB
+import metrics
+
+try:
+    import msgpack
+except ImportError:  # optional: only the "msgpack" WebSocket encoding needs it
+    msgpack = None
 
 app = FastAPI(title="QueueCTL Dashboard (WS+Auth+Events)")
 
@@ -24,30 +37,138 @@ app.add_middleware(
 
 templates = Jinja2Templates(directory="templates")
 
+# every DB call below goes through here, off the event loop
+adb = AsyncDB()
+
 # Dashboard auth token (optional)
 DASH_TOKEN = os.environ.get("DASHBOARD_TOKEN", None)
 
-clients: Set[WebSocket] = set()
-_last_snapshot = {"jobs": None, "status": None}
+ENCODINGS = ("json", "columnar", "msgpack")
+# how long a new /ws client has to subscribe before it gets the default
+SUBSCRIBE_WAIT = 2.0
+
+
+class Subscription:
+    """
+    What one /ws client receives: jobs in `state` and/or with ids starting
+    with `prefix`, at most `limit` of them (the window; None is unbounded),
+    only `fields`, encoded as
+      json      a list of job objects (the default)
+      columnar  {"fields": [...], "columns": [[values of field 0], ...]}
+      msgpack   the columnar form as a binary msgpack frame
+    The client sets it with {"type": "subscribe", ...}; one that has not
+    subscribed within SUBSCRIBE_WAIT seconds gets every job, as JSON.
+    """
+
+    def __init__(self, state: Optional[str] = None, prefix: Optional[str] = None, limit: Optional[int] = None,
+                 fields: Optional[List[str]] = None, encoding: str = "json"):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"encoding must be one of {', '.join(ENCODINGS)}")
+        if encoding == "msgpack" and msgpack is None:
+            raise ValueError("msgpack encoding is not available (pip install msgpack)")
+        fields = list(fields or JOB_COLUMNS)
+        unknown = [f for f in fields if f not in JOB_COLUMNS]
+        if unknown:
+            raise ValueError(f"unknown field(s): {', '.join(unknown)}")
+        # the client keys its copy by id and "removed" refers to ids
+        self.fields = tuple(["id"] + [f for f in fields if f != "id"])
+        self.state = state or None
+        self.prefix = prefix or None
+        self.limit = max(1, int(limit)) if limit else None
+        self.encoding = encoding
+        # the ids the client holds: deltas only remove those, and only
+        # those count against the window
+        self.visible: Set[str] = set()
+
+    def key(self) -> tuple:
+        return self.state, self.prefix, self.limit, self.fields, self.encoding
+
+    def matches(self, row) -> bool:
+        return ((self.state is None or row["state"] == self.state)
+                and (self.prefix is None or row["id"].startswith(self.prefix)))
+
+    def encode(self, payload: Dict, rows) -> Tuple[bool, object]:
+        """(binary?, frame) for payload plus the rows' subscribed fields as "jobs"."""
+        values = [tuple(r[f] for f in self.fields) for r in rows]
+        if self.encoding == "json":
+            payload["jobs"] = [dict(zip(self.fields, v)) for v in values]
+            return False, json.dumps(payload, default=str)
+        columns = [list(col) for col in zip(*values)] if values else [[] for _ in self.fields]
+        payload["jobs"] = {"fields": list(self.fields), "columns": columns}
+        if self.encoding == "msgpack":
+            return True, msgpack.packb(payload, default=str)
+        return False, json.dumps(payload, default=str, separators=(",", ":"))
+
+
+clients: Dict[WebSocket, Subscription] = {}
+# position in the change stream (see db.change_watermark) that connected
+# clients have been brought up to; None while nobody is connected
+_watermark: Optional[Tuple[int, int]] = None
+_broadcast_lock = asyncio.Lock()
+
+# read API responses, reused until a job changes (see _cached)
+CACHE_TTL = 5.0
+CACHE_ENTRIES = 256
+
+
+class ResponseCache:
+    """
+    Encoded JSON bodies by request (path + query), LRU-bounded. An entry is
+    valid while the job change watermark it was computed at is current and
+    it is younger than CACHE_TTL; the TTL covers what the watermark does not
+    see (time-based rates, gc deletes).
+    """
+
+    def __init__(self, max_entries: int = CACHE_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, int], float, bytes, str]]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key: str, watermark: Tuple[int, int]) -> Optional[Tuple[bytes, str]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != watermark or time.monotonic() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2], entry[3]
+
+    def put(self, key: str, watermark: Tuple[int, int], body: bytes) -> Tuple[bytes, str]:
+        etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self._entries[key] = (watermark, time.monotonic(), body, etag)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return body, etag
+
+
+_cache = ResponseCache()
+
+
+async def _cached(request: Request, compute: Callable, *args) -> Response:
+    """
+    Serve compute(*args) (run on the read pool) through _cache, with an ETag;
+    a matching If-None-Match gets an empty 304. An unchanged watermark costs
+    two index lookups instead of the query and the JSON encoding.
+    """
+    key = request.url.path + "?" + "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    watermark = await adb.read(change_watermark)
+    hit = _cache.get(key, watermark)
+    if hit is None:
+        data = await adb.read(compute, *args)
+        hit = _cache.put(key, watermark, json.dumps(data, default=str, separators=(",", ":")).encode())
+    body, etag = hit
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 def _serialize_jobs(rows) -> List[Dict]:
+    # rows may be projections (see db.get_jobs_page); lease bookkeeping stays internal
     out = []
     for r in rows:
-        out.append({
-            "id": r["id"],
-            "command": r["command"],
-            "state": r["state"],
-            "attempts": r["attempts"],
-            "max_retries": r["max_retries"],
-            "priority": r["priority"],
-            "timeout": r["timeout"],
-            "created_at": r["created_at"],
-            "updated_at": r["updated_at"],
-            "next_run_at": r["next_run_at"],
-            "last_error": r["last_error"],
-            "last_stdout": r["last_stdout"],
-            "last_stderr": r["last_stderr"],
-        })
+        out.append({k: r[k] for k in r.keys() if k in JOB_COLUMNS})
     return out
 
 @app.get("/", response_class=HTMLResponse)
@@ -55,26 +176,79 @@ async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request, "token_enabled": bool(DASH_TOKEN)})
 
 @app.get("/api/jobs")
-async def api_jobs(state: str = None, page: int = 1, per_page: int = 20):
-    rows, total = get_jobs_paginated(page=page, per_page=per_page, state=state)
-    return JSONResponse({"jobs": _serialize_jobs(rows), "total": total, "page": page, "per_page": per_page})
+async def api_jobs(request: Request, state: str = None, page: Optional[int] = None, per_page: int = 20,
+                   cursor: Optional[str] = None, limit: int = 20, fields: Optional[str] = None,
+                   total: bool = True):
+    """
+    Keyset-paginated job list: pass the returned next_cursor back as `cursor`.
+    `fields` is a comma-separated column list (default: everything but
+    last_stdout/last_stderr); total=false skips the job count.
+    `page`/`per_page` keep the old OFFSET paging working.
+    """
+    if page is not None and cursor is None:
+        return await _cached(request, _jobs_offset_page, page, per_page, state)
+    columns = tuple(f.strip() for f in fields.split(",") if f.strip()) if fields else LIST_COLUMNS
+    limit = max(1, min(limit, 1000))
+    try:
+        return await _cached(request, _jobs_page, state, limit, cursor, columns, total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-@app.get("/api/status")
-async def api_status():
+def _jobs_offset_page(page: int, per_page: int, state: Optional[str]) -> Dict:
+    rows, count = get_jobs_paginated(page=page, per_page=per_page, state=state)
+    return {"jobs": _serialize_jobs(rows), "total": count, "page": page, "per_page": per_page}
+
+def _jobs_page(state: Optional[str], limit: int, cursor: Optional[str], columns: Tuple[str, ...],
+               total: bool) -> Dict:
+    rows, next_cursor = get_jobs_page(state=state, limit=limit, cursor=cursor, columns=columns)
+    body = {"jobs": [{k: r[k] for k in columns} for r in rows], "next_cursor": next_cursor, "limit": limit}
+    if total:
+        body["total"] = count_jobs(state)
+    return body
+
+def _status() -> Dict:
     summary = stats_summary()
-    rows = list_jobs()
-    avg_attempts = round((sum([r["attempts"] for r in rows]) / len(rows)) if rows else 0, 2)
-    summary["avg_attempts"] = avg_attempts
+    summary["avg_attempts"] = avg_attempts()
+    summary["per_minute"] = throughput(5)
     summary["timestamp"] = int(time.time())
-    return JSONResponse(summary)
+    return summary
+
+@app.get("/api/status")
+async def api_status(request: Request):
+    return await _cached(request, _status)
 
 @app.get("/api/jobs/{job_id}/events")
-async def api_job_events(job_id: str, limit: int = 100):
+async def api_job_events(request: Request, job_id: str, limit: int = 100):
+    return await _cached(request, _job_events, job_id, limit)
+
+def _job_events(job_id: str, limit: int) -> List[Dict]:
     evs = get_job_events(job_id, limit=limit)
     out = []
     for e in evs:
         out.append({"event_type": e["event_type"], "message": e["message"], "created_at": e["created_at"]})
-    return JSONResponse(out)
+    return out
+
+@app.get("/api/jobs/{job_id}/log")
+async def api_job_log(job_id: str, stream: str = "stdout", lines: int = 200):
+    if stream not in ("stdout", "stderr"):
+        raise HTTPException(status_code=400, detail="stream must be stdout or stderr")
+    lines = max(1, min(lines, 5000))
+    body = await adb.read(_job_log, job_id, stream, lines)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(body)
+
+def _job_log(job_id: str, stream: str, lines: int) -> Optional[Dict]:
+    # the spilled log is a gzip file: read it on the pool too
+    j = get_job(job_id)
+    if not j:
+        return None
+    _, log_dir = output_settings()
+    tail = tail_log(log_dir, job_id, stream, lines)
+    spilled = tail is not None
+    if tail is None:
+        tail = (j["last_" + stream] or "").splitlines()[-lines:]
+    return {"job_id": job_id, "stream": stream, "spilled": spilled, "lines": tail}
 
 def _check_token(header_token: str = None, query_token: str = None):
     """
@@ -93,13 +267,17 @@ def _check_token(header_token: str = None, query_token: str = None):
 async def api_dlq_retry(job_id: str = Form(...), x_api_key: str = Header(None)):
     if not _check_token(header_token=x_api_key):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    j = get_job(job_id)
+    j = await adb.read(get_job, job_id)
     if not j:
         raise HTTPException(status_code=404, detail="Job not found")
     if j["state"] != "dead":
         raise HTTPException(status_code=400, detail="Job not in DLQ")
-    update_job_state(job_id, state="pending", attempts=0, next_run_at=0, last_error=None, last_stdout=None, last_stderr=None)
-    return JSONResponse({"status": "ok", "message": f"Requeued {job_id}"})
+    try:
+        state = await adb.write(retry_dead_job, job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    poke()
+    return JSONResponse({"status": "ok", "message": f"Requeued {job_id} ({state})"})
 
 # websocket endpoint with optional token in query param
 @app.websocket("/ws")
@@ -109,62 +287,142 @@ async def websocket_endpoint(ws: WebSocket, token: str = Query(None)):
         await ws.close(code=4001)
         return
     await ws.accept()
-    clients.add(ws)
     try:
-        await send_snapshot([ws])
+        # clients normally subscribe first thing: don't send them every job before that
+        try:
+            data = await asyncio.wait_for(ws.receive_text(), SUBSCRIBE_WAIT)
+        except asyncio.TimeoutError:
+            data = None
+        if _message_type(data) != "subscribe":
+            clients[ws] = Subscription()
+            await send_snapshot(ws)
         while True:
+            if data is not None:
+                await _handle_message(ws, data)
             data = await ws.receive_text()
-            try:
-                msg = json.loads(data)
-                if msg.get("type") == "retry" and msg.get("job_id"):
-                    # only allow if no token required or token was provided on ws
-                    j_id = msg["job_id"]
-                    j = get_job(j_id)
-                    if j and j["state"] == "dead":
-                        update_job_state(j_id, state="pending", attempts=0, next_run_at=0, last_error=None, last_stdout=None, last_stderr=None)
-                        await send_snapshot()
-            except Exception:
-                pass
     except WebSocketDisconnect:
-        clients.discard(ws)
+        clients.pop(ws, None)
     except Exception:
-        clients.discard(ws)
+        clients.pop(ws, None)
 
-async def send_snapshot(target_clients: List[WebSocket] = None):
-    rows = list_jobs()
-    jobs = _serialize_jobs(rows)
-    summary = stats_summary()
-    rows_all = list_jobs()
-    avg_attempts = round((sum([r["attempts"] for r in rows_all]) / len(rows_all)) if rows_all else 0, 2)
-    summary["avg_attempts"] = avg_attempts
-    summary["timestamp"] = int(time.time())
+def _message_type(data: Optional[str]) -> Optional[str]:
+    try:
+        return json.loads(data).get("type")
+    except Exception:
+        return None
 
-    global _last_snapshot
-    payload = {"type": "snapshot", "jobs": jobs, "status": summary}
+async def _handle_message(ws: WebSocket, data: str):
+    try:
+        msg = json.loads(data)
+        if msg.get("type") == "retry" and msg.get("job_id"):
+            # only allow if no token required or token was provided on ws
+            j_id = msg["job_id"]
+            # retry_dead_job() itself ignores jobs that are not dead
+            if await adb.write(retry_dead_job, j_id):
+                poke()
+                await broadcast_changes()
+        elif msg.get("type") == "subscribe":
+            try:
+                sub = Subscription(msg.get("state"), msg.get("prefix"), msg.get("limit"),
+                                   msg.get("fields"), msg.get("encoding") or "json")
+            except (TypeError, ValueError) as e:
+                await ws.send_text(json.dumps({"type": "error", "detail": str(e)}))
+                return
+            clients[ws] = sub
+            await send_snapshot(ws)
+        elif msg.get("type") == "resync":
+            # client's local state drifted (e.g. jobs deleted); start it over
+            await send_snapshot(ws)
+    except Exception:
+        pass
 
-    if not target_clients:
-        if _last_snapshot["jobs"] == jobs and _last_snapshot["status"] == summary:
+async def _send(ws: WebSocket, frame: Tuple[bool, object]):
+    binary, data = frame
+    try:
+        if binary:
+            await ws.send_bytes(data)
+        else:
+            await ws.send_text(data)
+    except Exception:
+        clients.pop(ws, None)
+
+async def send_snapshot(ws: WebSocket):
+    """
+    The subscribed jobs + status, sent when a client subscribes or asks to
+    resync. Holds the broadcast lock, so no delta can reach the client
+    between reading the snapshot and sending it (an older snapshot would
+    overwrite newer rows); the next delta may repeat some rows, which is
+    harmless.
+    """
+    global _watermark
+    async with _broadcast_lock:
+        sub = clients.get(ws)
+        if sub is None:
             return
-        _last_snapshot["jobs"] = jobs
-        _last_snapshot["status"] = summary
-        target = list(clients)
-    else:
-        target = target_clients
-
-    text = json.dumps(payload, default=str)
-    to_remove = []
-    for c in target:
-        try:
-            await c.send_text(text)
-        except Exception:
-            to_remove.append(c)
-    for r in to_remove:
-        clients.discard(r)
+        rows, summary, wm = await adb.read(_snapshot, sub.state, sub.prefix, sub.limit, sub.fields)
+        if _watermark is None:
+            _watermark = wm
+        sub.visible = {r["id"] for r in rows}
+        # a full window means jobs were left out: the client cannot check its count
+        truncated = sub.limit is not None and len(rows) >= sub.limit
+        await _send(ws, sub.encode({"type": "snapshot", "status": summary, "truncated": truncated}, rows))
+
+def _snapshot(state: Optional[str], prefix: Optional[str], limit: Optional[int],
+              fields: Tuple[str, ...]) -> Tuple[List, Dict, Tuple[int, int]]:
+    with read_snapshot():
+        return find_jobs(state, prefix, limit, fields), _status(), change_watermark()
+
+def _changes(since: Tuple[int, int]) -> Tuple[List, List[str], Tuple[int, int], Optional[Dict]]:
+    with read_snapshot():
+        rows, removed, wm = job_changes(since)
+        return rows, removed, wm, (_status() if wm != since else None)
+
+def _delta(sub: Subscription, rows, removed: List[str]) -> Tuple[List, List[str]]:
+    """Changed rows to send a subscriber, and the ids it holds that left its subscription."""
+    sent, gone = [], [job_id for job_id in removed if job_id in sub.visible]
+    sub.visible.difference_update(gone)
+    for r in rows:
+        if sub.matches(r):
+            # a full window only follows the jobs already in it
+            if r["id"] in sub.visible or sub.limit is None or len(sub.visible) < sub.limit:
+                sub.visible.add(r["id"])
+                sent.append(r)
+        elif r["id"] in sub.visible:
+            sub.visible.discard(r["id"])
+            gone.append(r["id"])
+    return sent, gone
+
+async def broadcast_changes():
+    """
+    Push only the jobs that changed since the last broadcast, plus fresh
+    counters, to every client, filtered by its subscription. Clients with
+    the same subscription and the same delta share one serialized message.
+    """
+    global _watermark
+    async with _broadcast_lock:
+        if not clients:
+            _watermark = None
+            return
+        if _watermark is None:
+            _watermark = await adb.read(change_watermark)
+            return
+        rows, removed, wm, summary = await adb.read(_changes, _watermark)
+        if wm == _watermark:
+            return
+        _watermark = wm
+        shared: Dict[tuple, Tuple[bool, object]] = {}
+        for ws, sub in list(clients.items()):
+            sent, gone = _delta(sub, rows, removed)
+            key = (sub.key(), tuple(r["id"] for r in sent), tuple(gone))
+            frame = shared.get(key)
+            if frame is None:
+                frame = shared[key] = sub.encode({"type": "delta", "removed": gone, "status": summary}, sent)
+            await _send(ws, frame)
 
 async def _broadcaster():
     while True:
         try:
-            await send_snapshot()
+            await broadcast_changes()
         except Exception:
             pass
         await asyncio.sleep(1.0)
@@ -173,6 +431,14 @@ async def _broadcaster():
 async def startup_event():
     asyncio.create_task(_broadcaster())
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    adb.close()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(await adb.read(metrics.exposition), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/health")
 async def health():
     return {"status": "ok", "time": int(time.time())}
@@ -1,15 +1,36 @@
 # worker.py - job processor for QueueCTL (timeout, priority, scheduled jobs)
-import subprocess
+import os
+import socket
+import threading
 import time
 import multiprocessing
 import signal
 import sys
+from typing import List, Optional, Tuple
+from capture import output_settings, run_captured
+from fairshare import FairShare
 from db import (
-    claim_one_pending,
-    update_job_state,
+    DEFAULT_LEASE_SECONDS,
+    complete_job,
+    extend_leases,
+    fail_job,
+    reap_expired_leases,
+    release_jobs,
     get_config,
     get_job,
+    init_db,
+    next_due_at,
 )
+from metrics import METRICS, observe_wait
+from notify import Waker, poke
+from pyjobs import PythonPool, start_pool
+from retention import BackgroundRetention
+
+# how often (seconds) a worker checks for expired leases left by dead workers
+REAP_INTERVAL = 1.0
+# idle workers sleep until the next due job/lease expiry or a poke, but never
+# longer than this (safety net for missed pokes)
+MAX_IDLE_SECONDS = 5.0
 
 shutdown_flag = multiprocessing.Event()
 
@@ -17,6 +38,8 @@ shutdown_flag = multiprocessing.Event()
 def handle_sigterm(signum, frame):
     print("Worker received stop signal, will exit after current job...")
     shutdown_flag.set()
+    # wake idle workers so they notice the flag now, not at their next timer
+    poke()
 
 
 signal.signal(signal.SIGINT, handle_sigterm)
@@ -26,97 +49,225 @@ except Exception:
     pass
 
 
-def process_job(job_id: str):
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    Background thread that keeps extending the leases of every job this
+    worker holds (running or queued in its batch), so long jobs are not
+    reaped. Jobs whose lease was lost end up in `lost`.
+    """
+
+    def __init__(self, owner: str, lease_seconds: int):
+        super().__init__(daemon=True)
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.interval = max(1.0, lease_seconds / 3.0)
+        self.held = set()
+        self.lost = set()
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+
+    def hold(self, job_ids: List[str]):
+        with self._lock:
+            self.held.update(job_ids)
+
+    def drop(self, job_id: str):
+        with self._lock:
+            self.held.discard(job_id)
+            self.lost.discard(job_id)
+
+    def is_lost(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self.lost
+
+    def stop(self):
+        self._halt.set()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            with self._lock:
+                ids = list(self.held - self.lost)
+            if not ids:
+                continue
+            still = set(extend_leases(ids, self.owner, int(time.time()) + self.lease_seconds))
+            with self._lock:
+                self.lost.update(j for j in ids if j not in still and j in self.held)
+
+
+def process_job(job_id: str, owner: Optional[str] = None, output: Optional[Tuple[int, str]] = None,
+                claimed_at: Optional[float] = None, pool: Optional[PythonPool] = None):
     job = get_job(job_id)
     if not job:
         return
+    if claimed_at is not None:
+        observe_wait(job, claimed_at)
 
     cmd = job["command"]
     job_timeout = job["timeout"] if job["timeout"] is not None else None
-    print(f"> Processing {job['id']} (priority={job['priority']} timeout={job_timeout}) cmd: {cmd}")
+    cap, log_dir = output or output_settings()
+    print(f"> Processing {job['id']} (priority={job['priority']} timeout={job_timeout}) {job['kind']}: {cmd}")
     try:
-        # run command with optional timeout
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=job_timeout)
-        out = (result.stdout or "").strip()
-        err = (result.stderr or "").strip()
-        if result.returncode == 0:
+        # run command with optional timeout, streaming output into bounded buffers
+        with METRICS.timer("run"):
+            if job["kind"] == "python":
+                if pool is None:
+                    raise RuntimeError("python job but this worker has no python pool")
+                returncode, out, err = pool.run(cmd, job["args"], job_timeout, job["id"], cap, log_dir)
+            else:
+                returncode, out, err = run_captured(cmd, job_timeout, job["id"], cap, log_dir)
+        if returncode is None:
+            err_msg = f"timeout after {job_timeout}s"
+            print(f"[TIMEOUT] {job['id']} -> {err_msg}")
+            # treat timeout like failure and retry/move to DLQ, keeping any output
+            handle_retry(job, err_msg, owner=owner, stdout=out or None, stderr=err or None)
+        elif returncode == 0:
             print(f"[OK] {job['id']}")
-            update_job_state(job["id"], state="completed", attempts=job["attempts"], last_stdout=out, last_stderr=err)
+            with METRICS.timer("commit"):
+                released = complete_job(job["id"], owner=owner, stdout=out, stderr=err)
+            if released is None:
+                print(f"[LOST] {job['id']} lease expired before completion; result discarded")
+            elif released:
+                print(f"[DEPS] {job['id']} released {len(released)} dependent job(s)")
+                poke()
         else:
-            print(f"[FAIL] {job['id']} (exit={result.returncode})")
-            handle_retry(job, err or out)
-    except subprocess.TimeoutExpired as te:
-        out = (getattr(te, "output", "") or "")
-        err = (getattr(te, "stderr", "") or "")
-        err_msg = f"timeout after {job_timeout}s"
-        print(f"[TIMEOUT] {job['id']} -> {err_msg}")
-        # treat timeout like failure and retry/move to DLQ
-        handle_retry(job, err_msg)
-        # save stdout/stderr if any
-        update_job_state(job["id"], last_stdout=(out.strip() if out else None), last_stderr=(err.strip() if err else None))
+            print(f"[FAIL] {job['id']} (exit={returncode})")
+            handle_retry(job, err or out, owner=owner, stdout=out, stderr=err)
     except Exception as e:
         print(f"[EXC] {job['id']} -> {e}")
-        handle_retry(job, str(e))
+        handle_retry(job, str(e), owner=owner)
+    if job["concurrency_key"]:
+        # a slot on this key is free again; workers idling on it can claim
+        poke()
 
 
-def handle_retry(job, err_msg):
-    attempts = int(job["attempts"] or 0) + 1
-    max_retries = int(job["max_retries"] or 3)
-    base = int(get_config("backoff_base") or 2)
-    if attempts > max_retries:
+def handle_retry(job, err_msg, owner: Optional[str] = None,
+                 stdout: Optional[str] = None, stderr: Optional[str] = None) -> bool:
+    """Record a failed run; fail_job() decides retry vs. DLQ in the same transaction."""
+    with METRICS.timer("commit"):
+        outcome = fail_job(job["id"], err_msg, owner=owner, stdout=stdout, stderr=stderr)
+    if outcome is None:
+        print(f"[LOST] {job['id']} lease expired before failure was recorded")
+        return False
+    state, attempts, delay = outcome
+    if state == "dead":
         print(f"[DLQ] Job {job['id']} moved to DLQ after {attempts-1} retries.")
-        update_job_state(job["id"], state="dead", attempts=attempts, last_error=err_msg, last_stderr=err_msg)
-        return
+    else:
+        print(f"[RETRY] {job['id']} in {delay}s (attempt {attempts}/{job['max_retries']})")
+        METRICS.observe("retry_delay", delay)
+        # idle workers may be sleeping past the new retry time
+        poke()
+    return True
 
-    delay = base ** attempts
-    next_run_at = int(time.time()) + delay
-    print(f"[RETRY] {job['id']} in {delay}s (attempt {attempts}/{max_retries})")
-    update_job_state(
-        job["id"],
-        state="pending",
-        attempts=attempts,
-        next_run_at=next_run_at,
-        last_error=err_msg,
-        last_stderr=err_msg,
-    )
-
-
-def worker_loop(poll_interval: float = 1.0):
-    print("Worker started. Press Ctrl+C to stop.")
-    while not shutdown_flag.is_set():
-        now_ts = int(time.time())
-        job_id = claim_one_pending(now_ts)
-        if not job_id:
-            time.sleep(poll_interval)
-            continue
-        process_job(job_id)
-        # brief pause to avoid tight-looping
-        time.sleep(0.2)
-
-
-def start_workers(count: int = 1, foreground: bool = False):
-    if foreground:
-        worker_loop()
-        return
 
-    procs = []
-    for _ in range(count):
-        p = multiprocessing.Process(target=worker_loop)
-        p.start()
-        procs.append(p)
+def idle_timeout(max_wait: float) -> float:
+    """Seconds an idle worker may sleep before something becomes due."""
+    now = time.time()
+    due = next_due_at(int(now))
+    if due is None:
+        return max_wait
+    # next_run_at/lease times are whole seconds; never spin on a past-due entry
+    return min(max_wait, max(0.1, due - now))
 
+
+def worker_loop(poll_interval: float = MAX_IDLE_SECONDS, batch_size: int = 1,
+                max_jobs: Optional[int] = None, stop=None, queues: Optional[List[str]] = None):
+    """
+    Claim and run jobs from `queues` (default: all) until shutdown_flag (or
+    this worker's own `stop` event) is set, or until `max_jobs` jobs have
+    been started.
+    """
+    def stopping() -> bool:
+        return shutdown_flag.is_set() or (stop is not None and stop.is_set())
+
+    owner = worker_id()
+    lease_seconds = int(get_config("lease_seconds") or DEFAULT_LEASE_SECONDS)
+    # jobs run one at a time, so one child; started on the first python job
+    # (or here, with python_pool_warm) from a forkserver, not forked off
+    # this process once the heartbeat thread runs
+    pool = start_pool(1)
+    heartbeat = LeaseHeartbeat(owner, lease_seconds)
+    heartbeat.start()
+    waker = Waker()
+    output = output_settings()
+    retention = BackgroundRetention(owner)
+    fair = FairShare(queues)
+    print(f"Worker {owner} started (batch size {batch_size}, lease {lease_seconds}s, "
+          f"queues {','.join(queues) if queues else 'all'}). Press Ctrl+C to stop.")
+    last_reap = 0.0
+    processed = 0
     try:
-        for p in procs:
-            p.join()
-    except KeyboardInterrupt:
-        print("Main received KeyboardInterrupt, shutting down children...")
-        shutdown_flag.set()
-        for p in procs:
+        while not stopping():
+            if max_jobs and processed >= max_jobs:
+                print(f"Worker {owner} ran {processed} job(s); exiting to be replaced.")
+                break
+            if time.time() - last_reap >= REAP_INTERVAL:
+                last_reap = time.time()
+                reaped = reap_expired_leases(int(last_reap))
+                if reaped:
+                    print(f"[REAP] {len(reaped)} expired lease(s) returned: {', '.join(reaped)}")
+                    poke()
+            METRICS.flush(owner)
+            if retention.due():
+                retention.run()
+            now_ts = int(time.time())
+            t0 = time.perf_counter()
+            n = min(batch_size, max_jobs - processed) if max_jobs else batch_size
+            job_ids = fair.claim(now_ts, n, owner=owner, lease_seconds=lease_seconds)
+            if not job_ids:
+                waker.wait(idle_timeout(poll_interval))
+                continue
+            METRICS.observe("claim", time.perf_counter() - t0)
+            claimed_at = time.time()
+            heartbeat.hold(job_ids)
+            started = 0
             try:
-                p.terminate()
-            except Exception:
-                pass
+                for job_id in job_ids:
+                    if stopping():
+                        break
+                    started += 1
+                    processed += 1
+                    if heartbeat.is_lost(job_id):
+                        print(f"[LOST] {job_id} lease expired before it started; skipping")
+                    else:
+                        process_job(job_id, owner=owner, output=output, claimed_at=claimed_at, pool=pool)
+                    heartbeat.drop(job_id)
+            finally:
+                # give the unstarted part of the batch back to other workers
+                remaining = job_ids[started:]
+                if remaining:
+                    release_jobs(remaining, owner=owner)
+                    for job_id in remaining:
+                        heartbeat.drop(job_id)
+                    print(f"Released {len(remaining)} unstarted job(s) back to pending.")
+                    poke()
+    finally:
+        heartbeat.stop()
+        waker.close()
+        pool.close()
+        METRICS.flush(owner, force=True)
+
+
+def start_workers(count: int = 1, foreground: bool = False, batch_size: int = 1, concurrency: int = 1,
+                  max_count: Optional[int] = None, max_jobs: Optional[int] = None,
+                  drain_timeout: Optional[float] = None, queues: Optional[List[str]] = None,
+                  schedules: bool = True):
+    if foreground:
+        if concurrency > 1:
+            # asyncio engine: each process runs up to `concurrency` jobs at once
+            from async_worker import async_worker_loop
+            async_worker_loop(concurrency, max_jobs=max_jobs, queues=queues)
+        else:
+            worker_loop(batch_size=batch_size, max_jobs=max_jobs, queues=queues)
+        return
+
+    from supervisor import Supervisor
+    Supervisor(count, max(max_count or count, count), batch_size=batch_size, concurrency=concurrency,
+               max_jobs=max_jobs, drain_timeout=drain_timeout, queues=queues, schedules=schedules).run()
 
 
 if __name__ == "__main__":
+    init_db()
     start_workers(1)